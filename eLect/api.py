@@ -1,22 +1,34 @@
 import os.path
 from datetime import datetime
+import hashlib
 import json
 import re
 
 from flask import request, Response, url_for, send_from_directory
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import func, select
+from werkzeug.http import http_date
 from werkzeug.utils import secure_filename
 from jsonschema import validate, ValidationError
 
 from . import models
 from . import decorators
+from . import serializers
 from eLect.main import app
 from eLect.custom_exceptions import *
-from .database import session
-from eLect.utils import get_or_create, json_serial
-from eLect.electiontypes import WinnerTakeAll, Proportional, Schulze
+from .database import session, pool_status, read_engine, use_primary
+from eLect.utils import get_or_create, race_ballot, update_pairwise_counts
+from eLect.utils import race_vote_version, dict_keys_to_int, cast_vote, lock_user_votes
+from eLect.electiontypes import get_tally_engine
+from eLect.parallel import stored_election_tally, enqueue_tallies
+from eLect.ballots import ballot_stats
+from eLect.journal import get_journal, receipt_status
 
 ### Global variables
-
+# PostgreSQL's foreign key violation SQLSTATE, and the constraint it names
+# for a vote whose user doesn't exist
+FOREIGN_KEY_VIOLATION = "23503"
+VOTE_USER_FOREIGN_KEY = "vote_user_id_fkey"
 
 ### Schemas for schema validation go here...
 ### GET schemas
@@ -124,13 +136,33 @@ candidate_POST_schema = {
 vote_POST_schema = {
     "type": "object",
     "properties": {
-        "value": {"type": "number"},
-        "user_id": {"type": "number"},
-        "candidate_id": {"type": "number"},
+        "value": {"type": "integer"},
+        "user_id": {"type": "integer"},
+        "candidate_id": {"type": "integer"},
     },
     "required": ["value", "candidate_id", "user_id"]
 }
 
+ballot_POST_schema = {
+    "type": "object",
+    "properties": {
+        "user_id": {"type": "integer"},
+        "votes": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "properties": {
+                    "candidate_id": {"type": "integer"},
+                    "value": {"type": "integer"},
+                },
+                "required": ["candidate_id", "value"]
+            }
+        },
+    },
+    "required": ["user_id", "votes"]
+}
+
 ### PUT schemas
 #
 
@@ -246,20 +278,6 @@ DELETE_schema = {
 #     except Exception as e:
 #         session.rollback()
 
-### Assign electiontypes model
-# TODO: There has GOT to be a better way to do this
-def assign_election_type(elect_type):
-    """Assign ElectionTypes models"""
-    if elect_type == "WTA":
-        elect_type = WinnerTakeAll()
-        return elect_type
-    if elect_type == "Proportional":
-        elect_type = Proportional()
-        return elect_type
-    if elect_type == "Schulze":
-        elect_type = Schulze()
-        return elect_type
-
 # Putting repetitive session query validations here...
 def check_election_id(elect_id):
     election = session.query(models.Election).get(elect_id)
@@ -289,6 +307,30 @@ def check_vote_id(vote_id):
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
+def lock_vote(vote_id, user_id=None):
+    """Takes the vote-writing locks of the vote's user and of user_id (see
+    lock_user_votes()), and returns the vote as it is once they are held,
+    or None if it was deleted meanwhile.  Ballots read afterwards can't be
+    changed by a concurrent request before this transaction ends"""
+    vote = session.query(models.Vote).get(vote_id)
+    locked = set()
+    while vote is not None:
+        user_ids = set([vote.user_id, user_id or vote.user_id]) - locked
+        if not user_ids:
+            return vote
+        for lock_id in sorted(user_ids):
+            lock_user_votes(lock_id)
+            locked.add(lock_id)
+        # Reloads the vote, in case another request changed its user
+        vote = session.query(models.Vote).populate_existing().filter(
+            models.Vote.id == vote_id).first()
+    return None
+
+def vote_not_found(vote_id):
+    message = "Could not find vote with id {}".format(vote_id)
+    data = json.dumps({"message": message})
+    return Response(data, 404, mimetype="application/json")
+
 def check_user_id(user_id):
     user = session.query(models.User).get(user_id)
     if not user:
@@ -296,6 +338,94 @@ def check_user_id(user_id):
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
+def paginate(query, id_column):
+    """Keyset pagination for list endpoints.  Returns the page of query's
+    rows with id_column greater than the request's "after" arg, at most
+    "limit" rows (DEFAULT_PAGE_SIZE, capped at MAX_PAGE_SIZE), and the
+    response headers.  When more rows follow, a Link rel="next" header holds
+    the next page's URL.  Requests without limit or after aren't paged, and
+    get every row"""
+    if "limit" not in request.args and "after" not in request.args:
+        return query.order_by(id_column).all(), {}
+
+    max_page_size = app.config.get("MAX_PAGE_SIZE", 1000)
+    limit = request.args.get("limit",
+        app.config.get("DEFAULT_PAGE_SIZE", 100), type=int)
+    limit = max(1, min(limit, max_page_size))
+    after = request.args.get("after", type=int)
+
+    if after is not None:
+        query = query.filter(id_column > after)
+    # One extra row tells whether there is a next page
+    rows = query.order_by(id_column).limit(limit + 1).all()
+
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        # Keeps the request's other args, such as fields
+        args = request.args.to_dict()
+        args.update(request.view_args)
+        args.update(after=rows[-1].id, limit=limit)
+        headers["Link"] = "<{}>; rel=\"next\"".format(url_for(request.endpoint, **args))
+    return rows, headers
+
+
+def conditional_get(query, model, collection=False):
+    """Conditional GET support.  Returns (response, headers): a 304 response
+    if the request's If-None-Match or If-Modified-Since still matches the
+    rows of query, otherwise None, and the ETag and Last-Modified headers for
+    a full response.  The validators come from one count and
+    max(last_modified) query, without loading or serializing any rows; rows
+    never modified count from their start_date.
+
+    Deleting a row doesn't move max(last_modified), so collections only get
+    an ETag, which also covers the count"""
+    modified = model.last_modified
+    if hasattr(model, "start_date"):
+        modified = func.coalesce(model.last_modified, model.start_date)
+    count, last_modified = query.with_entities(func.count(), func.max(modified)).one()
+    # A missing resource gets no validators, and its usual 404
+    if not collection and count == 0:
+        return None, {}
+
+    # The representation also depends on the args (fields, paging) and on
+    # the negotiated format
+    etag = hashlib.sha1("{} {} {} {}".format(request.full_path,
+        request.headers.get("Accept", ""), count, last_modified).encode("utf-8")).hexdigest()
+    headers = {"ETag": "\"{}\"".format(etag), "Cache-Control": "no-cache"}
+    if not collection and last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and "Last-Modified" in headers:
+        # HTTP dates have whole seconds
+        not_modified = last_modified.replace(microsecond=0) <= \
+            request.if_modified_since.replace(tzinfo=None)
+    else:
+        not_modified = False
+    if not_modified:
+        return Response(None, 304, headers=headers), headers
+    return None, headers
+
+def requested_fields(serializer, collection=False):
+    """Returns serializer narrowed to the request's "fields" arg, a
+    comma-separated list of field names.  Without one, returns serializer
+    itself, or for collections serializer.listed(), without the deferred
+    fields.  id is always included, as pagination keys on it.  Raises
+    ValueError for unknown fields"""
+    fields = request.args.get("fields")
+    if not fields:
+        return serializer.listed() if collection else serializer
+    fields = set(field.strip() for field in fields.split(",") if field.strip())
+    fields.add("id")
+    return serializer.only(fields)
+
+def fields_error(error):
+    """Returns the 400 response for a ValueError from requested_fields()"""
+    data = json.dumps({"message": str(error)})
+    return Response(data, 400, mimetype="application/json")
+
 
 ### Define the API endpoints
 ############################
@@ -311,27 +441,40 @@ def check_user_id(user_id):
 @decorators.accept("application/json")
 def elections_get():
     """ Returns a list of elections """
-
-    # TODO: how to paginate using API/JSON requests, WITHOUT
-    # loading every damn thing at once
+    try:
+        serializer = requested_fields(serializers.election, collection=True)
+    except ValueError as e:
+        return fields_error(e)
 
     elections = session.query(models.Election)
-    elections = elections.order_by(models.Election.id)
-
-    if not elections:
-        message = "No elections in database."
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
-
-    data = json.dumps([election.as_dictionary() for election in elections],
-        default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    not_modified, validators = conditional_get(elections, models.Election,
+        collection=True)
+    if not_modified:
+        return not_modified
+
+    # Pages through elections by id, see paginate().  Only the serialized
+    # columns are selected
+    elections = elections.with_entities(*serializer.attributes())
+    elections, headers = paginate(elections, models.Election.id)
+    headers.update(validators)
+
+    data = serializers.dumps(serializer.rows(elections))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/elections/<int:elect_id>", methods=["GET"])
 @decorators.accept("application/json")
 def election_get(elect_id):
     """ Returns a single election """
-    election = session.query(models.Election).get(elect_id)
+    try:
+        serializer = requested_fields(serializers.election)
+    except ValueError as e:
+        return fields_error(e)
+    election = session.query(models.Election).filter(
+        models.Election.id == elect_id)
+    not_modified, headers = conditional_get(election, models.Election)
+    if not_modified:
+        return not_modified
+    election = election.with_entities(*serializer.attributes()).first()
 
     # Check for election's existence
     if not election:
@@ -339,8 +482,8 @@ def election_get(elect_id):
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(election.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializer.row(election))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 
 @app.route("/api/elections/<int:elect_id>/races", methods=["GET"])
@@ -349,23 +492,27 @@ def races_get(elect_id):
     """ Returns a list of races from given election id """
 
     check_election_id(elect_id)
+    try:
+        serializer = requested_fields(serializers.race, collection=True)
+    except ValueError as e:
+        return fields_error(e)
     # Finds races for election with elect_id
     # QUESTION
     # what is the difference between .filter(SQL expressions),
     # and .filter_by(keyword expressions)?
     races = session.query(models.Race).filter(
         models.Race.election_id == elect_id)
+    not_modified, validators = conditional_get(races, models.Race,
+        collection=True)
+    if not_modified:
+        return not_modified
 
-    races = races.order_by(models.Race.id)
-
-    if not races:
-        message = "No races found associated with election with id {}.".format(elect_id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+    races = races.with_entities(*serializer.attributes())
+    races, headers = paginate(races, models.Race.id)
+    headers.update(validators)
 
-    data = json.dumps([race.as_dictionary() for race in races],
-        default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializer.rows(races))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/elections/<int:elect_id>/races/<int:race_id>", methods=["GET"])
 @app.route("/api/races/<int:race_id>", methods=["GET"])
@@ -375,9 +522,17 @@ def race_get(race_id, elect_id=None):
     # Check for election's existence, if elect_id is included
     if elect_id:
         check_election_id(elect_id)
+    try:
+        serializer = requested_fields(serializers.race)
+    except ValueError as e:
+        return fields_error(e)
 
     # Finds race with race_id
-    race = session.query(models.Race).get(race_id)
+    race = session.query(models.Race).filter(models.Race.id == race_id)
+    not_modified, headers = conditional_get(race, models.Race)
+    if not_modified:
+        return not_modified
+    race = race.with_entities(*serializer.attributes()).first()
 
     # Check for race's existence
     if not race:
@@ -385,8 +540,8 @@ def race_get(race_id, elect_id=None):
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(race.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializer.row(race))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/races/<int:race_id>/candidates",
  methods=["GET"])
@@ -395,20 +550,24 @@ def candidates_get(race_id):
     """ Returns a list of candidates from given race id"""
     # Check for race's existence
     check_race_id(race_id)
+    try:
+        serializer = requested_fields(serializers.candidate, collection=True)
+    except ValueError as e:
+        return fields_error(e)
     # Find candidates for given election / race
     candidates = session.query(models.Candidate).filter(
         models.Candidate.race_id == race_id)
+    not_modified, validators = conditional_get(candidates, models.Candidate,
+        collection=True)
+    if not_modified:
+        return not_modified
 
-    candidates = candidates.order_by(models.Candidate.id)
+    candidates = candidates.with_entities(*serializer.attributes())
+    candidates, headers = paginate(candidates, models.Candidate.id)
+    headers.update(validators)
 
-    if not candidates:
-        message = "No candidates found for race id #{}.".format(race_id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
-
-    data = json.dumps([candidate.as_dictionary() for candidate in candidates],
-        default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializer.rows(candidates))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/races/<int:race_id>/candidates/<int:cand_id>", methods=["GET"])
 @app.route("/api/candidates/<int:cand_id>", methods=["GET"])
@@ -420,8 +579,18 @@ def candidate_get(cand_id, elect_id=None, race_id=None):
     if race_id:
         check_race_id(race_id)
 
+    try:
+        serializer = requested_fields(serializers.candidate)
+    except ValueError as e:
+        return fields_error(e)
+
     # Find and check the candidate
-    candidate = session.query(models.Candidate).get(cand_id)
+    candidate = session.query(models.Candidate).filter(
+        models.Candidate.id == cand_id)
+    not_modified, headers = conditional_get(candidate, models.Candidate)
+    if not_modified:
+        return not_modified
+    candidate = candidate.with_entities(*serializer.attributes()).first()
 
     # Check for candidates's existence
     if not candidate:
@@ -429,45 +598,95 @@ def candidate_get(cand_id, elect_id=None, race_id=None):
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(candidate.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializer.row(candidate))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/races/<int:race_id>/votes", 
     methods=["GET"])
 @app.route("/api/candidates/<int:cand_id>/votes", 
     methods=["GET"])
-@decorators.accept("application/json")
+@decorators.accept("application/json", "application/x-ndjson")
 def votes_get(race_id=None, cand_id=None):
-    """ Returns a list of votes cast """
+    """ Returns a list of votes cast.  Streams every vote, unpaginated, as
+    NDJSON when the client prefers application/x-ndjson, or as one JSON
+    list with stream=1 """
+    try:
+        serializer = requested_fields(serializers.vote, collection=True)
+    except ValueError as e:
+        return fields_error(e)
     if cand_id:
         # Check for candidate's existence
         check_cand_id(cand_id)
         # Finds, checks, and returns a list of votes cast for candidate
         votes = session.query(models.Vote).filter(
             models.Vote.candidate_id == cand_id)
+        vote_filter = models.Vote.__table__.c.candidate_id == cand_id
     elif race_id:
         check_race_id(race_id)
         votes = session.query(models.Vote).filter(
             models.Vote.race_id == race_id)
+        vote_filter = models.Vote.__table__.c.race_id == race_id
     else:
         message = "No candidate_id or race_id provided"
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    votes = votes.order_by(models.Vote.id)
+    not_modified, validators = conditional_get(votes, models.Vote,
+        collection=True)
+    if not_modified:
+        return not_modified
 
-    if not votes:
-        if cand_id:
-            category = "candidate"
-        elif race_id: 
-            category = "race"
-        message = "Could not find any votes cast for {} with id #{}".format(category, cand_id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+    ndjson = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]) == "application/x-ndjson"
+    if ndjson or request.args.get("stream") == "1":
+        response = stream_votes(vote_filter, ndjson, serializer)
+        response.headers.extend(validators)
+        return response
 
-    data = json.dumps([vote.as_dictionary() for vote in votes],
-        default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    votes = votes.with_entities(*serializer.attributes())
+    votes, headers = paginate(votes, models.Vote.id)
+    headers.update(validators)
+
+    data = serializers.dumps(serializer.rows(votes))
+    return Response(data, 200, headers=headers, mimetype="application/json")
+
+def stream_votes(vote_filter, ndjson, serializer=serializers.vote):
+    """Streams the votes matching vote_filter, ordered by id, without
+    building ORM objects.  Rows come from a server-side cursor on a
+    connection of their own, and are sent in chunks of STREAM_CHUNK_ROWS
+    as NDJSON or a JSON list.  An "after" arg resumes after a vote id"""
+    vote = models.Vote.__table__
+    votes = select(serializer.columns()).where(vote_filter).order_by(vote.c.id)
+    after = request.args.get("after", type=int)
+    if after is not None:
+        votes = votes.where(vote.c.id > after)
+    chunk_rows = app.config.get("STREAM_CHUNK_ROWS", 1000)
+    # The generator runs after the request, so the engine is picked now
+    bind = read_engine()
+
+    def generate():
+        connection = bind.connect()
+        try:
+            result = connection.execution_options(stream_results=True).execute(votes)
+            separator = b"" if ndjson else b"["
+            while True:
+                rows = result.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                lines = [serializers.dumps(serializer.from_values(row))
+                    for row in rows]
+                if ndjson:
+                    yield b"\n".join(lines) + b"\n"
+                else:
+                    yield separator + b",".join(lines)
+                    separator = b","
+            if not ndjson:
+                yield b"]" if separator == b"," else b"[]"
+        finally:
+            connection.close()
+
+    mimetype = "application/x-ndjson" if ndjson else "application/json"
+    return Response(generate(), 200, mimetype=mimetype)
 
 @app.route("/api/candidates/<int:cand_id>/votes/<int:vote_id>", 
     methods=["GET"])
@@ -495,36 +714,44 @@ def vote_get(vote_id=None, elect_id=None, race_id=None, cand_id=None, user_id=No
     if all([user_id, race_id]):
         vote = session.query(models.Vote).filter(
             models.Vote.race_id == race_id,
-            models.Vote.user_id == user_id).first()
+            models.Vote.user_id == user_id)
     elif all([user_id, cand_id]):
         vote = session.query(models.Vote).filter(
             models.Vote.candidate_id == cand_id,
-            models.Vote.user_id == user_id).first()
+            models.Vote.user_id == user_id)
     else:
-        vote = session.query(models.Vote).get(vote_id)
+        vote = session.query(models.Vote).filter(models.Vote.id == vote_id)
+    not_modified, headers = conditional_get(vote, models.Vote)
+    if not_modified:
+        return not_modified
+    vote = vote.first()
 
     if not vote:
         message = "Could not find vote"
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(vote.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializers.vote.row(vote))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 
 @app.route("/api/users/<int:user_id>", methods=["GET"])
 @decorators.accept("application/json")
 def user_get(user_id):
     """ Returns information about a specific user """
-    user = session.query(models.User).get(user_id)
+    user = session.query(models.User).filter(models.User.id == user_id)
+    not_modified, headers = conditional_get(user, models.User)
+    if not_modified:
+        return not_modified
+    user = user.first()
 
     if not user:
         message = "Could not find user with id #{}".format(user_id)
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(user.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializers.user.row(user))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 
 @app.route("/api/types", methods=["GET"])
@@ -532,35 +759,77 @@ def user_get(user_id):
 def types_get():
     """ Returns a list of election types """
     elect_types = session.query(models.ElectionType)
+    not_modified, headers = conditional_get(elect_types, models.ElectionType,
+        collection=True)
+    if not_modified:
+        return not_modified
 
     if not elect_types:
         message = "No election types in database."
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps([elect_type.as_dictionary() for elect_type in elect_types],
-        default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializers.election_type.rows(elect_types))
+    return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/types/<type_enum>", methods=["GET"])
 @decorators.accept("application/json")
 def type_get(type_enum):
     """ Returns information about an election type """
-    elect_type = session.query(models.ElectionType).get(type_enum)
+    elect_type = session.query(models.ElectionType).filter(
+        models.ElectionType.election_type == type_enum)
+    not_modified, headers = conditional_get(elect_type, models.ElectionType)
+    if not_modified:
+        return not_modified
+    elect_type = elect_type.first()
 
     if not elect_type:
         message = "No election type with enum value of \"{}\".".format(type_enum)
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
-    data = json.dumps(elect_type.as_dictionary(), default=json_serial)
-    return Response(data, 200, mimetype="application/json")
+    data = serializers.dumps(serializers.election_type.row(elect_type))
+    return Response(data, 200, headers=headers, mimetype="application/json")
+
+@app.route("/api/votes/receipts/<receipt>", methods=["GET"])
+@decorators.accept("application/json")
+def vote_receipt_get(receipt):
+    """ Returns the vote for a receipt from the vote journal, or its status
+    while the vote is still waiting to be flushed """
+    # The journals are read first: a vote is committed before its segment
+    # is deleted, so one that isn't found there is in the vote table
+    status = None
+    if app.config.get("VOTE_JOURNAL_DIR"):
+        status = receipt_status(app.config["VOTE_JOURNAL_DIR"], receipt)
+    if status is None:
+        vote = session.query(models.Vote).filter(
+            models.Vote.receipt == receipt).first()
+        if vote:
+            data = serializers.dumps(serializers.vote.row(vote))
+            return Response(data, 200, mimetype="application/json")
+
+    if status == "pending":
+        data = json.dumps({"receipt": receipt, "status": status})
+        return Response(data, 202, mimetype="application/json")
+    if status == "rejected":
+        message = "Vote with receipt {} was rejected: the candidate, user or election was invalid, or the user had already voted.".format(
+            receipt)
+        data = json.dumps({"message": message})
+        return Response(data, 422, mimetype="application/json")
+
+    message = "Could not find vote with receipt {}".format(receipt)
+    data = json.dumps({"message": message})
+    return Response(data, 404, mimetype="application/json")
 
 @app.route("/api/elections/<int:elect_id>/races/<int:race_id>/tally", methods=["GET"])
 @app.route("/api/races/<int:race_id>/tally", methods=["GET"])
 @decorators.accept("application/json")
 def get_tally(race_id, elect_id=None):
     """ Tallies results for race [race_id] """
+    # The cached Results are rewritten from what this request reads, which
+    # a lagging replica could have older than the primary
+    use_primary()
+
     # Check for election's existence, if elect_id is included
     if elect_id:
         check_election_id(elect_id)
@@ -574,26 +843,105 @@ def get_tally(race_id, elect_id=None):
     # Finds race election type
     elect_type_enum = race.election_type
 
-    # Inits elect_type object with elect_type_enum identifier
-    elect_type = assign_election_type(elect_type_enum)
+    # Results are cached per race, vote-set version and election type.
+    # Closed races can be reopened and their candidates edited, so clients
+    # revalidate every time, which the version-keyed ETag keeps cheap
+    vote_version = race_vote_version(race_id)
+    etag = "race-{}-{}-v{}".format(race_id, elect_type_enum, vote_version)
+    headers = {"ETag": "\"{}\"".format(etag), "Cache-Control": "no-cache"}
+    if request.if_none_match.contains(etag):
+        return Response(None, 304, headers=headers)
+
+    # Looks up the shared tally engine for elect_type_enum
+    elect_type = get_tally_engine(elect_type_enum)
     if not elect_type:
         message = "Could not find election type with enum {}".format(
             elect_type_enum)
         data = json.dumps({"message": message})
         return Response(data, 404, mimetype="application/json")
 
+    cached_results = session.query(models.Results).filter(
+        models.Results.race_id == race_id,
+        models.Results.election_type == elect_type_enum,
+        models.Results.vote_version == vote_version).first()
+
     # Attempts to tally race and check results, according to elect_type rules
     try:
-        results = elect_type.tally_race(race_id)
+        if cached_results:
+            # JSONB keys are strings, the tally engines use int cand ids
+            results = dict_keys_to_int(cached_results.results.items())
+        else:
+            results = elect_type.tally_race(race_id)
         elect_type.check_results(results)
     except Exception as e:
         message = "Tally Error: {}".format(e)
         data = json.dumps({"message": message})
         return Response(data, 400, mimetype="application/json")
 
-    data = json.dumps(results)
+    if not cached_results:
+        # Replaces the race's stale results with the new tally
+        session.query(models.Results).filter(
+            models.Results.race_id == race_id,
+            models.Results.vote_version != None).delete(synchronize_session=False)
+        session.add(models.Results(
+            race_id=race_id,
+            results=results,
+            vote_version=vote_version))
+        session.commit()
+
+    data = serializers.dumps(results)
+    return Response(data, 200, headers=headers, mimetype="application/json")
+
+@app.route("/api/races/<int:race_id>/ballots/stats", methods=["GET"])
+@decorators.accept("application/json")
+def ballot_stats_get(race_id):
+    """ Returns the number of ballots, and unique ballots, cast in a race """
+    race = session.query(models.Race).get(race_id)
+
+    # Check for race's existence
+    if not race:
+        message = "Could not find race with id {}".format(race_id)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+
+    data = serializers.dumps(ballot_stats(race_id))
+    return Response(data, 200, mimetype="application/json")
+
+@app.route("/api/elections/<int:elect_id>/tally", methods=["GET"])
+@decorators.accept("application/json")
+def election_tally_get(elect_id):
+    """ Returns the stored tally of every race in election [elect_id].  Races
+    without current results are tallied in the background, and the request
+    is answered 202 until they are done """
+    election = session.query(models.Election).get(elect_id)
+
+    # Check for election's existence
+    if not election:
+        message = "Could not find election with id {}".format(elect_id)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+
+    tallies, stale_race_ids = stored_election_tally(elect_id)
+    if stale_race_ids:
+        enqueue_tallies(stale_race_ids)
+        message = "Tallying {} races of election id {}, try again shortly.".format(
+            len(stale_race_ids), elect_id)
+        data = json.dumps({"message": message, "pending_race_ids": stale_race_ids})
+        headers = {"Retry-After": "1"}
+        return Response(data, 202, headers=headers, mimetype="application/json")
+
+    data = serializers.dumps(tallies)
     return Response(data, 200, mimetype="application/json")
 
+@app.route("/api/database/pool", methods=["GET"])
+@decorators.accept("application/json")
+def pool_get():
+    """ Returns the database connection pool's usage, and how long requests
+    have waited to check out connections """
+    data = json.dumps(pool_status())
+    return Response(data, 200, headers={"Cache-Control": "no-store"},
+        mimetype="application/json")
+
 ############################
 # POST endpoints
 ############################
@@ -629,7 +977,7 @@ def election_post():
 
     # Return a 201 Created, containing the election as JSON and with the 
     # Location header set to the location of the election
-    data = json.dumps(election.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.election.row(election))
     headers = {"Location": url_for("election_get", elect_id=election.id)}
     return Response(data, 201, headers=headers, mimetype="application/json")
 
@@ -668,7 +1016,7 @@ def race_post():
 
     # Return a 201 Created, containing the election as JSON and with the 
     # Location header set to the location of the election
-    data = json.dumps(race.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.race.row(race))
     headers = {"Location": url_for("race_get", race_id=race.id)}
     return Response(data, 201, headers=headers, mimetype="application/json")
 
@@ -711,7 +1059,7 @@ def candidate_post():
 
     # Return a 201 Created, containing the candidate as JSON and with the 
     # Location header set to the location of the candidate
-    data = json.dumps(candidate.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.candidate.row(candidate))
     headers = {"Location": url_for("candidate_get", cand_id=candidate.id)}
     return Response(data, 201, headers=headers, mimetype="application/json")
 
@@ -722,19 +1070,59 @@ def vote_post():
     """ Add new vote """
     data = request.json
 
-    check_cand_id(data["candidate_id"])
-    check_user_id(data["user_id"])
     # Validate header data vs. schema
     try:
         validate(data, vote_POST_schema)
     except ValidationError as error:
         data = {"message": error.message}
         return Response(json.dumps(data), 422, mimetype="application/json")
-    
-    candidate = session.query(models.Candidate).get(
-        data["candidate_id"])
-    race = candidate.race
 
+    # With the vote journal on, the vote is only written to the journal.
+    # It is checked against the database when flushed
+    journal = get_journal()
+    if journal:
+        receipt = journal.append(data["user_id"], data["candidate_id"], data["value"])
+        data = json.dumps({"receipt": receipt, "status": "pending"})
+        headers = {"Location": url_for("vote_receipt_get", receipt=receipt)}
+        return Response(data, 202, headers=headers, mimetype="application/json")
+
+    # Add the vote to the database.  Closed elections and repeat votes are
+    # rejected by the insert itself, see cast_vote()
+    try:
+        vote = cast_vote(data["user_id"], data["candidate_id"], data["value"])
+    except IntegrityError as error:
+        session.rollback()
+        if not unknown_user_error(error):
+            raise
+        message = "Could not find user with id {}".format(data["user_id"])
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+    if vote is None:
+        session.rollback()
+        return vote_rejected(data["user_id"], data["candidate_id"])
+    session.commit()
+
+    # Return a 201 Created, containing the vote as JSON and with the 
+    # Location header set to the location of the election
+    data = serializers.dumps(serializers.vote.row(vote))
+    headers = {"Location": url_for("election_get", elect_id=vote.election_id)}
+    return Response(data, 201, headers=headers, mimetype="application/json")
+
+def unknown_user_error(error):
+    """Returns whether an IntegrityError is a vote's user_id foreign key
+    violation"""
+    orig = getattr(error, "orig", None)
+    return getattr(orig, "pgcode", None) == FOREIGN_KEY_VIOLATION and \
+        orig.diag.constraint_name == VOTE_USER_FOREIGN_KEY
+
+def vote_rejected(user_id, candidate_id):
+    """Works out why cast_vote() inserted nothing, and returns the matching
+    error Response"""
+    candidate = session.query(models.Candidate).get(candidate_id)
+    if not candidate or not candidate.race or not candidate.race.election:
+        message = "Could not find candidate with id {}".format(candidate_id)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
 
     # Check if election is still currently open
     if not candidate.race.election.elect_open:
@@ -743,36 +1131,143 @@ def vote_post():
         data = json.dumps({"message": message})
         return Response(data, 403, mimetype="application/json")
 
-    # Check if user already voted for this candidate / race
-    existing_candidate_votes = session.query(models.Vote).filter(
-        models.Vote.user_id == data["user_id"],
-        models.Vote.candidate_id == data["candidate_id"]).count()
-    existing_race_votes = session.query(models.Vote).filter(
-        models.Vote.user_id == data["user_id"],
-        models.Vote.race_id == race.id).count()
+    # Otherwise, the user already voted for this candidate / race
+    return vote_conflict(user_id, candidate_id, candidate.race_id)
 
-    if existing_candidate_votes > 0:
+def vote_conflict(user_id, candidate_id, race_id):
+    """Returns the 403 Response for a vote that clashes with one of the
+    user's existing votes"""
+    duplicate_vote = session.query(models.Vote.id).filter(
+        models.Vote.user_id == user_id,
+        models.Vote.candidate_id == candidate_id).first()
+    if duplicate_vote:
         message = "User with id {} has already voted for candidate with id {}.".format(
-            data["user_id"],
-            data["candidate_id"])
+            user_id,
+            candidate_id)
+    else:
+        message = "User with id {} has already voted in race id {}.".format(
+            user_id,
+            race_id)
+    data = json.dumps({"message": message})
+    return Response(data, 403, mimetype="application/json")
+
+@app.route("/api/races/<int:race_id>/ballot", methods=["POST"])
+@decorators.accept("application/json")
+@decorators.require("application/json")
+def ballot_post(race_id):
+    """ Add a user's whole ballot for a race, in one transaction """
+    data = request.json
+
+    # Validate header data vs. schema
+    try:
+        validate(data, ballot_POST_schema)
+    except ValidationError as error:
+        data = {"message": error.message}
+        return Response(json.dumps(data), 422, mimetype="application/json")
+
+    user_id = data["user_id"]
+    ballot = {vote["candidate_id"]: vote["value"] for vote in data["votes"]}
+    if len(ballot) < len(data["votes"]):
+        message = "Ballot lists a candidate more than once."
+        data = json.dumps({"message": message})
+        return Response(data, 422, mimetype="application/json")
+
+    # Fetches everything the ballot is validated against in one query
+    race_info = session.query(
+        models.Race.election_type,
+        models.Race._min_vote_val,
+        models.Race._max_vote_val,
+        models.Election.id,
+        models.Election.elect_open,
+        func.array_agg(models.Candidate.id),
+        session.query(models.User.id).filter(
+            models.User.id == user_id).exists()).join(
+        models.Election, models.Race.election_id == models.Election.id).outerjoin(
+        models.Candidate, models.Candidate.race_id == models.Race.id).filter(
+        models.Race.id == race_id).group_by(
+        models.Race.id, models.Election.id).first()
+
+    if not race_info:
+        message = "Could not find race with id {}".format(race_id)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+    (elect_type, min_vote_val, max_vote_val, elect_id, elect_open,
+        candidate_ids, user_exists) = race_info
+
+    if not user_exists:
+        message = "Could not find user with id {}".format(user_id)
+        data = json.dumps({"message": message})
+        return Response(data, 404, mimetype="application/json")
+
+    # Check if election is still currently open
+    if not elect_open:
+        message = "Election with id {} is currently closed, and not accepting new votes.".format(
+            elect_id)
         data = json.dumps({"message": message})
         return Response(data, 403, mimetype="application/json")
-    if existing_race_votes > 0 and race.election_type not in race._ranking_types:
+
+    for cand_id, value in ballot.items():
+        if cand_id not in candidate_ids:
+            message = "Could not find candidate with id {} in race id {}".format(
+                cand_id, race_id)
+            data = json.dumps({"message": message})
+            return Response(data, 422, mimetype="application/json")
+        if not min_vote_val <= value <= max_vote_val:
+            message = "Vote value {} for candidate with id {} is outside race id {}'s range of {} to {}.".format(
+                value, cand_id, race_id, min_vote_val, max_vote_val)
+            data = json.dumps({"message": message})
+            return Response(data, 422, mimetype="application/json")
+
+    if len(ballot) > 1 and elect_type not in models.Race._ranking_types:
+        message = "Race id {} only allows one vote per user.".format(race_id)
+        data = json.dumps({"message": message})
+        return Response(data, 422, mimetype="application/json")
+
+    # Check if user already voted for these candidates / race.
+    lock_user_votes(user_id)
+    old_ballot = race_ballot(race_id, user_id)
+    for cand_id in ballot:
+        if cand_id in old_ballot:
+            message = "User with id {} has already voted for candidate with id {}.".format(
+                user_id,
+                cand_id)
+            data = json.dumps({"message": message})
+            return Response(data, 403, mimetype="application/json")
+    if old_ballot and elect_type not in models.Race._ranking_types:
         message = "User with id {} has already voted in race id {}.".format(
-            data["user_id"],
-            race.id)
+            user_id,
+            race_id)
         data = json.dumps({"message": message})
         return Response(data, 403, mimetype="application/json")
 
-    # Add the vote to the database
-    vote = models.Vote(**data)
-    session.add(vote)
+    # Adds all of the ballot's votes with a single executemany.  A vote by
+    # the same user committed since the check above trips a unique index
+    try:
+        session.execute(models.Vote.__table__.insert(), [{
+            "user_id": user_id,
+            "race_id": race_id,
+            "candidate_id": cand_id,
+            "value": value}
+            for cand_id, value in ballot.items()])
+    except IntegrityError:
+        session.rollback()
+        message = "User with id {} has already voted in race id {}.".format(
+            user_id,
+            race_id)
+        data = json.dumps({"message": message})
+        return Response(data, 403, mimetype="application/json")
+    new_ballot = dict(old_ballot)
+    new_ballot.update(ballot)
+    update_pairwise_counts(race_id, old_ballot, new_ballot)
     session.commit()
 
-    # Return a 201 Created, containing the vote as JSON and with the 
-    # Location header set to the location of the election
-    data = json.dumps(vote.as_dictionary(), default=json_serial)
-    headers = {"Location": url_for("election_get", elect_id=candidate.race.election.id)}
+    # Return a 201 Created, containing the user's ballot for the race
+    data = json.dumps({
+        "race_id": race_id,
+        "user_id": user_id,
+        "votes": [{"candidate_id": cand_id, "value": value}
+            for cand_id, value in sorted(new_ballot.items())]})
+    headers = {"Location": url_for("race_get", race_id=race_id)}
     return Response(data, 201, headers=headers, mimetype="application/json")
 
 @app.route("/api/users", methods=["POST"])
@@ -804,7 +1299,7 @@ def user_post():
     session.commit()
 
     # Return a 201 Created, 
-    data = json.dumps(user.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.user.row(user))
     # Update this to send them back to previous page before 
     headers = {"Location": url_for("elections_get")}
     return Response(data, 201, headers=headers, mimetype="application/json")
@@ -839,7 +1334,7 @@ def election_put():
         setattr(election, key, value)
     session.commit()
 
-    data = json.dumps(election.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.election.row(election))
     headers = {"Location": url_for("election_get", elect_id=election.id)}
     return Response(data, 200, headers=headers, mimetype="application/json")
 
@@ -866,9 +1361,18 @@ def race_put():
     data.pop("id", None)
     for key, value in data.items():
         setattr(race, key, value)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        # See the race_ranked trigger in models.py
+        session.rollback()
+        message = "Race id {} has users with more than one vote, and can't change to election type {}.".format(
+            race.id,
+            data.get("election_type"))
+        data = json.dumps({"message": message})
+        return Response(data, 403, mimetype="application/json")
 
-    data = json.dumps(race.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.race.row(race))
     headers = {"Location": url_for("race_get", race_id=race.id)}
     return Response(data, 200, headers=headers, mimetype="application/json")
 
@@ -898,7 +1402,7 @@ def candidate_put():
         setattr(candidate, key, value)
     session.commit()
 
-    data = json.dumps(candidate.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.candidate.row(candidate))
     headers = {"Location": url_for("candidate_get", cand_id=candidate.id)}
     return Response(data, 200, headers=headers, mimetype="application/json")
 
@@ -917,14 +1421,17 @@ def vote_put():
         return Response(json.dumps(data), 422, mimetype="application/json")
     # Check if vote exists
     check_vote_id(data["id"])
-    # Check if candidate exists
-    check_cand_id(data["candidate_id"])
-    candidate = session.query(models.Candidate).filter(
-        models.Candidate.id == data["candidate_id"]).first()
 
+    # Init Vote object with id=data["id"], holding its ballots' locks
+    vote = lock_vote(data["id"], data.get("user_id"))
+    if vote is None:
+        return vote_not_found(data["id"])
 
-    # Init Vote object with id=data["id"]
-    vote = session.query(models.Vote).get(data["id"])
+    # Check if candidate exists
+    candidate_id = data.get("candidate_id", vote.candidate_id)
+    check_cand_id(candidate_id)
+    candidate = session.query(models.Candidate).filter(
+        models.Candidate.id == candidate_id).first()
 
     # Checks if election is still open
     if not candidate.race.election.elect_open:
@@ -933,14 +1440,31 @@ def vote_put():
         data = json.dumps({"message": message})
         return Response(data, 403, mimetype="application/json")
 
+    # Ballots touched by this edit, as they were before it
+    ballot_keys = set([
+        (vote.race_id, vote.user_id),
+        (candidate.race_id, data.get("user_id", vote.user_id))])
+    old_ballots = {key: race_ballot(*key) for key in ballot_keys}
+
     # Update target vote
+    user_id = data.get("user_id", vote.user_id)
     data.pop("id", None)
     for key, value in data.items():
-        vote[key] = value
+        setattr(vote, key, value)
+    vote.race_id = candidate.race_id
+    try:
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        return vote_conflict(user_id, candidate.id, candidate.race_id)
+
+    # Update pairwise counts with each ballot's change
+    for (race_id, user_id), old_ballot in old_ballots.items():
+        update_pairwise_counts(race_id, old_ballot, race_ballot(race_id, user_id))
     session.commit()
 
-    data = json.dumps(vote.as_dictionary(), default=json_serial)
-    headers = {"Location": url_for("vote_get", id=vote.id)}
+    data = serializers.dumps(serializers.vote.row(vote))
+    headers = {"Location": url_for("vote_get", vote_id=vote.id)}
     return Response(data, 200, headers=headers, mimetype="application/json")
 
 @app.route("/api/users", methods=["PUT"])
@@ -967,7 +1491,7 @@ def user_put():
         user[key] = value
     session.commit()
 
-    data = json.dumps(user.as_dictionary(), default=json_serial)
+    data = serializers.dumps(serializers.user.row(user))
     headers = {"Location": url_for("user_get", id=user.id)}
     return Response(data, 200, headers=headers, mimetype="application/json")
 
@@ -1091,17 +1615,23 @@ def vote_delete():
 
     check_vote_id(data["id"])
 
-    # Obtains vote object with id=data["id"]
-    vote = session.query(models.Vote).get(data["id"])
-    # Obtains parent race_id and creates JSON header data for subsequent redirect
+    # Obtains vote object with id=data["id"], holding its ballot's lock
+    vote = lock_vote(data["id"])
+    if vote is None:
+        return vote_not_found(data["id"])
+    # Obtains parent race_id for subsequent redirect
     race_id = vote.candidate.race_id
-    race_data = json.dump({"id": race_id})
+    # Removes the vote from the user's ballot in the race's pairwise counts
+    old_ballot = race_ballot(race_id, vote.user_id)
+    new_ballot = dict(old_ballot)
+    new_ballot.pop(vote.candidate_id, None)
+    update_pairwise_counts(race_id, old_ballot, new_ballot)
     # Deletes vote and commits
     session.delete(vote)
     session.commit()
 
     message = "Deleted vote id #{}".format(data["id"])
     data = json.dumps({"message": message})
-    headers = {"Location": url_for("race_get", data=race_data)}
+    headers = {"Location": url_for("race_get", race_id=race_id)}
 
     return Response(data, 200, headers=headers, mimetype="application/json")
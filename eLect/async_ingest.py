@@ -0,0 +1,305 @@
+### Asyncio vote ingestion service
+#
+# An aiohttp front end for POST /api/votes and POST /api/races/<id>/ballot,
+# answering exactly as the Flask API does.  Requests are validated against
+# the API's own schemas, and write with the same SQL as utils.cast_vote()
+# and ballot_post(), over an asyncpg connection pool.  A request only holds
+# a connection while its transaction runs, so thousands of in-flight votes
+# share ASYNC_INGEST_POOL_SIZE connections, queueing for one in acquire()
+# instead of holding a thread each.
+#
+# The vote journal isn't used here: votes are always written directly, and
+# answered 201.  Run the service with "python run.py run_ingest".
+import datetime
+import re
+
+import asyncpg
+from aiohttp import web
+from jsonschema import validate, ValidationError
+
+from eLect import models
+from eLect import serializers
+from eLect import utils
+from eLect.api import vote_POST_schema, ballot_POST_schema, VOTE_USER_FOREIGN_KEY
+from eLect.main import app
+
+
+class Statement(object):
+    """A text() style SQL statement with :name parameters, rewritten to
+    asyncpg's numbered $n placeholders.  A name used more than once keeps
+    one number"""
+    def __init__(self, sql):
+        self.names = []
+        self.sql = re.sub(r"(?<!:):(\w+)", self._placeholder, sql)
+
+    def _placeholder(self, match):
+        name = match.group(1)
+        if name not in self.names:
+            self.names.append(name)
+        return "${}".format(self.names.index(name) + 1)
+
+    def args(self, params):
+        """Returns the positional arguments for a dict of parameters"""
+        return [params[name] for name in self.names]
+
+lock_user = Statement(utils.lock_user_sql)
+cast_vote = Statement(utils.cast_vote_sql)
+
+# Why cast_vote inserted nothing, as in api.vote_rejected()
+candidate_info = Statement("""
+SELECT candidate.race_id, election.id, election.elect_open
+FROM candidate
+JOIN race ON race.id = candidate.race_id
+JOIN election ON election.id = race.election_id
+WHERE candidate.id = :candidate_id
+""")
+duplicate_vote = Statement("""
+SELECT 1 FROM vote WHERE user_id = :user_id AND candidate_id = :candidate_id LIMIT 1
+""")
+
+# Everything a ballot is validated against, as in api.ballot_post()
+race_info = Statement("""
+SELECT CAST(race.election_type AS text), race._min_vote_val, race._max_vote_val,
+    election.id, election.elect_open, array_agg(candidate.id),
+    EXISTS (SELECT 1 FROM "user" WHERE "user".id = :user_id)
+FROM race
+JOIN election ON election.id = race.election_id
+LEFT JOIN candidate ON candidate.race_id = race.id
+WHERE race.id = :race_id
+GROUP BY race.id, election.id
+""")
+race_ballot = Statement("""
+SELECT candidate_id, value FROM vote WHERE race_id = :race_id AND user_id = :user_id
+""")
+insert_vote = Statement("""
+INSERT INTO vote (user_id, race_id, candidate_id, value, start_date)
+VALUES (:user_id, :race_id, :candidate_id, :value, :start_date)
+""")
+upsert_pairwise_count = Statement("""
+INSERT INTO pairwise_count (race_id, cand1_id, cand2_id, num_users_prefer)
+VALUES (:race_id, :cand1_id, :cand2_id, :num_users_prefer)
+ON CONFLICT (race_id, cand1_id, cand2_id) DO UPDATE
+SET num_users_prefer = pairwise_count.num_users_prefer + EXCLUDED.num_users_prefer
+""")
+
+
+def json_response(data, status, headers=None):
+    return web.Response(body=serializers.dumps(data), status=status,
+        headers=headers, content_type="application/json")
+
+def message_response(message, status):
+    return json_response({"message": message}, status)
+
+@web.middleware
+async def json_only(request, handler):
+    """Answers 406 and 415 as the accept() and require() decorators do"""
+    accept = request.headers.get("Accept", "*/*")
+    if not any(mimetype in accept
+            for mimetype in ("application/json", "application/*", "*/*")):
+        return message_response("Request must accept application/json data", 406)
+    if request.content_type != "application/json":
+        return message_response("Request must contain application/json data", 415)
+    return await handler(request)
+
+async def read_json(request, schema):
+    """Returns the request's JSON, or raises a 422 if it doesn't match
+    the schema"""
+    try:
+        data = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(body=serializers.dumps(
+            {"message": "Request body is not valid JSON"}),
+            content_type="application/json")
+    try:
+        validate(data, schema)
+    except ValidationError as error:
+        raise web.HTTPUnprocessableEntity(body=serializers.dumps(
+            {"message": error.message}), content_type="application/json")
+    return data
+
+
+async def vote_post(request):
+    """ Add new vote """
+    data = await read_json(request, vote_POST_schema)
+    # The schema's integers may still be JSON floats like 2.0, which
+    # asyncpg won't bind as integer parameters
+    params = {
+    "user_id": int(data["user_id"]),
+    "candidate_id": int(data["candidate_id"]),
+    "value": int(data["value"]),
+    "start_date": datetime.datetime.utcnow(),
+    }
+
+    async with request.app["pool"].acquire() as connection:
+        try:
+            async with connection.transaction():
+                await connection.execute(lock_user.sql, *lock_user.args(params))
+                vote = await connection.fetchrow(cast_vote.sql, *cast_vote.args(params))
+        except asyncpg.ForeignKeyViolationError as error:
+            if error.constraint_name != VOTE_USER_FOREIGN_KEY:
+                raise
+            return message_response(
+                "Could not find user with id {}".format(data["user_id"]), 404)
+        if vote is None:
+            return await vote_rejected(connection, params)
+
+    data = serializers.vote.from_values([vote[field] for field in serializers.vote.fields])
+    headers = {"Location": "/api/elections/{}".format(vote["election_id"])}
+    return json_response(data, 201, headers)
+
+async def vote_rejected(connection, params):
+    """Works out why cast_vote inserted nothing, and returns the matching
+    error Response"""
+    candidate = await connection.fetchrow(candidate_info.sql,
+        *candidate_info.args(params))
+    if candidate is None:
+        return message_response(
+            "Could not find candidate with id {}".format(params["candidate_id"]), 404)
+    race_id, elect_id, elect_open = candidate
+
+    # Check if election is still currently open
+    if not elect_open:
+        return message_response(
+            "Election with id {} is currently closed, and not accepting new votes.".format(
+                elect_id), 403)
+
+    # Otherwise, the user already voted for this candidate / race
+    if await connection.fetchval(duplicate_vote.sql, *duplicate_vote.args(params)):
+        message = "User with id {} has already voted for candidate with id {}.".format(
+            params["user_id"],
+            params["candidate_id"])
+    else:
+        message = "User with id {} has already voted in race id {}.".format(
+            params["user_id"],
+            race_id)
+    return message_response(message, 403)
+
+
+class BallotRejected(Exception):
+    """Ends a ballot's transaction with an error Response"""
+    def __init__(self, response):
+        super(BallotRejected, self).__init__()
+        self.response = response
+
+async def ballot_post(request):
+    """ Add a user's whole ballot for a race, in one transaction """
+    race_id = int(request.match_info["race_id"])
+    data = await read_json(request, ballot_POST_schema)
+
+    # As in vote_post(), JSON floats like 2.0 pass the schema as integers
+    user_id = int(data["user_id"])
+    ballot = {int(vote["candidate_id"]): int(vote["value"]) for vote in data["votes"]}
+    if len(ballot) < len(data["votes"]):
+        return message_response("Ballot lists a candidate more than once.", 422)
+
+    async with request.app["pool"].acquire() as connection:
+        try:
+            async with connection.transaction():
+                new_ballot = await cast_ballot(connection, race_id, user_id, ballot)
+        except BallotRejected as rejected:
+            return rejected.response
+        except asyncpg.UniqueViolationError:
+            # A vote by the same user committed since the ballot was checked
+            return message_response(
+                "User with id {} has already voted in race id {}.".format(
+                    user_id,
+                    race_id), 403)
+
+    # Return a 201 Created, containing the user's ballot for the race
+    data = {
+    "race_id": race_id,
+    "user_id": user_id,
+    "votes": [{"candidate_id": cand_id, "value": value}
+        for cand_id, value in sorted(new_ballot.items())],
+    }
+    headers = {"Location": "/api/races/{}".format(race_id)}
+    return json_response(data, 201, headers)
+
+async def cast_ballot(connection, race_id, user_id, ballot):
+    """Checks and inserts a ballot, and updates the race's pairwise counts,
+    in the connection's transaction.  Returns the user's whole ballot for
+    the race.  Raises BallotRejected with the error Response for a ballot
+    that can't be cast"""
+    params = {"race_id": race_id, "user_id": user_id}
+    info = await connection.fetchrow(race_info.sql, *race_info.args(params))
+    if info is None:
+        raise BallotRejected(message_response(
+            "Could not find race with id {}".format(race_id), 404))
+    (elect_type, min_vote_val, max_vote_val, elect_id, elect_open,
+        candidate_ids, user_exists) = info
+
+    if not user_exists:
+        raise BallotRejected(message_response(
+            "Could not find user with id {}".format(user_id), 404))
+
+    # Check if election is still currently open
+    if not elect_open:
+        raise BallotRejected(message_response(
+            "Election with id {} is currently closed, and not accepting new votes.".format(
+                elect_id), 403))
+
+    for cand_id, value in ballot.items():
+        if cand_id not in candidate_ids:
+            raise BallotRejected(message_response(
+                "Could not find candidate with id {} in race id {}".format(
+                    cand_id, race_id), 422))
+        if not min_vote_val <= value <= max_vote_val:
+            raise BallotRejected(message_response(
+                "Vote value {} for candidate with id {} is outside race id {}'s range of {} to {}.".format(
+                    value, cand_id, race_id, min_vote_val, max_vote_val), 422))
+
+    if len(ballot) > 1 and elect_type not in models.Race._ranking_types:
+        raise BallotRejected(message_response(
+            "Race id {} only allows one vote per user.".format(race_id), 422))
+
+    # Check if user already voted for these candidates / race.
+    await connection.execute(lock_user.sql, *lock_user.args(params))
+    old_ballot = dict(await connection.fetch(race_ballot.sql, *race_ballot.args(params)))
+    for cand_id in ballot:
+        if cand_id in old_ballot:
+            raise BallotRejected(message_response(
+                "User with id {} has already voted for candidate with id {}.".format(
+                    user_id,
+                    cand_id), 403))
+    if old_ballot and elect_type not in models.Race._ranking_types:
+        raise BallotRejected(message_response(
+            "User with id {} has already voted in race id {}.".format(
+                user_id,
+                race_id), 403))
+
+    start_date = datetime.datetime.utcnow()
+    await connection.executemany(insert_vote.sql, [insert_vote.args({
+        "user_id": user_id,
+        "race_id": race_id,
+        "candidate_id": cand_id,
+        "value": value,
+        "start_date": start_date})
+        for cand_id, value in ballot.items()])
+    new_ballot = dict(old_ballot)
+    new_ballot.update(ballot)
+    deltas = utils.pairwise_count_deltas(race_id, old_ballot, new_ballot)
+    if deltas:
+        await connection.executemany(upsert_pairwise_count.sql,
+            [upsert_pairwise_count.args(delta) for delta in deltas])
+    return new_ballot
+
+
+async def database_pool(application):
+    """Opens the app's connection pool for as long as it runs"""
+    application["pool"] = await asyncpg.create_pool(app.config["DATABASE_URI"],
+        min_size=app.config.get("ASYNC_INGEST_POOL_MIN_SIZE", 2),
+        max_size=app.config.get("ASYNC_INGEST_POOL_SIZE", 10))
+    yield
+    await application["pool"].close()
+
+def create_app():
+    """Returns the ingestion service's aiohttp Application"""
+    application = web.Application(middlewares=[json_only],
+        client_max_size=app.config.get("MAX_CONTENT_LENGTH", 1024 * 1024))
+    application.cleanup_ctx.append(database_pool)
+    application.router.add_post("/api/votes", vote_post)
+    application.router.add_post(r"/api/races/{race_id:\d+}/ballot", ballot_post)
+    return application
+
+def run(host="0.0.0.0", port=8081):
+    web.run_app(create_app(), host=host, port=port)
@@ -0,0 +1,86 @@
+### Dense in-memory ballots for tallying
+#
+# A race's votes are read once, as raw Core rows, into an int32
+# voters x candidates matrix.  Tallies are then numpy reductions over the
+# matrix, instead of ORM queries and Python dicts.
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy.sql import select
+
+from eLect import models
+from eLect import pairwise
+from eLect.database import session
+
+# Matrix value for candidates a voter didn't vote for
+UNRANKED = np.iinfo(np.int32).min
+
+# Rows fetched per round trip while loading
+FETCH_SIZE = 10000
+
+BallotMatrix = namedtuple("BallotMatrix",
+    ["candidate_ids", "candidate_index", "ballots"])
+
+
+def load_ballot_matrix(race_id, bind=None, shard=0, num_shards=1):
+    """Loads race_id's votes into a BallotMatrix: the sorted candidate ids,
+    a {cand_id: column} map, and an int32 voters x candidates matrix of vote
+    values, with UNRANKED where a voter didn't vote for a candidate.
+    With num_shards > 1, only voters whose user_id % num_shards == shard are
+    loaded.  bind defaults to the shared session"""
+    if bind is None:
+        # Core statements don't autoflush like session.query() does
+        session.flush()
+        bind = session
+    candidate = models.Candidate.__table__
+    vote = models.Vote.__table__
+
+    candidate_ids = [cand_id for cand_id, in bind.execute(
+        select([candidate.c.id]).where(
+            candidate.c.race_id == race_id).order_by(candidate.c.id))]
+    if not candidate_ids:
+        return BallotMatrix([], {}, np.empty((0, 0), dtype=np.int32))
+
+    # race_id lets a partitioned vote table prune to the race's partition
+    votes = select([vote.c.user_id, vote.c.candidate_id, vote.c.value]).where(
+        vote.c.race_id == race_id,
+        vote.c.candidate_id.in_(candidate_ids))
+    if num_shards > 1:
+        votes = votes.where(vote.c.user_id % num_shards == shard)
+    result = bind.execute(votes.execution_options(stream_results=True))
+    chunks = []
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int32))
+    votes = np.concatenate(chunks) if chunks else np.empty((0, 3), dtype=np.int32)
+
+    # Voter rows in user id order, candidate columns in candidate id order
+    user_ids, voter_rows = np.unique(votes[:, 0], return_inverse=True)
+    cand_columns = np.searchsorted(np.array(candidate_ids, dtype=np.int32), votes[:, 1])
+
+    ballots = np.full((len(user_ids), len(candidate_ids)), UNRANKED, dtype=np.int32)
+    ballots[voter_rows, cand_columns] = votes[:, 2]
+    return BallotMatrix(candidate_ids, pairwise.candidate_index(candidate_ids), ballots)
+
+def partial_pairwise_counts(race_id, bind=None, shard=0, num_shards=1):
+    """Counts pairwise preferences for one shard of a race's voters.  Returns
+    a mergeable (candidate_ids, C x C counts) partial, see
+    pairwise.merge_partials()"""
+    ballot_matrix = load_ballot_matrix(race_id, bind, shard, num_shards)
+    unique_ballots, multiplicities = pairwise.compress_ballots(ballot_matrix.ballots)
+    counts = pairwise.pairwise_from_ballots(unique_ballots, UNRANKED, multiplicities)
+    return ballot_matrix.candidate_ids, counts
+
+def ballot_stats(race_id):
+    """Diagnostic counts of the ballots cast in race_id: voters, and unique
+    ballots after compress_ballots()"""
+    ballot_matrix = load_ballot_matrix(race_id)
+    unique_ballots, multiplicities = pairwise.compress_ballots(ballot_matrix.ballots)
+    stats = {
+    "race_id": race_id,
+    "num_ballots": int(ballot_matrix.ballots.shape[0]),
+    "num_unique_ballots": int(unique_ballots.shape[0]),
+    }
+    return stats
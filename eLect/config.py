@@ -25,6 +25,65 @@ class DevelopmentConfig(object):
     # RequestEntityTooLarge exception
     MAX_CONTENT_LENGTH = 1 * 1024 * 1024
     DEBUG = True
+    # Schulze strongest path engine: "matrix" (numpy) or "dict" (reference)
+    SCHULZE_PATH_ENGINE = "matrix"
+    # Schulze pairwise preference builder: "stream" (single pass), "join" (SQL),
+    # "database" (elect_pairwise_counts() function in PostgreSQL),
+    # "persisted" (pairwise_count table kept up to date by the vote API) or
+    # "matrix" (numpy reduction over the race's ballot matrix) or
+    # "sharded" (partial matrices per voter shard, summed)
+    SCHULZE_PAIR_BUILDER = "stream"
+    # WTA / Proportional vote sums: "rollup" (candidate_tally), "votes" or "matrix"
+    VOTE_SUM_SOURCE = "rollup"
+    # Worker processes for election-wide tallies (None = one per CPU)
+    TALLY_WORKERS = None
+    # Voter shards (user_id % PAIRWISE_SHARDS) counted per database by the
+    # "sharded" builder (None = one per CPU)
+    PAIRWISE_SHARDS = None
+    # Threads per process querying those shards, each holding a pooled
+    # connection while it counts
+    PAIRWISE_SHARD_THREADS = 4
+    # Extra databases holding disjoint sets of voters, merged into "sharded"
+    # tallies along with DATABASE_URI
+    VOTE_SHARD_DATABASE_URIS = []
+    # Directory of the local vote journals, shared by the app's processes.
+    # When set, POST /api/votes journals votes and answers 202 with a
+    # receipt (see journal.py)
+    VOTE_JOURNAL_DIR = None
+    # Journal group commit window, flush interval (seconds) and segment size
+    VOTE_JOURNAL_GROUP_COMMIT_MS = 5
+    VOTE_JOURNAL_FLUSH_INTERVAL = 1.0
+    VOTE_JOURNAL_SEGMENT_VOTES = 10000
+    # Seconds the receipts of rejected journaled votes are kept for
+    VOTE_JOURNAL_RECEIPT_TTL = 3600
+    # Rows per page on list endpoints paged with limit or after, and the
+    # most a client may ask for.  Requests without either get every row
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Rows fetched and sent per chunk by streaming vote exports
+    STREAM_CHUNK_ROWS = 1000
+    # Connection pool: persistent connections, extra connections allowed
+    # under load, seconds to wait for one, seconds before a connection is
+    # replaced (-1 = never), and whether to test connections on checkout
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    # Create the vote table LIST partitioned by race_id, one partition per
+    # race, so tallies prune to one race and deleting a race drops its
+    # partition.  Only applies when the vote table is created
+    VOTE_PARTITION_BY_RACE = False
+    # Read replicas for GET requests, skipped while more than
+    # REPLICA_MAX_LAG_SECONDS behind the primary.  Lag is measured at most
+    # every REPLICA_LAG_CHECK_INTERVAL seconds
+    REPLICA_DATABASE_URIS = cfg_params.get("replica_database_uris", [])
+    REPLICA_MAX_LAG_SECONDS = 5.0
+    REPLICA_LAG_CHECK_INTERVAL = 1.0
+    # Connections held by the asyncio vote ingestion service (see
+    # async_ingest.py), shared by all of its in-flight requests
+    ASYNC_INGEST_POOL_MIN_SIZE = 2
+    ASYNC_INGEST_POOL_SIZE = 10
 
 
 class TestingConfig(object):
@@ -49,3 +108,62 @@ class TestingConfig(object):
     ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
     MAX_CONTENT_LENGTH = 1 * 1024 * 1024
     DEBUG = True
+    # Schulze strongest path engine: "matrix" (numpy) or "dict" (reference)
+    SCHULZE_PATH_ENGINE = "matrix"
+    # Schulze pairwise preference builder: "stream" (single pass), "join" (SQL),
+    # "database" (elect_pairwise_counts() function in PostgreSQL),
+    # "persisted" (pairwise_count table kept up to date by the vote API) or
+    # "matrix" (numpy reduction over the race's ballot matrix) or
+    # "sharded" (partial matrices per voter shard, summed)
+    SCHULZE_PAIR_BUILDER = "stream"
+    # WTA / Proportional vote sums: "rollup" (candidate_tally), "votes" or "matrix"
+    VOTE_SUM_SOURCE = "rollup"
+    # Worker processes for election-wide tallies (None = one per CPU)
+    TALLY_WORKERS = None
+    # Voter shards (user_id % PAIRWISE_SHARDS) counted per database by the
+    # "sharded" builder (None = one per CPU)
+    PAIRWISE_SHARDS = None
+    # Threads per process querying those shards, each holding a pooled
+    # connection while it counts
+    PAIRWISE_SHARD_THREADS = 4
+    # Extra databases holding disjoint sets of voters, merged into "sharded"
+    # tallies along with DATABASE_URI
+    VOTE_SHARD_DATABASE_URIS = []
+    # Directory of the local vote journals, shared by the app's processes.
+    # When set, POST /api/votes journals votes and answers 202 with a
+    # receipt (see journal.py)
+    VOTE_JOURNAL_DIR = None
+    # Journal group commit window, flush interval (seconds) and segment size
+    VOTE_JOURNAL_GROUP_COMMIT_MS = 5
+    VOTE_JOURNAL_FLUSH_INTERVAL = 1.0
+    VOTE_JOURNAL_SEGMENT_VOTES = 10000
+    # Seconds the receipts of rejected journaled votes are kept for
+    VOTE_JOURNAL_RECEIPT_TTL = 3600
+    # Rows per page on list endpoints paged with limit or after, and the
+    # most a client may ask for.  Requests without either get every row
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # Rows fetched and sent per chunk by streaming vote exports
+    STREAM_CHUNK_ROWS = 1000
+    # Connection pool: persistent connections, extra connections allowed
+    # under load, seconds to wait for one, seconds before a connection is
+    # replaced (-1 = never), and whether to test connections on checkout
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    # Create the vote table LIST partitioned by race_id, one partition per
+    # race, so tallies prune to one race and deleting a race drops its
+    # partition.  Only applies when the vote table is created
+    VOTE_PARTITION_BY_RACE = False
+    # Read replicas for GET requests, skipped while more than
+    # REPLICA_MAX_LAG_SECONDS behind the primary.  Lag is measured at most
+    # every REPLICA_LAG_CHECK_INTERVAL seconds
+    REPLICA_DATABASE_URIS = cfg_params.get("replica_database_uris", [])
+    REPLICA_MAX_LAG_SECONDS = 5.0
+    REPLICA_LAG_CHECK_INTERVAL = 1.0
+    # Connections held by the asyncio vote ingestion service (see
+    # async_ingest.py), shared by all of its in-flight requests
+    ASYNC_INGEST_POOL_MIN_SIZE = 2
+    ASYNC_INGEST_POOL_SIZE = 10
@@ -25,3 +25,5 @@ class NoWinners(Exception):
     pass
 class TiedResults(Exception):
     pass
+class JournalInUse(Exception):
+    pass
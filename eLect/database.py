@@ -1,10 +1,229 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import threading
+import time
+
+from flask import request
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.orm import sessionmaker, scoped_session, Session as BaseSession
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 
 from eLect.main import app
 
-engine = create_engine(app.config["DATABASE_URI"])
+
+class CheckoutStats(object):
+    """Running totals of the time spent waiting for pool connections"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def as_dictionary(self):
+        with self._lock:
+            stats = {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_seconds_total": self.wait_total,
+            "wait_seconds_max": self.wait_max,
+            "wait_seconds_mean": self.wait_total / self.checkouts if self.checkouts else 0.0,
+            }
+        return stats
+
+# Kept outside the pool, which engine.dispose() replaces
+checkout_stats = CheckoutStats()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits for a
+    connection, including the time taken to open new ones"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        checkout_stats.record(time.perf_counter() - start)
+        return connection
+
+
+def create_pooled_engine(uri, poolclass=QueuePool):
+    """Returns an engine for uri, pooled as the DB_POOL_* config says"""
+    return create_engine(uri,
+        poolclass=poolclass,
+        pool_size=app.config.get("DB_POOL_SIZE", 5),
+        max_overflow=app.config.get("DB_MAX_OVERFLOW", 10),
+        pool_timeout=app.config.get("DB_POOL_TIMEOUT", 30),
+        pool_recycle=app.config.get("DB_POOL_RECYCLE", -1),
+        pool_pre_ping=app.config.get("DB_POOL_PRE_PING", False))
+
+engine = create_pooled_engine(app.config["DATABASE_URI"], TimedQueuePool)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+
+
+# Replication lag of a replica, in seconds.  0 when it is streaming from
+# the primary and has replayed all the WAL it received, as replay
+# timestamps stop moving on an idle primary, and for a server that isn't a
+# replica at all.  NULL, so unavailable, when the replica has no streaming
+# WAL receiver: having replayed everything it received says nothing about
+# how far behind it is then
+replica_lag_statement = text("""
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (
+        SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class ReplicaPool(object):
+    """Read replicas, picked in turn from those within max_lag seconds of
+    the primary.  Each replica's lag is measured at most once per
+    check_interval seconds; a replica that can't be reached, or isn't
+    streaming from the primary, counts as lagging until its next check"""
+    def __init__(self, uris, max_lag=5.0, check_interval=1.0):
+        self.engines = [create_pooled_engine(uri) for uri in uris]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._lags = [None] * len(self.engines)
+        self._checked = [None] * len(self.engines)
+        self._next = 0
+
+    def lag(self, position):
+        """Returns the replica's last measured lag, measuring it again if
+        the measurement is stale.  None if it couldn't be measured"""
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked[position]
+            if checked is not None and now - checked < self.check_interval:
+                return self._lags[position]
+            # Other threads keep the old measurement meanwhile
+            self._checked[position] = now
+        try:
+            with self.engines[position].connect() as connection:
+                lag = connection.execute(replica_lag_statement).scalar()
+            lag = float(lag) if lag is not None else None
+        except Exception:
+            lag = None
+        with self._lock:
+            self._lags[position] = lag
+        return lag
+
+    def choose(self):
+        """Returns the next replica engine within max_lag, or None to read
+        from the primary"""
+        for i in range(len(self.engines)):
+            with self._lock:
+                position = self._next
+                self._next = (self._next + 1) % len(self.engines)
+            lag = self.lag(position)
+            if lag is not None and lag <= self.max_lag:
+                return self.engines[position]
+        return None
+
+    def status(self):
+        return [{"replica": position, "lag_seconds": self._lags[position]}
+            for position in range(len(self.engines))]
+
+replicas = ReplicaPool(app.config.get("REPLICA_DATABASE_URIS", []),
+    app.config.get("REPLICA_MAX_LAG_SECONDS", 5.0),
+    app.config.get("REPLICA_LAG_CHECK_INTERVAL", 1.0))
+
+
+class RoutingSession(BaseSession):
+    """Session that sends plain SELECTs to the read engine in
+    info["read_engine"], when one is set.  Bulk updates and deletes, text
+    statements and connection() always use the primary, and so does
+    everything after the session first writes, see use_primary()"""
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        read_engine = self.info.get("read_engine")
+        if read_engine is not None and getattr(clause, "is_select", False):
+            return read_engine
+        return super(RoutingSession, self).get_bind(mapper, clause=clause, **kwargs)
+
+Session = sessionmaker(bind=engine, class_=RoutingSession)
+# One session per thread, so each request thread gets its own
+session = scoped_session(Session)
+
+def read_engine():
+    """Returns the engine the current request reads from"""
+    return session.info.get("read_engine") or engine
+
+def use_primary(db_session=session):
+    """Sends the rest of a request's reads to the primary, for requests
+    that write what they read"""
+    db_session.info.pop("read_engine", None)
+
+@event.listens_for(Session, "before_flush")
+def flush_to_primary(db_session, flush_context, instances):
+    """A session that writes reads from the primary from then on, so it
+    sees its own writes"""
+    use_primary(db_session)
+
+
+# Cookie holding the time of a client's last write
+LAST_WRITE_COOKIE = "elect_last_write"
+
+@app.before_request
+def route_reads():
+    """Sends a GET request's reads to a replica, unless the client wrote
+    within REPLICA_MAX_LAG_SECONDS and so might not see its write there"""
+    if request.method != "GET" or not replicas.engines:
+        return
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        last_write = 0
+    if time.time() - last_write <= replicas.max_lag:
+        return
+    session.info["read_engine"] = replicas.choose()
+
+@app.after_request
+def mark_write(response):
+    """Records successful writes in a cookie, see route_reads()"""
+    if replicas.engines and request.method not in ("GET", "HEAD", "OPTIONS") \
+            and response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, str(time.time()),
+            max_age=int(replicas.max_lag) + 1, httponly=True)
+    return response
+
+@app.teardown_request
+def reset_reads(exception=None):
+    session.info.pop("read_engine", None)
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    """Ends the request's session, returning its connection to the pool.
+    A request that failed has its transaction rolled back, so the next one
+    doesn't inherit it"""
+    if exception is not None:
+        session.rollback()
+    session.remove()
+
+def pool_status():
+    """Returns the engine pool's current usage and its checkout wait stats"""
+    pool = engine.pool
+    status = {
+    "size": pool.size(),
+    "checked_out": pool.checkedout(),
+    "overflow": pool.overflow(),
+    }
+    status.update(checkout_stats.as_dictionary())
+    status["replicas"] = replicas.status()
+    return status
@@ -3,17 +3,17 @@ from functools import wraps
 
 from flask import request, Response
 
-def accept(mimetype):
+def accept(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 406 Not Acceptable if the client won't accept 
-        a certain mimetype
+        any of the given mimetypes
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if "application/json" in request.accept_mimetypes:
+            if any(mimetype in request.accept_mimetypes for mimetype in mimetypes):
                 return func(*args, **kwargs)
-            message = "Request must accept {} data".format(mimetype)
+            message = "Request must accept {} data".format(" or ".join(mimetypes))
             data = json.dumps({"message": message})
             return Response(data, 406, mimetype="application/json")
         return wrapper
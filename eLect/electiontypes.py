@@ -1,5 +1,8 @@
 import os
 import json
+from abc import ABC, abstractmethod
+from collections import Counter
+from itertools import groupby
 from operator import itemgetter
 
 from sqlalchemy import text
@@ -8,57 +11,124 @@ from sqlalchemy.orm import aliased, with_polymorphic
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from eLect.main import app
 from eLect.custom_exceptions import *
-from eLect.utils import num_votes_cast
+from eLect import pairwise
+from eLect import ballots
+from eLect.utils import num_votes_cast, check_race
 from eLect import models
 from eLect.models import ElectionType
 from eLect.database import Base, engine, session
 
 
+def candidate_vote_sums(race_id, source=None):
+    """Returns a list of (vote sum, cand_id) tuples for every candidate in
+    race_id that received votes.  Read from the candidate_tally rollup,
+    summed over the vote table with source="votes", or reduced over the
+    race's ballot matrix with source="matrix".  Defaults to the
+    VOTE_SUM_SOURCE config value"""
+    if source is None:
+        source = app.config.get("VOTE_SUM_SOURCE", "rollup")
+
+    if source == "rollup":
+        return session.query(
+            models.CandidateTally.vote_sum,
+            models.CandidateTally.candidate_id).filter(
+            models.CandidateTally.race_id == race_id,
+            models.CandidateTally.vote_count > 0).all()
+    elif source == "votes":
+        return session.query(
+            func.sum(models.Vote.value)).add_column(
+            models.Vote.candidate_id).filter(
+            models.Vote.race_id == race_id).group_by(
+            models.Vote.candidate_id).all()
+    elif source == "matrix":
+        ballot_matrix = ballots.load_ballot_matrix(race_id)
+        sums, counts = pairwise.ballot_sums(ballot_matrix.ballots, ballots.UNRANKED)
+        return [(int(vote_sum), cand_id) for cand_id, vote_sum, vote_count in
+            zip(ballot_matrix.candidate_ids, sums, counts) if vote_count > 0]
+    raise ValueError("Unknown vote sum source {}".format(source))
+
+def race_vote_total(race_id, source=None):
+    """Returns the sum of all vote values cast in race_id, summed from the
+    candidate_tally rollup or the vote table (see candidate_vote_sums())"""
+    if source is None:
+        source = app.config.get("VOTE_SUM_SOURCE", "rollup")
+
+    if source == "rollup":
+        return session.query(
+            func.sum(models.CandidateTally.vote_sum)).filter(
+            models.CandidateTally.race_id == race_id,
+            models.CandidateTally.vote_count > 0).scalar()
+    elif source == "votes":
+        return session.query(
+            func.sum(models.Vote.value)).filter(
+            models.Vote.race_id == race_id)[0][0]
+    elif source == "matrix":
+        ballot_matrix = ballots.load_ballot_matrix(race_id)
+        sums, counts = pairwise.ballot_sums(ballot_matrix.ballots, ballots.UNRANKED)
+        return int(sums.sum()) if counts.any() else None
+    raise ValueError("Unknown vote sum source {}".format(source))
+
+
+### Tally engines
+# Stateless tally algorithms, one shared instance per election_type enum
+# value.  Requests look engines up in TALLY_ENGINES; the ElectionType ORM
+# rows only carry each election type's title and descriptions.
+TALLY_ENGINES = {}
+
+def register_tally_engine(election_type):
+    """Class decorator registering a single, shared instance of a tally
+    engine class under an election_type enum value"""
+    def decorator(cls):
+        cls.election_type = election_type
+        TALLY_ENGINES[election_type] = cls()
+        return cls
+    return decorator
+
+def get_tally_engine(election_type):
+    """Returns the tally engine registered for election_type, or None"""
+    return TALLY_ENGINES.get(election_type)
+
+
+class TallyEngine(ABC):
+    """Base tally engine.  Subclasses implement tally_race() and
+    check_results(), and can't be instantiated without them"""
+    election_type = None
+
+    def check_race(self, race_id):
+        """Checks race conditions before attempting to tally votes.
+        Failed test returns Exception"""
+        check_race(race_id)
+
+    @abstractmethod
+    def tally_race(self, race_id):
+        """Tallies the votes for race_id, returning its results dict"""
+
+    @abstractmethod
+    def check_results(self, results):
+        """Raises the matching exception for results without a winner"""
 
-class WinnerTakeAll(ElectionType):
-    """ Winner-Take-All elections class """
-    def __init__(self):
-        # super().__init__()
-        self.election_type = "WTA"
-        self.title = "Winner-Take-All"
-        self.description_short = "Voter may select one candidate,"\
-        " and one winner is declared based upon a simple majority."
-        self.description_long = "Good for up/down single vote issues and proposals,"\
-        " and races with only 2 candidates.  Possibility of ties and other problems "\
-        "makes this option less attractive than other options, despite its popularity."
 
-    @hybrid_method
+@register_tally_engine("WTA")
+class WinnerTakeAllEngine(TallyEngine):
+    """ Winner-Take-All tally engine """
     def tally_race(self, race_id):
         """ Tallies the votes for a race. Returns a dict of {cand.ids:score} """
 
         # Checks race conditions before attempts at tallying
         self.check_race(race_id)
 
-        # # The easy-to-read way of doing this
         try:
-            results = session.query(
-                func.sum(models.Vote.value)).add_column(
-                models.Vote.candidate_id).filter(
-                models.Vote.candidate.has(race_id = race_id)).group_by(
-                models.Vote.candidate_id).all()
+            results = candidate_vote_sums(race_id)
         except Exception as e:
             # TODO: Find better way to Except. what to return here?
             return None
 
-        # # The supposedly faster way of doing this
-        # results = session.query(
-        #     func.count(models.Vote.value)).add_column(
-        #     models.Vote.candidate_id).join(
-        #     models.Vote.candidate, aliased = True).filter_by(
-        #     race_id = race_id).group_by(
-        #     models.Vote.candidate_id).all()
         if len(results) > 1 :
             highscore = max(results, key=itemgetter(0))[0]
             highscore_winners = {cand:score for score, cand in results if score == highscore}
 
         return highscore_winners
 
-    @hybrid_method
     def check_results(self, results):
         """ Checks the results returned by the WTA tally_race() method """
         if not results:
@@ -69,46 +139,20 @@ class WinnerTakeAll(ElectionType):
             raise TiedResults("Election tied between cand_ids {}".format(
                 list(results.keys())))
 
-    @staticmethod
-    def fetch():
-        """Bill, what the hell am I doing here?"""
-        query = session.query(models.ElectionType).get(1)
-        return WinnerTakeAll()
 
-class Proportional(ElectionType):
-    """ Proportional elections class. Returns a dict of cand.ids:score"""
-    def __init__(self):
-        # super(Proportional, self).__init__()
-        self.election_type = "Proportional"
-        self.title = "Proportional"
-        self.description_short = "Voter may choose one candidate, "\
-        "and all candidates are tallied proportinally to each other as "\
-        "a percentage."
-        self.description_long = "Good for Parliamentary-style elections, "\
-        "or in races where having a single winner is less important than having "\
-        "all candidates ranked according to their percentage of the overall vote."
-
-    @hybrid_method
+@register_tally_engine("Proportional")
+class ProportionalEngine(TallyEngine):
+    """ Proportional tally engine. Returns a dict of cand.ids:score"""
     def tally_race(self, race_id):
         """ Tallies the votes for race_id with election_type = "Proportional" """
 
-        # # The easy-to-read way of doing this
-        # SEE WTA for a quicker method (commented out)
-        results = session.query(
-            func.sum(models.Vote.value)).add_column(
-            models.Vote.candidate_id).filter(
-            models.Vote.candidate.has(race_id = race_id)).group_by(
-            models.Vote.candidate_id).all()
-
-        total_scores = session.query(
-            func.sum(models.Vote.value)).filter(
-            models.Vote.candidate.has(race_id = race_id))[0][0]
+        results = candidate_vote_sums(race_id)
+        total_scores = race_vote_total(race_id)
 
         calculated_results = {cand: score/total_scores for score, cand in results}
 
         return calculated_results
 
-    @hybrid_method
     def check_results(self, results):
         """ Checks the results returned by the Proportional tally_race() method """
         if not results:
@@ -117,26 +161,112 @@ class Proportional(ElectionType):
         #     raise NoWinners("No winners found")
 
 
-class Schulze(ElectionType):
-    """ Schulze elections class """
-    def __init__(self):
-        # super(Schulze, self).__init__()
-        self.election_type = "Schulze"
-        self.title = "Schulze (Condorcet)"
-        self.description_short = "Voter may rank ALL candidates in relation to each other." 
-        self.description_long = "Offers voters the most power for their vote. "\
-        "Ability to rank all candidates relative to each other allows voters to give "\
-        "higher preferences to their preferred candidates, without taking votes away "\
-        "from their 2nd, 3rd, etc. choices.  Fosters true multi-party systems, "\
-        "prevents ties and eliminates the need for recounts, among many other advantages.\n"\
-        "The best option for races with 3 or more candidates, that must end with a single winner."
+@register_tally_engine("Schulze")
+class SchulzeEngine(TallyEngine):
+    """ Schulze (Condorcet) tally engine """
+    # Every pair builder gen_pair_results() can pick, "join" being the reference
+    pair_builders = ("join", "stream", "database", "persisted", "matrix", "sharded")
 
-    # @hybrid_method
-    def gen_pair_results(self, race):
+    def gen_pair_results(self, race, pair_builder=None):
         """Method required by Schulze tally_race() that generates 
         dict of key:value pairs, defined as 
         (candA, CandB) tuple of unique canididate pairs from race:
-        # of voters who preferred candA over candB on each individual ballot """
+        # of voters who preferred candA over candB on each individual ballot.
+        Builder is picked by pair_builder, or the SCHULZE_PAIR_BUILDER config
+        value ("join", "stream", "database", "persisted", "matrix" or
+        "sharded").
+        All builders return the same dict """
+        if pair_builder is None:
+            pair_builder = app.config.get("SCHULZE_PAIR_BUILDER", "stream")
+        if pair_builder == "join":
+            return self.gen_pair_results_join(race)
+        elif pair_builder == "stream":
+            return self.gen_pair_results_stream(race)
+        elif pair_builder == "database":
+            return self.gen_pair_results_database(race)
+        elif pair_builder == "persisted":
+            return self.gen_pair_results_persisted(race)
+        elif pair_builder == "matrix":
+            return self.gen_pair_results_matrix(race)
+        elif pair_builder == "sharded":
+            return self.gen_pair_results_sharded(race)
+        raise ValueError("Unknown Schulze pair builder {}".format(pair_builder))
+
+    def gen_pair_results_stream(self, race):
+        """Builds pair results in a single pass over the race's votes.
+        (user_id, candidate_id, value) rows are streamed through a server-side
+        cursor ordered by user, and each ballot is assembled in memory.
+        Identical ballots are counted once, by their hashed (cand_id, value)
+        tuple, and their preferences are added to a C x C counter matrix
+        weighted by how many voters cast them"""
+        candidate_ids = sorted(candidate.id for candidate in race.candidates)
+        index = pairwise.candidate_index(candidate_ids)
+        counts = pairwise.empty_matrix(len(candidate_ids))
+
+        rows = session.query(
+            models.Vote.user_id,
+            models.Vote.candidate_id,
+            models.Vote.value).filter(
+                models.Vote.race_id == race.id,
+                models.Vote.candidate_id.in_(candidate_ids)).order_by(
+                models.Vote.user_id,
+                models.Vote.candidate_id).execution_options(
+                stream_results=True).yield_per(1000)
+
+        unique_ballots = Counter(
+            tuple((cand_id, value) for user_id, cand_id, value in ballot)
+            for user_id, ballot in groupby(rows, key=itemgetter(0)))
+        for ballot, multiplicity in unique_ballots.items():
+            pairwise.add_ballot(counts, index, ballot, multiplicity)
+
+        return pairwise.matrix_to_pair_dict(candidate_ids, counts)
+
+    def gen_pair_results_matrix(self, race):
+        """Builds pair results with vectorized comparisons over the race's
+        unique ballots (see ballots.py), weighted by their multiplicity"""
+        candidate_ids, counts = ballots.partial_pairwise_counts(race.id)
+        return pairwise.matrix_to_pair_dict(candidate_ids, counts)
+
+    def gen_pair_results_sharded(self, race):
+        """Builds pair results from partial matrices counted per voter shard
+        on a shared thread pool, across every configured vote database, then
+        summed (see parallel.py)"""
+        # parallel.py imports this module
+        from eLect.parallel import sharded_pairwise_counts
+        candidate_ids, counts = sharded_pairwise_counts(race.id)
+        return pairwise.matrix_to_pair_dict(candidate_ids, counts)
+
+    def gen_pair_results_database(self, race):
+        """Builds pair results inside PostgreSQL with the elect_pairwise_counts()
+        function (see models.py), so only the C x C counts cross the wire"""
+        # Raw SQL doesn't autoflush like session.query() does
+        session.flush()
+        cand_pair_results = session.execute(text(
+            "SELECT cand1_id, cand2_id, num_users_prefer "
+            "FROM elect_pairwise_counts(:race_id) "
+            "ORDER BY cand1_id, cand2_id"), {"race_id": race.id}).fetchall()
+
+        return {(cand1, cand2):num_users_prefer for \
+        cand1, cand2, num_users_prefer in cand_pair_results}
+
+    def gen_pair_results_persisted(self, race):
+        """Reads pair results from the race's pairwise_count rows, which the
+        vote write path keeps up to date, so no votes are rescanned"""
+        cand_pair_results = session.query(
+            models.PairwiseCount.cand1_id,
+            models.PairwiseCount.cand2_id,
+            models.PairwiseCount.num_users_prefer).filter(
+                models.PairwiseCount.race_id == race.id,
+                models.PairwiseCount.num_users_prefer > 0).order_by(
+                models.PairwiseCount.cand1_id,
+                models.PairwiseCount.cand2_id).all()
+
+        return {(cand1, cand2):num_users_prefer for \
+        cand1, cand2, num_users_prefer in cand_pair_results}
+
+    def gen_pair_results_join(self, race):
+        """Builds pair results by joining each candidate pair's votes per user
+        in SQL.  Quadratic in the number of candidates, kept as a reference"""
 
         pair_results = {}
         ### Original SELECT from previous version
@@ -170,6 +300,8 @@ class Schulze(ElectionType):
             vote2.value.label("vote_cand2_value")).filter(
                 models.Vote.user_id == models.User.id,
                 vote2.user_id == models.User.id,
+                models.Vote.race_id == race.id,
+                vote2.race_id == race.id,
                 models.Vote.candidate_id == cand_pairs.c.cand1_id,
                 vote2.candidate_id == cand_pairs.c.cand2_id,
                 ).subquery() 
@@ -187,37 +319,91 @@ class Schulze(ElectionType):
         cand1, cand2, num_users_prefer in cand_pair_results}
         return dict_cand_pair_results
 
-    @hybrid_method
-    def tally_race(self, race_id):
-        """ Tallies the votes for race_id with election_type = "Schulze" """
-        race = session.query(models.Race).get(race_id)
-        pair_results = self.gen_pair_results(race)
-
+    def gen_path_results(self, pair_results):
+        """Reference strongest path computation over the (cand1, cand2) dict
+        returned by gen_pair_results().  Kept selectable with
+        path_engine="dict" for equivalence testing against the matrix engine.
+        Candidates are those in the dict's pairs, and pairs missing from it,
+        like the builders' zero counts, count as 0.
+        Returns a (final_results, ranking) tuple"""
         path_results = {}
         final_results = {}
 
-        candidate_ids = [candidate for candidate,cand2 in pair_results.keys()]
-        for cand1,cand2 in pair_results.keys():
-            if pair_results[(cand1,cand2)] > pair_results[(cand2,cand1)]:
-                path_results[(cand1,cand2)] = pair_results[(cand1,cand2)]
-            else:
-                path_results[(cand1,cand2)] = 0
-        for cand1,cand2 in pair_results.keys():
-            for cand3 in candidate_ids:
-                if (cand1 != cand3) and (cand2 != cand3):
-                    path_results[(cand2,cand3)] = max(
-                        path_results[(cand2,cand3)],
-                        min(path_results[(cand2,cand1)],
-                        path_results[(cand1,cand3)]))
+        candidate_ids = sorted(set(cand for pair in pair_results.keys()
+            for cand in pair))
+        for cand1 in candidate_ids:
+            for cand2 in candidate_ids:
+                if cand1 == cand2:
+                    continue
+                preferred = pair_results.get((cand1,cand2), 0)
+                if preferred > pair_results.get((cand2,cand1), 0):
+                    path_results[(cand1,cand2)] = preferred
+                else:
+                    path_results[(cand1,cand2)] = 0
+        for cand1 in candidate_ids:
+            for cand2 in candidate_ids:
+                for cand3 in candidate_ids:
+                    if len(set([cand1, cand2, cand3])) == 3:
+                        path_results[(cand2,cand3)] = max(
+                            path_results[(cand2,cand3)],
+                            min(path_results[(cand2,cand1)],
+                            path_results[(cand1,cand3)]))
         for cand in candidate_ids:
             final_results[cand] = True
-        for cand1,cand2 in pair_results.keys():
+        for cand1, cand2 in path_results.keys():
             if path_results[(cand2,cand1)] > path_results[(cand1,cand2)]:
                 final_results[cand1] = False
 
+        # Candidates ranked by the number of others they beat by strongest path
+        wins = {cand: 0 for cand in candidate_ids}
+        for cand1, cand2 in path_results.keys():
+            if path_results[(cand1,cand2)] > path_results[(cand2,cand1)]:
+                wins[cand1] += 1
+        ranking = sorted(wins.keys(), key=lambda cand: (-wins[cand], cand))
+
+        return final_results, ranking
+
+    def gen_path_matrix(self, pair_results, candidate_ids=None):
+        """Strongest path computation as numpy broadcasts over a dense
+        C x C matrix. Candidates without any pairwise preference count as 0
+        rather than raising a KeyError. Returns a (final_results, ranking) tuple"""
+        candidate_ids, matrix = pairwise.pair_dict_to_matrix(
+            pair_results, candidate_ids)
+        paths = pairwise.widest_paths(matrix)
+        return (pairwise.schulze_winners(candidate_ids, paths),
+            pairwise.schulze_ranking(candidate_ids, paths))
+
+    def tally_paths(self, race, path_engine=None, pair_builder=None):
+        """Generates pair results for race, and runs the selected strongest
+        path engine ("matrix" or "dict") over them.  Defaults to the
+        SCHULZE_PATH_ENGINE config value"""
+        if path_engine is None:
+            path_engine = app.config.get("SCHULZE_PATH_ENGINE", "matrix")
+        if path_engine not in ("dict", "matrix"):
+            raise ValueError("Unknown Schulze path engine {}".format(path_engine))
+        pair_results = self.gen_pair_results(race, pair_builder)
+
+        # Both engines only rank the candidates in pair_results.  A candidate
+        # nobody prefers or is preferred to would otherwise be unbeaten, and
+        # tie with the real winner
+        if not pair_results:
+            return {}, []
+        if path_engine == "dict":
+            return self.gen_path_results(pair_results)
+        return self.gen_path_matrix(pair_results)
+
+    def tally_race(self, race_id, path_engine=None, pair_builder=None):
+        """ Tallies the votes for race_id with election_type = "Schulze" """
+        race = session.query(models.Race).get(race_id)
+        final_results, ranking = self.tally_paths(race, path_engine, pair_builder)
         return final_results
 
-    @hybrid_method
+    def rank_race(self, race_id, path_engine=None, pair_builder=None):
+        """ Returns the full Schulze ranking of candidate ids for race_id, best first """
+        race = session.query(models.Race).get(race_id)
+        final_results, ranking = self.tally_paths(race, path_engine, pair_builder)
+        return ranking
+
     def check_results(self, results):
         num_true = [(cand, value) for cand, value in results.items()\
         if value==True]
@@ -227,3 +413,77 @@ class Schulze(ElectionType):
         elif len(num_true) > 1:
             raise TiedResults("Results are tied between candidates: ",
                 [cand for cand,value in num_true])
+
+
+### Election type metadata rows
+class EngineMethods(object):
+    """Forwards the TallyEngine methods on ElectionType rows to the engine
+    registered under the class's engine_type.  Engine specific methods,
+    like Schulze's rank_race(), are reached through engine"""
+    engine_type = None
+
+    @property
+    def engine(self):
+        return TALLY_ENGINES[type(self).engine_type]
+
+    def check_race(self, race_id):
+        return self.engine.check_race(race_id)
+
+    def tally_race(self, race_id, **kwargs):
+        return self.engine.tally_race(race_id, **kwargs)
+
+    def check_results(self, results):
+        return self.engine.check_results(results)
+
+
+class WinnerTakeAll(EngineMethods, ElectionType):
+    """ Winner-Take-All elections class """
+    engine_type = "WTA"
+
+    def __init__(self):
+        # super().__init__()
+        self.election_type = "WTA"
+        self.title = "Winner-Take-All"
+        self.description_short = "Voter may select one candidate,"\
+        " and one winner is declared based upon a simple majority."
+        self.description_long = "Good for up/down single vote issues and proposals,"\
+        " and races with only 2 candidates.  Possibility of ties and other problems "\
+        "makes this option less attractive than other options, despite its popularity."
+
+    @staticmethod
+    def fetch():
+        """Bill, what the hell am I doing here?"""
+        query = session.query(models.ElectionType).get(1)
+        return WinnerTakeAll()
+
+class Proportional(EngineMethods, ElectionType):
+    """ Proportional elections class. Returns a dict of cand.ids:score"""
+    engine_type = "Proportional"
+
+    def __init__(self):
+        # super(Proportional, self).__init__()
+        self.election_type = "Proportional"
+        self.title = "Proportional"
+        self.description_short = "Voter may choose one candidate, "\
+        "and all candidates are tallied proportinally to each other as "\
+        "a percentage."
+        self.description_long = "Good for Parliamentary-style elections, "\
+        "or in races where having a single winner is less important than having "\
+        "all candidates ranked according to their percentage of the overall vote."
+
+
+class Schulze(EngineMethods, ElectionType):
+    """ Schulze elections class """
+    engine_type = "Schulze"
+
+    def __init__(self):
+        # super(Schulze, self).__init__()
+        self.election_type = "Schulze"
+        self.title = "Schulze (Condorcet)"
+        self.description_short = "Voter may rank ALL candidates in relation to each other." 
+        self.description_long = "Offers voters the most power for their vote. "\
+        "Ability to rank all candidates relative to each other allows voters to give "\
+        "higher preferences to their preferred candidates, without taking votes away "\
+        "from their 2nd, 3rd, etc. choices.  Fosters true multi-party systems, "\
+        "prevents ties and eliminates the need for recounts, among many other advantages.\n"\
+        "The best option for races with 3 or more candidates, that must end with a single winner."
@@ -0,0 +1,170 @@
+### Bulk vote import with PostgreSQL COPY
+#
+# Votes are streamed from a CSV or NDJSON file, checked against in-memory
+# maps of the existing candidates and users, and written with
+# COPY FROM STDIN in chunks.  This skips the ORM entirely, including
+# Vote.__init__'s candidate lookup, and each vote's race_id comes from the
+# candidate map.
+import csv
+import datetime
+import io
+import json
+import time
+
+from sqlalchemy import text
+from sqlalchemy.sql import select
+
+from eLect import models
+from eLect import utils
+from eLect.database import session
+
+# Votes buffered per COPY
+CHUNK_ROWS = 100000
+
+VOTE_FIELDS = ["user_id", "candidate_id", "value"]
+
+
+def read_votes(vote_file, file_format):
+    """Yields (line_number, raw line, [user_id, candidate_id, value]) from a
+    CSV file with a header row, or from an NDJSON file of vote objects.
+    Unparseable lines are yielded with None for their fields"""
+    if file_format == "csv":
+        reader = csv.reader(vote_file)
+        header = next(reader)
+        columns = [header.index(field) for field in VOTE_FIELDS]
+        for row in reader:
+            try:
+                yield reader.line_num, ",".join(row), [row[column] for column in columns]
+            except IndexError:
+                yield reader.line_num, ",".join(row), None
+    elif file_format == "ndjson":
+        for line_number, line in enumerate(vote_file, 1):
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+            try:
+                vote = json.loads(line)
+                yield line_number, line, [vote[field] for field in VOTE_FIELDS]
+            except (ValueError, KeyError, TypeError):
+                yield line_number, line, None
+    else:
+        raise ValueError("Unknown vote file format {}".format(file_format))
+
+def import_votes(path, file_format=None, rejects_path=None, chunk_rows=CHUNK_ROWS):
+    """Imports the votes in path, in a single transaction.  file_format is
+    "csv" or "ndjson", from the file extension by default.  Rejected lines
+    are written to rejects_path (path + ".rejects" by default) with their
+    reason.
+
+    The vote_tally and vote_ranked triggers are disabled for the load.
+    vote.ranked is set from each race's election type as the staged rows
+    are inserted, and the rollups and pairwise counts of every affected
+    race are rebuilt afterwards; the ALTER TABLE lock holds off concurrent
+    votes until the commit.
+    Returns a dict of import stats"""
+    if file_format is None:
+        file_format = "csv" if path.endswith(".csv") else "ndjson"
+    if rejects_path is None:
+        rejects_path = path + ".rejects"
+    start = time.perf_counter()
+
+    candidate = models.Candidate.__table__
+    user = models.User.__table__
+    candidate_races = dict(session.execute(
+        select([candidate.c.id, candidate.c.race_id])).fetchall())
+    user_ids = set(user_id for user_id, in session.execute(select([user.c.id])))
+
+    session.execute(text("ALTER TABLE vote DISABLE TRIGGER vote_tally"))
+    session.execute(text("ALTER TABLE vote DISABLE TRIGGER vote_ranked"))
+    # Rows are staged first, as COPY can't skip votes that clash with the
+    # vote table's unique indexes.  Staged rows take their vote ids from
+    # vote's sequence, to pick out the clashing lines afterwards
+    session.execute(text(
+        "CREATE TEMPORARY TABLE vote_import "
+        "(LIKE vote INCLUDING DEFAULTS, line_number integer) ON COMMIT DROP"))
+    # COPY runs on the session's own connection, inside its transaction
+    cursor = session.connection().connection.cursor()
+    start_date = datetime.datetime.utcnow().isoformat()
+
+    num_rows = 0
+    num_rejected = 0
+    race_ids = set()
+    buffer = []
+
+    def copy_buffer():
+        cursor.copy_expert(
+            "COPY vote_import (user_id, candidate_id, race_id, value, start_date, "
+            "line_number) FROM STDIN",
+            io.StringIO("".join(buffer)))
+        del buffer[:]
+
+    try:
+        with open(path, newline="") as vote_file, open(rejects_path, "w") as rejects:
+            for line_number, line, fields in read_votes(vote_file, file_format):
+                try:
+                    user_id, cand_id, value = (int(field) for field in fields)
+                except (TypeError, ValueError):
+                    reason = "unreadable vote"
+                else:
+                    race_id = candidate_races.get(cand_id)
+                    if cand_id not in candidate_races:
+                        reason = "unknown candidate {}".format(cand_id)
+                    elif race_id is None:
+                        reason = "candidate {} is not in a race".format(cand_id)
+                    elif user_id not in user_ids:
+                        reason = "unknown user {}".format(user_id)
+                    else:
+                        buffer.append("{}\t{}\t{}\t{}\t{}\t{}\n".format(
+                            user_id, cand_id, race_id, value, start_date, line_number))
+                        race_ids.add(race_id)
+                        num_rows += 1
+                        if len(buffer) >= chunk_rows:
+                            copy_buffer()
+                        continue
+                rejects.write("{}\t{}\t{}\n".format(line_number, reason, line))
+                num_rejected += 1
+            if buffer:
+                copy_buffer()
+
+            # Earlier lines win over later repeats of the same vote.  ranked
+            # is set here, as vote_ranked would, since the one-vote-per-race
+            # unique index depends on it
+            clashes = session.execute(text(
+                "WITH imported AS ("
+                "INSERT INTO vote (id, user_id, candidate_id, race_id, value, start_date, ranked) "
+                "SELECT vote_import.id, vote_import.user_id, vote_import.candidate_id, "
+                "vote_import.race_id, vote_import.value, vote_import.start_date, "
+                "COALESCE(CAST(race.election_type AS text) = ANY(CAST(:ranking_types AS text[])), false) "
+                "FROM vote_import JOIN race ON race.id = vote_import.race_id "
+                "ORDER BY vote_import.line_number "
+                "ON CONFLICT DO NOTHING RETURNING id) "
+                "SELECT line_number, user_id, candidate_id, value FROM vote_import "
+                "WHERE NOT EXISTS (SELECT 1 FROM imported WHERE imported.id = vote_import.id) "
+                "ORDER BY line_number"),
+                {"ranking_types": models.Race._ranking_types}).fetchall()
+            for line_number, user_id, cand_id, value in clashes:
+                rejects.write("{}\t{}\t{},{},{}\n".format(line_number,
+                    "repeat vote by user {}".format(user_id), user_id, cand_id, value))
+            num_rows -= len(clashes)
+            num_rejected += len(clashes)
+
+        session.execute(text("ALTER TABLE vote ENABLE TRIGGER vote_tally"))
+        session.execute(text("ALTER TABLE vote ENABLE TRIGGER vote_ranked"))
+        for race_id in sorted(race_ids):
+            utils.rebuild_vote_tallies(race_id)
+            utils.rebuild_pairwise_counts(race_id)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    seconds = time.perf_counter() - start
+    stats = {
+    "rows": num_rows,
+    "rejected": num_rejected,
+    "races": len(race_ids),
+    "seconds": seconds,
+    "rows_per_second": num_rows / seconds if seconds else 0,
+    "rejects_path": rejects_path,
+    }
+    return stats
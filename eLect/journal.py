@@ -0,0 +1,421 @@
+### Durable local vote journal
+#
+# With VOTE_JOURNAL_DIR set, POST /api/votes appends votes to a local
+# journal instead of committing each one to PostgreSQL.  A writer thread
+# group-commits the journal: votes arriving within VOTE_JOURNAL_GROUP_COMMIT_MS
+# of each other are written and fsync'd together, then acknowledged with a
+# receipt id.  A flusher thread moves closed journal segments into the vote
+# table, one statement per segment, and deletes each segment once that
+# statement has committed.  Segments left over from an earlier run are
+# flushed on start; votes that already reached the table are skipped, so
+# replays are idempotent.
+#
+# Each app process journals to its own numbered directory under
+# VOTE_JOURNAL_DIR, held with an exclusive flock for as long as the process
+# runs.  Receipt status is kept on disk: a receipt is pending while it is in
+# any process's segments, and rejected while it is in a ".rejected" file,
+# which are deleted after VOTE_JOURNAL_RECEIPT_TTL seconds.  So any process
+# can answer for any receipt.  Directories whose process is gone are
+# flushed by the other processes' flushers.
+import atexit
+import datetime
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+
+from eLect.main import app
+from eLect.database import Session
+from eLect.custom_exceptions import JournalInUse
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".journal"
+REJECTED_SUFFIX = ".rejected"
+LOCK_NAME = ".lock"
+
+# Takes the vote locks of a segment's users, in order, before flushing it
+lock_voters_statement = text("""
+SELECT pg_advisory_xact_lock(voter.user_id)
+FROM (SELECT DISTINCT unnest(CAST(:user_ids AS integer[])) AS user_id
+    ORDER BY 1) AS voter
+""")
+
+# Inserts a segment's votes, checked like cast_vote_statement in utils.py:
+# unknown users and candidates, closed elections and repeat votes are
+# skipped.  The ranked ballots touched get their pairwise deltas in the
+# same statement.  Returns the receipts of every journaled vote now in the
+# vote table, including votes flushed by an earlier, interrupted run.
+flush_statement = text("""
+WITH journal AS (
+    SELECT *
+    FROM unnest(CAST(:receipts AS text[]), CAST(:user_ids AS integer[]),
+        CAST(:candidate_ids AS integer[]), CAST(:vote_values AS integer[]),
+        CAST(:start_dates AS timestamp[])) WITH ORDINALITY
+        AS journal(receipt, user_id, candidate_id, value, start_date, position)
+), new_vote AS (
+    INSERT INTO vote (receipt, user_id, candidate_id, race_id, value, start_date)
+    SELECT journal.receipt, journal.user_id, candidate.id, candidate.race_id,
+        journal.value, journal.start_date
+    FROM journal
+    JOIN "user" ON "user".id = journal.user_id
+    JOIN candidate ON candidate.id = journal.candidate_id
+    JOIN race ON race.id = candidate.race_id
+    JOIN election ON election.id = race.election_id
+    WHERE election.elect_open
+    ORDER BY journal.position
+    ON CONFLICT DO NOTHING
+    RETURNING vote.receipt, vote.user_id, vote.race_id, vote.candidate_id,
+        vote.value, vote.ranked
+), ballot AS (
+    SELECT vote.race_id, vote.user_id, vote.candidate_id, vote.value,
+        false AS is_new
+    FROM vote
+    JOIN (SELECT DISTINCT race_id, user_id FROM new_vote WHERE ranked) AS voter
+        ON vote.race_id = voter.race_id AND vote.user_id = voter.user_id
+    UNION ALL
+    SELECT race_id, user_id, candidate_id, value, true
+    FROM new_vote WHERE ranked
+), pair_delta AS (
+    SELECT better.race_id, better.candidate_id AS cand1_id,
+        worse.candidate_id AS cand2_id, count(*) AS num_users_prefer
+    FROM ballot AS better
+    JOIN ballot AS worse ON worse.race_id = better.race_id
+        AND worse.user_id = better.user_id AND better.value > worse.value
+    WHERE better.is_new OR worse.is_new
+    GROUP BY 1, 2, 3
+), pair_upsert AS (
+    INSERT INTO pairwise_count (race_id, cand1_id, cand2_id, num_users_prefer)
+    SELECT race_id, cand1_id, cand2_id, num_users_prefer FROM pair_delta
+    ON CONFLICT (race_id, cand1_id, cand2_id) DO UPDATE
+    SET num_users_prefer = pairwise_count.num_users_prefer + EXCLUDED.num_users_prefer
+)
+SELECT receipt FROM new_vote
+UNION
+SELECT receipt FROM vote WHERE receipt = ANY(CAST(:receipts AS text[]))
+""")
+
+
+def lock_directory(directory):
+    """Returns the open lock file holding an exclusive flock on directory.
+    Raises JournalInUse if another process holds it"""
+    lock_file = open(os.path.join(directory, LOCK_NAME), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise JournalInUse("Vote journal directory {} is in use by another process".format(
+            directory))
+    return lock_file
+
+def journal_directories(root):
+    """Returns the journal directories under root, in order"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, name) for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)))
+
+def directory_receipt_status(directory, receipt):
+    """Returns "pending" if receipt is in one of directory's segments,
+    "rejected" if it is in one of its rejected files, otherwise None.
+    Segments are read before rejected files, which a flush writes before
+    deleting its segment, so a vote being flushed is always found"""
+    record = '"receipt": {}'.format(json.dumps(receipt))
+    for suffix, status in [(SEGMENT_SUFFIX, "pending"), (REJECTED_SUFFIX, "rejected")]:
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(suffix):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as journal_file:
+                    for line in journal_file:
+                        if line.rstrip("\n") == receipt or record in line:
+                            return status
+            except FileNotFoundError:
+                # Flushed or expired meanwhile
+                continue
+    return None
+
+def receipt_status(root, receipt):
+    """Returns "pending" or "rejected" for a receipt journaled by any of
+    the processes journaling under root, otherwise None"""
+    for directory in journal_directories(root):
+        status = directory_receipt_status(directory, receipt)
+        if status:
+            return status
+    return None
+
+
+class VoteJournal(object):
+    """Append-only journal of accepted votes, in numbered segment files of
+    one JSON vote per line.  Raises JournalInUse if another process is
+    journaling to directory"""
+    def __init__(self, directory, group_commit_ms=5, flush_interval=1.0,
+            segment_votes=10000, receipt_ttl=3600):
+        self.directory = directory
+        self.group_commit = group_commit_ms / 1000.0
+        self.flush_interval = flush_interval
+        self.segment_votes = segment_votes
+        self.receipt_ttl = receipt_ttl
+
+        # Receipts written to the journal but not yet flushed.  Rejected
+        # receipts are only kept on disk
+        self.pending = set()
+
+        self._queue = queue.Queue()
+        # Guards the open segment, shared by the writer and the flusher
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._segment = None
+        self._segment_path = None
+        self._segment_count = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = lock_directory(directory)
+        # Leftover segments are closed, and are flushed first
+        self._segment_number = 0
+        for path in self._closed_segments():
+            self._segment_number = int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)])
+            self.pending.update(record["receipt"] for record in self._read_segment(path))
+
+        self._writer = threading.Thread(target=self._write_loop, name="vote-journal-writer")
+        self._flusher = threading.Thread(target=self._flush_loop, name="vote-journal-flusher")
+        self._writer.daemon = True
+        self._flusher.daemon = True
+
+    def start(self):
+        """Starts the writer and flusher threads"""
+        self._writer.start()
+        self._flusher.start()
+
+    def close(self):
+        """Stops the threads once the queued votes are written, and flushes
+        every segment that can be flushed"""
+        self._queue.put(None)
+        self._writer.join()
+        self._stop.set()
+        self._flusher.join()
+        with self._lock:
+            self._close_segment()
+        self.flush_segments()
+        self._lock_file.close()
+
+    def append(self, user_id, candidate_id, value):
+        """Journals a vote, returning its receipt id once the vote is on
+        disk.  Raises the writer's error if it couldn't be written"""
+        record = {
+        "receipt": uuid.uuid4().hex,
+        "user_id": user_id,
+        "candidate_id": candidate_id,
+        "value": value,
+        "start_date": datetime.datetime.utcnow().isoformat(),
+        }
+        entry = [record, threading.Event(), None]
+        self._queue.put(entry)
+        entry[1].wait()
+        if entry[2] is not None:
+            raise entry[2]
+        return record["receipt"]
+
+    def status(self, receipt):
+        """Returns "pending" or "rejected" for a receipt this journal still
+        tracks, otherwise None"""
+        if receipt in self.pending:
+            return "pending"
+        return directory_receipt_status(self.directory, receipt)
+
+    def flush_segments(self):
+        """Flushes the closed segments to the vote table, oldest first.
+        Stops at the first failure; the segment is retried next time"""
+        for path in self._closed_segments():
+            try:
+                self._flush_segment(path)
+            except Exception:
+                logger.exception("Could not flush vote journal segment %s", path)
+                return
+
+    def flush_orphans(self):
+        """Flushes the segments left in sibling journal directories by
+        processes that have stopped"""
+        for directory in journal_directories(os.path.dirname(self.directory)):
+            if os.path.samefile(directory, self.directory):
+                continue
+            try:
+                lock_file = lock_directory(directory)
+            except JournalInUse:
+                continue
+            try:
+                for name in sorted(os.listdir(directory)):
+                    if name.endswith(SEGMENT_SUFFIX):
+                        self._flush_segment(os.path.join(directory, name))
+            except Exception:
+                logger.exception("Could not flush vote journal directory %s", directory)
+            finally:
+                lock_file.close()
+
+    def expire_receipts(self):
+        """Deletes the rejected files older than receipt_ttl"""
+        expired = time.time() - self.receipt_ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(REJECTED_SUFFIX) and os.path.getmtime(path) < expired:
+                os.remove(path)
+
+    def _write_loop(self):
+        """Writes queued votes in groups, one fsync per group"""
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            entries = [entry]
+            deadline = time.monotonic() + self.group_commit
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    # Writes this group before stopping
+                    self._queue.put(None)
+                    break
+                entries.append(entry)
+
+            try:
+                with self._lock:
+                    if self._segment is None:
+                        self._open_segment()
+                    self._segment.write("".join(
+                        json.dumps(entry[0]) + "\n" for entry in entries))
+                    self._segment.flush()
+                    os.fsync(self._segment.fileno())
+                    self.pending.update(entry[0]["receipt"] for entry in entries)
+                    self._segment_count += len(entries)
+                    if self._segment_count >= self.segment_votes:
+                        self._close_segment()
+            except Exception as e:
+                for entry in entries:
+                    entry[2] = e
+            for entry in entries:
+                entry[1].set()
+
+    def _flush_loop(self):
+        """Closes the open segment and flushes, every flush_interval"""
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                self._close_segment()
+            self.flush_segments()
+            self.flush_orphans()
+            self.expire_receipts()
+
+    def _open_segment(self):
+        self._segment_number += 1
+        self._segment_path = os.path.join(self.directory,
+            "{:012d}{}".format(self._segment_number, SEGMENT_SUFFIX))
+        self._segment = open(self._segment_path, "a")
+        self._segment_count = 0
+        self._fsync_directory()
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+            self._segment_path = None
+
+    def _closed_segments(self):
+        """Returns the paths of the segments no longer written to, in order"""
+        with self._lock:
+            open_path = self._segment_path
+        paths = sorted(os.path.join(self.directory, name)
+            for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        return [path for path in paths if path != open_path]
+
+    def _read_segment(self, path):
+        """Returns a segment's votes.  A torn last line was never
+        acknowledged, so it is dropped"""
+        records = []
+        with open(path) as segment:
+            for line in segment:
+                if not line.endswith("\n"):
+                    break
+                records.append(json.loads(line))
+        return records
+
+    def _flush_segment(self, path):
+        records = self._read_segment(path)
+        receipts = [record["receipt"] for record in records]
+        flushed = set()
+        if records:
+            db_session = Session()
+            try:
+                db_session.execute(lock_voters_statement,
+                    {"user_ids": [record["user_id"] for record in records]})
+                flushed = set(receipt for receipt, in db_session.execute(flush_statement, {
+                    "receipts": receipts,
+                    "user_ids": [record["user_id"] for record in records],
+                    "candidate_ids": [record["candidate_id"] for record in records],
+                    "vote_values": [record["value"] for record in records],
+                    "start_dates": [record["start_date"] for record in records]}))
+                db_session.commit()
+            except Exception:
+                db_session.rollback()
+                raise
+            finally:
+                db_session.close()
+
+        # Rejected receipts are recorded before the segment goes, see
+        # directory_receipt_status()
+        rejected = [receipt for receipt in receipts if receipt not in flushed]
+        if rejected:
+            logger.warning("Vote journal segment %s: %d votes rejected",
+                path, len(rejected))
+            with open(path[:-len(SEGMENT_SUFFIX)] + REJECTED_SUFFIX, "w") as rejected_file:
+                rejected_file.write("".join(receipt + "\n" for receipt in rejected))
+        os.remove(path)
+        self._fsync_directory(os.path.dirname(path))
+        self.pending.difference_update(receipts)
+
+    def _fsync_directory(self, path=None):
+        """Makes segment creation and removal durable"""
+        directory = os.open(path or self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    """Returns the app's VoteJournal, in the first directory under
+    VOTE_JOURNAL_DIR no other process holds, starting it and replaying
+    leftover segments on first use.  None unless VOTE_JOURNAL_DIR is
+    configured.
+    Only processes that serve journaled votes call this, so other users of
+    the app (manage commands, tally workers, the ingestion service) don't
+    start the journal's threads"""
+    global _journal
+    with _journal_lock:
+        if _journal is None and app.config.get("VOTE_JOURNAL_DIR"):
+            number = 0
+            while _journal is None:
+                try:
+                    _journal = VoteJournal(
+                        os.path.join(app.config["VOTE_JOURNAL_DIR"], "{:04d}".format(number)),
+                        app.config.get("VOTE_JOURNAL_GROUP_COMMIT_MS", 5),
+                        app.config.get("VOTE_JOURNAL_FLUSH_INTERVAL", 1.0),
+                        app.config.get("VOTE_JOURNAL_SEGMENT_VOTES", 10000),
+                        app.config.get("VOTE_JOURNAL_RECEIPT_TTL", 3600))
+                except JournalInUse:
+                    number += 1
+            _journal.start()
+            atexit.register(_journal.close)
+        return _journal
@@ -9,4 +9,8 @@ from . import api
 from . import views
 
 from .database import Base, engine
-Base.metadata.create_all(engine)
\ No newline at end of file
+# Also installs the database functions registered in models.py
+Base.metadata.create_all(engine)
+# Partitions vote by race, if VOTE_PARTITION_BY_RACE is set
+from .models import create_vote_partitions
+create_vote_partitions()
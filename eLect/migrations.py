@@ -0,0 +1,67 @@
+### Schema migrations for existing databases
+#
+# create_all() only creates missing tables.  Columns and indexes added to
+# tables that already exist are applied by migrate(), which is idempotent:
+# every step checks for what it adds, so it is safe to run on each deploy.
+# Each race's candidate_tally and pairwise_count rows are then rebuilt from
+# its votes, as votes cast before their triggers existed aren't counted.
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+from eLect import models
+from eLect import utils
+from eLect.database import Base, engine, session
+
+# Columns added to existing tables, as (table, column definition)
+COLUMNS = [
+    ("results", "vote_version bigint"),
+    ("vote", "ranked boolean NOT NULL DEFAULT false"),
+    ("vote", "receipt text"),
+    ("candidate_tally", "version bigint NOT NULL DEFAULT 0"),
+    ]
+
+# Constraints the models declare on columns rather than as Index objects
+UNIQUE_INDEXES = [
+    ("vote_receipt_key", "vote", "receipt"),
+    ]
+
+# Marks the votes cast in ranked races before vote.ranked existed.  Later
+# votes are marked by the vote_ranked trigger
+backfill_ranked = text("""
+UPDATE vote SET ranked = true
+FROM race
+WHERE race.id = vote.race_id
+    AND CAST(race.election_type AS text) = ANY(CAST(:ranking_types AS text[]))
+    AND NOT vote.ranked
+""")
+
+
+def migrate():
+    """Adds the missing columns and indexes to an existing database, in a
+    single transaction.  CREATE INDEX blocks writes to its table while it
+    builds, so run this outside peak voting.  Then rebuilds every race's vote tallies and pairwise counts from its
+    votes, a race per transaction.  Returns the names of the indexes checked"""
+    index_names = []
+    with engine.begin() as connection:
+        for table, column in COLUMNS:
+            connection.execute(text("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}".format(
+                table, column)))
+        connection.execute(backfill_ranked,
+            {"ranking_types": models.Race._ranking_types})
+
+        for name, table, column in UNIQUE_INDEXES:
+            connection.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                name, table, column)))
+            index_names.append(name)
+        for table in Base.metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                connection.execute(CreateIndex(index, if_not_exists=True))
+                index_names.append(index.name)
+
+    race_ids = [race_id for race_id, in session.query(models.Race.id).order_by(
+        models.Race.id)]
+    for race_id in race_ids:
+        utils.rebuild_vote_tallies(race_id)
+        utils.rebuild_pairwise_counts(race_id)
+        session.commit()
+    return index_names
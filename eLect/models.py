@@ -4,16 +4,22 @@ import datetime
 from flask import url_for
 from flask_login import UserMixin
 from flask.json import jsonify
-from sqlalchemy import Column, Integer, Text, DateTime, Boolean, Sequence, ForeignKey, Enum, CheckConstraint, event
-from sqlalchemy.orm import relationship, validates, column_property, backref, configure_mappers
+from sqlalchemy import Column, Integer, BigInteger, Text, DateTime, Boolean, Sequence, ForeignKey, Enum, CheckConstraint, Index, DDL, event, false, text
+from sqlalchemy.orm import relationship, validates, column_property, backref, configure_mappers, deferred, object_session
 from sqlalchemy.ext.hybrid import hybrid_property, hybrid_method
 from sqlalchemy.sql import func, select
 # Not sure if this is the best way to go about creating this ENUM
 # USE JSONB ALWAYS. Requires PostgreSQL v. >= 9.4
 from sqlalchemy.dialects.postgresql import ENUM, JSONB
 
+from eLect.main import app
 from eLect.custom_exceptions import *
-from .database import Base, engine, session
+from .database import Base, Session, engine, session
+
+# With VOTE_PARTITION_BY_RACE, vote is created LIST partitioned by race_id,
+# with one partition per race (see vote_partition_name()).  Partitioning is
+# fixed when the table is created.  Requires PostgreSQL >= 14
+VOTE_PARTITIONED = bool(app.config.get("VOTE_PARTITION_BY_RACE"))
 
 
 ### Define election type enum
@@ -34,11 +40,12 @@ class Election(Base):
     id = Column(Integer, primary_key=True)
     title = Column(Text, nullable=False)
     description_short = Column(Text)
-    description_long = Column(Text)
+    # Paragraphs of text, only loaded when accessed
+    description_long = deferred(Column(Text))
     icon_small_location = Column(Text, 
         default="static/site-images/election_small.gif")
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
     # end_date = Column(DateTime)
     elect_open = Column(Boolean, default=True)
 
@@ -86,15 +93,16 @@ class Race(Base):
     id = Column(Integer, primary_key=True)
     title = Column(Text, nullable=False)
     description_short = Column(Text)
-    description_long = Column(Text)
+    # Paragraphs of text, only loaded when accessed
+    description_long = deferred(Column(Text))
     icon_small_location = Column(Text,
         default="static/site-images/race_small.gif")
     race_open = Column(Boolean, default=True)
     # Needs the _ to differentiate from the hybrid property
     _min_vote_val = Column(Integer, default=0)
     _max_vote_val = Column(Integer, default=1)
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
 
     # Foreign relationships
     election_id = Column(Integer, ForeignKey('election.id'))
@@ -102,9 +110,15 @@ class Race(Base):
         ForeignKey('elect_type.election_type'), 
         default=None)
     candidates = relationship("Candidate", backref="race", cascade="all, delete-orphan")
-    votes = relationship("Vote", backref="race", cascade="all, delete-orphan")
+    # Partitioned votes go with their race's partition, see drop_vote_partitions()
+    votes = relationship("Vote", backref="race", cascade="all, delete-orphan",
+        passive_deletes=VOTE_PARTITIONED)
     results = relationship("Results", backref="race", cascade="all, delete-orphan")
 
+    # An election's races, in id order
+    __table_args__ = (
+        Index("race_election", "election_id", "id"),
+        )
 
 
     def __init__(self, *args, **kwargs):
@@ -245,15 +259,22 @@ class Candidate(Base):
     id = Column(Integer, primary_key=True)
     title = Column(Text, nullable=False)
     description_short = Column(Text)
-    description_long = Column(Text)
+    # Paragraphs of text, only loaded when accessed
+    description_long = deferred(Column(Text))
     icon_small_location = Column(Text,
         default="static/site-images/candidate_small.gif")
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
 
     # Foreign relationships
     race_id = Column(Integer, ForeignKey('race.id'), nullable=False)
-    votes = relationship("Vote", backref="candidate", cascade="all, delete-orphan")
+    votes = relationship("Vote", backref="candidate", cascade="all, delete-orphan",
+        passive_deletes=VOTE_PARTITIONED)
+
+    # A race's candidates, in id order
+    __table_args__ = (
+        Index("candidate_race", "race_id", "id"),
+        )
 
     def as_dictionary(self):
         candidate = {
@@ -273,16 +294,46 @@ class Candidate(Base):
 class Vote(Base):
     """ Vote class scheme """
     __tablename__ = "vote"
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     value = Column(Integer, nullable=False, default=0)
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
     
-    # Foreign relationships
+    # Whether the vote's race allows candidate rankings.  Set by the
+    # vote_ranked trigger, for the one-vote-per-race unique index below
+    ranked = Column(Boolean, nullable=False, server_default=false())
+    # Receipt id of a vote accepted through the vote journal, see journal.py
+    receipt = Column(Text, unique=not VOTE_PARTITIONED)
+
+    # Foreign relationships.  A partitioned table's unique indexes must
+    # include its partition key, race_id, so it joins the primary key
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
-    race_id = Column(Integer, ForeignKey('race.id'))
+    race_id = Column(Integer, ForeignKey('race.id'), primary_key=VOTE_PARTITIONED)
     candidate_id = Column(Integer, ForeignKey('candidate.id'), nullable=False)
 
+    # One vote per candidate, and one vote per race unless the race is ranked.
+    # Then a race's ballots and a candidate's votes, by user, with the
+    # columns tallies read included for index-only scans
+    __table_args__ = (
+        Index("vote_user_candidate", "user_id", "candidate_id",
+            *(["race_id"] if VOTE_PARTITIONED else []), unique=True),
+        Index("vote_user_race_unranked", "user_id", "race_id", unique=True,
+            postgresql_where=text("NOT ranked")),
+        Index("vote_race_user", "race_id", "user_id",
+            postgresql_include=["candidate_id", "value"]),
+        Index("vote_candidate_user", "candidate_id", "user_id",
+            postgresql_include=["value"]),
+        ) + ((
+        Index("vote_receipt_key", "receipt", "race_id", unique=True),
+        {"postgresql_partition_by": "LIST (race_id)"},
+        ) if VOTE_PARTITIONED else ())
+    # The ORM still identifies votes by id alone.  Deleted races drop their
+    # votes' partition before the flush, so loaded votes may already be gone
+    __mapper_args__ = {
+        "primary_key": [id],
+        "confirm_deleted_rows": not VOTE_PARTITIONED,
+        }
+
     def __init__(self, *args, **kwargs):
         """Things that need to be done on init, like assign race_id"""
 
@@ -312,14 +363,22 @@ class Results(Base):
     __tablename__ = "results"
     id = Column(Integer, primary_key=True)
     results = Column(JSONB)
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
+
+    # Race vote-set version the results were tallied at, see get_tally()
+    vote_version = Column(BigInteger)
 
     # Foreign Keys
     race_id = Column(Integer, ForeignKey("race.id"), nullable = False)
     election_type = Column(election_type_enum, 
         ForeignKey("elect_type.election_type"), default=None)
 
+    # Cached tally lookups, see get_tally()
+    __table_args__ = (
+        Index("results_race_version", "race_id", "vote_version"),
+        )
+
     def __init__(self, *args, **kwargs):
         """On __init__ of Results, assigns things like elect_type from parent Race"""
         super(Results, self).__init__(*args, **kwargs)
@@ -331,14 +390,83 @@ class Results(Base):
     def as_dictionary(self):
         results = {
         "id": self.id,
-        "start_date": self.start_date,
-        "last_modified": self.last_modified,
         "race_id": self.race_id,
         "election_type": self.election_type,
         "results": self.results,
         "start_date": self.start_date,
         "last_modified": self.last_modified,
         }
+        return results
+
+class PairwiseCount(Base):
+    """Persisted pairwise preference counts for a race: the number of users
+    whose ballot ranks cand1 above cand2.  Updated incrementally by the vote
+    write path in api.py, so Schulze tallies don't need to rescan votes"""
+    __tablename__ = "pairwise_count"
+    race_id = Column(Integer, ForeignKey("race.id", ondelete="CASCADE"),
+        primary_key=True)
+    cand1_id = Column(Integer, ForeignKey("candidate.id", ondelete="CASCADE"),
+        primary_key=True)
+    cand2_id = Column(Integer, ForeignKey("candidate.id", ondelete="CASCADE"),
+        primary_key=True)
+    num_users_prefer = Column(Integer, nullable=False, default=0)
+
+    def as_dictionary(self):
+        pairwise_count = {
+        "race_id": self.race_id,
+        "cand1_id": self.cand1_id,
+        "cand2_id": self.cand2_id,
+        "num_users_prefer": self.num_users_prefer,
+        }
+        return pairwise_count
+
+class CandidateTally(Base):
+    """Rollup of a candidate's vote sum and count, kept up to date by the
+    vote_tally trigger, so WTA and Proportional tallies read C rows
+    instead of V rows.  version is bumped on every change to the
+    candidate's votes; race totals and versions are sums over a race's
+    rows, so concurrent votes for different candidates don't queue on a
+    single race row"""
+    __tablename__ = "candidate_tally"
+    candidate_id = Column(Integer, ForeignKey("candidate.id", ondelete="CASCADE"),
+        primary_key=True)
+    race_id = Column(Integer, ForeignKey("race.id", ondelete="CASCADE"))
+    vote_sum = Column(BigInteger, nullable=False, default=0)
+    vote_count = Column(BigInteger, nullable=False, default=0)
+    version = Column(BigInteger, nullable=False, default=0)
+
+    # A race's rollups, read whole by WTA and Proportional tallies
+    __table_args__ = (
+        Index("candidate_tally_race", "race_id",
+            postgresql_include=["candidate_id", "vote_sum", "vote_count"]),
+        )
+
+    def as_dictionary(self):
+        candidate_tally = {
+        "candidate_id": self.candidate_id,
+        "race_id": self.race_id,
+        "vote_sum": self.vote_sum,
+        "vote_count": self.vote_count,
+        "version": self.version,
+        }
+        return candidate_tally
+
+class RaceTally(Base):
+    """A race's version counter for changes to its candidates, bumped by the
+    candidate_version trigger.  Added to the sum of the race's
+    candidate_tally versions, it keys the cached Results of the race (see
+    utils.race_vote_version()).  Votes never write this row"""
+    __tablename__ = "race_tally"
+    race_id = Column(Integer, ForeignKey("race.id", ondelete="CASCADE"),
+        primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+    def as_dictionary(self):
+        race_tally = {
+        "race_id": self.race_id,
+        "version": self.version,
+        }
+        return race_tally
 
 class ElectionType(Base):
     """ Election Type class scheme """
@@ -349,7 +477,7 @@ class ElectionType(Base):
     title = Column(Text, nullable=False)
     description_short = Column(Text)
     description_long = Column(Text)
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
 
     def __init__(self, *args, **kwargs):
         """Things that need to be done on init, like delete duplicate entries"""
@@ -382,19 +510,8 @@ class ElectionType(Base):
     def check_race(self, race_id):
         """Checks race conditions before attempting to tally votes. 
         Failed test returns Exception"""
-        from .utils import num_votes_cast
-        race = session.query(Race).get(race_id)
-        # Fix this query to simply return the count #, not a list of tuples
-        num_votes_cast = num_votes_cast(race_id)
-        if not race:
-            raise NoRaces("No race with id {}".format(race_id))
-        elif not race.candidates:
-            raise NoCandidates("No candidates found for race id {}".format(race_id))
-        elif race.race_open == True:
-            raise OpenElection("Race id {} in Election {} is still open.".format(
-                race_id, race.election_id))
-        elif num_votes_cast == 0:
-            raise NoVotes("No Votes cast in Race id {}".format(race_id))
+        from .utils import check_race
+        check_race(race_id)
 
 
 class User(Base, UserMixin):
@@ -405,8 +522,8 @@ class User(Base, UserMixin):
     email = Column(Text, unique = True)
     password = Column(Text)
     icon_small_location = Column(Text)
-    start_date = Column(DateTime, default=datetime.datetime.utcnow())
-    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow())
+    start_date = Column(DateTime, default=datetime.datetime.utcnow)
+    last_modified = Column(DateTime, onupdate=datetime.datetime.utcnow)
 
     # Foreign relationships
     # registered_elections = relationship("Election", backref="registered_user")
@@ -423,4 +540,238 @@ class User(Base, UserMixin):
         "start_date": self.start_date,
         "last_modified": self.last_modified,
         }
-        return user
\ No newline at end of file
+        return user
+
+
+### Database functions
+# Installed by Base.metadata.create_all(), once the tables they read exist.
+# CREATE OR REPLACE keeps this safe to run against an existing schema.
+
+# Pairwise preference counts for a Schulze race, computed inside PostgreSQL.
+# Each user's ballot is collapsed into candidate/value arrays with array_agg,
+# and only the C x C counts are returned to the client.
+pairwise_counts_function = DDL("""
+CREATE OR REPLACE FUNCTION elect_pairwise_counts(p_race_id integer)
+RETURNS TABLE(cand1_id integer, cand2_id integer, num_users_prefer bigint) AS $$
+    WITH ballot AS (
+        SELECT array_agg(vote.candidate_id ORDER BY vote.candidate_id) AS cand_ids,
+            array_agg(vote.value ORDER BY vote.candidate_id) AS vals
+        FROM vote
+        WHERE vote.race_id = p_race_id AND vote.candidate_id IN (
+            SELECT candidate.id FROM candidate WHERE candidate.race_id = p_race_id)
+        GROUP BY vote.user_id
+    )
+    SELECT ballot.cand_ids[i], ballot.cand_ids[j], count(*)
+    FROM ballot,
+        generate_subscripts(ballot.cand_ids, 1) AS i,
+        generate_subscripts(ballot.cand_ids, 1) AS j
+    WHERE ballot.vals[i] > ballot.vals[j]
+    GROUP BY 1, 2
+$$ LANGUAGE sql STABLE
+""")
+event.listen(Base.metadata, "after_create",
+    pairwise_counts_function.execute_if(dialect="postgresql"))
+event.listen(Base.metadata, "before_drop",
+    DDL("DROP FUNCTION IF EXISTS elect_pairwise_counts(integer)").execute_if(
+        dialect="postgresql"))
+
+# Keeps the candidate_tally rollup in step with every insert, update and
+# delete on vote, whichever code path writes the row.  Each vote only
+# writes its candidate's row.
+#
+# A race's vote-set version is race_tally.version plus the sum of its
+# candidate_tally versions, and must only ever grow.  A candidate leaving
+# a race takes its tally version out of that sum, so the candidate trigger
+# adds it, plus one, to race_tally.version.  It runs BEFORE the change, as
+# the candidate_tally row is cascade deleted with the candidate
+vote_tally_trigger = DDL("""
+CREATE OR REPLACE FUNCTION elect_vote_tally() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE candidate_tally
+            SET vote_sum = vote_sum - OLD.value, vote_count = vote_count - 1,
+                version = version + 1
+            WHERE candidate_id = OLD.candidate_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO candidate_tally (candidate_id, race_id, vote_sum, vote_count, version)
+            VALUES (NEW.candidate_id, NEW.race_id, NEW.value, 1, 1)
+            ON CONFLICT (candidate_id) DO UPDATE
+            SET vote_sum = candidate_tally.vote_sum + EXCLUDED.vote_sum,
+                vote_count = candidate_tally.vote_count + 1,
+                version = candidate_tally.version + 1;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vote_tally ON vote;
+CREATE TRIGGER vote_tally AFTER INSERT OR UPDATE OR DELETE ON vote
+    FOR EACH ROW EXECUTE PROCEDURE elect_vote_tally();
+
+CREATE OR REPLACE FUNCTION elect_candidate_version() RETURNS trigger AS $$
+DECLARE
+    tally_version bigint;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.race_id IS NOT NULL THEN
+        SELECT version INTO tally_version
+            FROM candidate_tally WHERE candidate_id = OLD.id;
+        INSERT INTO race_tally (race_id, version)
+            VALUES (OLD.race_id, COALESCE(tally_version, 0) + 1)
+            ON CONFLICT (race_id) DO UPDATE
+            SET version = race_tally.version + EXCLUDED.version;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        UPDATE candidate_tally SET race_id = NEW.race_id WHERE candidate_id = NEW.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.race_id IS NOT NULL THEN
+        INSERT INTO race_tally (race_id, version)
+            VALUES (NEW.race_id, 1)
+            ON CONFLICT (race_id) DO UPDATE
+            SET version = race_tally.version + 1;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS candidate_version ON candidate;
+CREATE TRIGGER candidate_version BEFORE INSERT OR DELETE OR UPDATE OF race_id
+    ON candidate FOR EACH ROW EXECUTE PROCEDURE elect_candidate_version();
+""")
+event.listen(Base.metadata, "after_create",
+    vote_tally_trigger.execute_if(dialect="postgresql"))
+event.listen(Base.metadata, "before_drop",
+    DDL("DROP FUNCTION IF EXISTS elect_vote_tally() CASCADE; "
+        "DROP FUNCTION IF EXISTS elect_candidate_version() CASCADE").execute_if(
+        dialect="postgresql"))
+
+# Keeps vote.ranked in step with the election type of the vote's race, on
+# every vote write and whenever a race changes election type.  Changing a
+# race to a non-ranking type fails if a user has several votes in it
+vote_ranked_trigger = DDL("""
+CREATE OR REPLACE FUNCTION elect_vote_ranked() RETURNS trigger AS $$
+BEGIN
+    NEW.ranked := COALESCE((SELECT race.election_type IN ({ranking_types})
+        FROM race WHERE race.id = NEW.race_id), false);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS vote_ranked ON vote;
+CREATE TRIGGER vote_ranked BEFORE INSERT OR UPDATE OF race_id ON vote
+    FOR EACH ROW EXECUTE PROCEDURE elect_vote_ranked();
+
+CREATE OR REPLACE FUNCTION elect_race_ranked() RETURNS trigger AS $$
+BEGIN
+    UPDATE vote SET ranked = COALESCE(NEW.election_type IN ({ranking_types}), false)
+        WHERE vote.race_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS race_ranked ON race;
+CREATE TRIGGER race_ranked AFTER UPDATE OF election_type ON race
+    FOR EACH ROW WHEN (OLD.election_type IS DISTINCT FROM NEW.election_type)
+    EXECUTE PROCEDURE elect_race_ranked();
+""".format(ranking_types=", ".join(
+    "'{}'".format(elect_type) for elect_type in Race._ranking_types)))
+event.listen(Base.metadata, "after_create",
+    vote_ranked_trigger.execute_if(dialect="postgresql"))
+event.listen(Base.metadata, "before_drop",
+    DDL("DROP FUNCTION IF EXISTS elect_vote_ranked() CASCADE; "
+        "DROP FUNCTION IF EXISTS elect_race_ranked() CASCADE").execute_if(
+        dialect="postgresql"))
+
+
+### Vote partitions, with VOTE_PARTITION_BY_RACE
+def vote_partition_name(race_id):
+    """Returns the name of race_id's vote partition"""
+    return "vote_race_{}".format(int(race_id))
+
+def create_vote_partition(race_id):
+    """Creates race_id's vote partition in its own short transaction.  The
+    table is created on its own and then attached, which only takes a SHARE
+    UPDATE EXCLUSIVE lock on vote, so votes keep being cast meanwhile"""
+    name = vote_partition_name(race_id)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS {} "
+            "(LIKE vote INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(name)))
+        attached = connection.execute(text(
+            "SELECT 1 FROM pg_inherits WHERE inhrelid = CAST(:name AS regclass)"),
+            {"name": name}).scalar()
+        if attached is None:
+            connection.execute(text(
+                "ALTER TABLE vote ATTACH PARTITION {} FOR VALUES IN ({})".format(
+                    name, int(race_id))))
+
+def create_vote_partitions():
+    """Creates any missing vote partitions for existing races.  Run by the
+    schema bootstrap in main.py"""
+    if not VOTE_PARTITIONED:
+        return
+    with engine.connect() as connection:
+        race_ids = [race_id for race_id, in connection.execute(
+            select([Race.__table__.c.id]))]
+    for race_id in race_ids:
+        create_vote_partition(race_id)
+
+def drop_vote_partitions(race_ids):
+    """Detaches and drops the vote partitions of race_ids, deleting their
+    votes without touching them row by row.  Runs on its own autocommit
+    connection, as DETACH PARTITION CONCURRENTLY can't run in a transaction
+    block, and finishes a detach an earlier call was interrupted in"""
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        for race_id in race_ids:
+            name = vote_partition_name(race_id)
+            pending = connection.execute(text(
+                "SELECT inhdetachpending FROM pg_inherits "
+                "WHERE inhrelid = to_regclass(:name)"), {"name": name}).scalar()
+            if pending is not None:
+                connection.execute(text("ALTER TABLE vote DETACH PARTITION {} {}".format(
+                    name, "FINALIZE" if pending else "CONCURRENTLY")))
+            connection.execute(text("DROP TABLE IF EXISTS {}".format(name)))
+
+@event.listens_for(Race, "after_insert")
+def create_race_vote_partition(mapper, connection, race):
+    """Notes a new race, whose vote partition is created once its
+    transaction commits.  Attaching a partition adds its foreign keys,
+    which would wait on the race's own uncommitted insert"""
+    if VOTE_PARTITIONED:
+        object_session(race).info.setdefault("new_vote_partitions", set()).add(race.id)
+
+@event.listens_for(Session, "before_flush")
+def drop_deleted_vote_partitions(db_session, flush_context, instances):
+    """Drops the vote partitions of the races a flush deletes, before it
+    deletes their candidates.  Race.votes and Candidate.votes are passive,
+    so deleting an election or race doesn't load its votes.  The votes go
+    even if the transaction then rolls back, in which case the races still
+    there get empty partitions back"""
+    if not VOTE_PARTITIONED:
+        return
+    race_ids = [instance.id for instance in db_session.deleted
+        if isinstance(instance, Race) and instance.id is not None]
+    if race_ids:
+        drop_vote_partitions(race_ids)
+        db_session.info["dropped_vote_partitions"] = True
+
+@event.listens_for(Session, "after_commit")
+def create_new_vote_partitions(db_session):
+    """Creates the vote partitions of the races a transaction inserted"""
+    db_session.info.pop("dropped_vote_partitions", None)
+    for race_id in sorted(db_session.info.pop("new_vote_partitions", ())):
+        create_vote_partition(race_id)
+
+@event.listens_for(Session, "after_soft_rollback")
+def restore_vote_partitions(db_session, previous_transaction):
+    """Forgets a rolled back transaction's new races, and gives the races
+    whose partitions it dropped their partitions back"""
+    if db_session.in_transaction():
+        return
+    db_session.info.pop("new_vote_partitions", None)
+    if db_session.info.pop("dropped_vote_partitions", None):
+        create_vote_partitions()
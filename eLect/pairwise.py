@@ -0,0 +1,126 @@
+### Matrix helpers for pairwise (Condorcet-style) tallies
+#
+# Candidates are mapped to dense indices so that the pairwise preference
+# counts and the strongest paths can be held in C x C numpy arrays, instead
+# of dicts keyed by (cand1, cand2) tuples.
+import numpy as np
+
+
+def candidate_index(candidate_ids):
+    """Returns a {cand_id: index} dict for a sorted list of candidate ids"""
+    return {cand_id: index for index, cand_id in enumerate(candidate_ids)}
+
+def empty_matrix(num_candidates):
+    """Returns a zeroed C x C pairwise counter matrix"""
+    return np.zeros((num_candidates, num_candidates), dtype=np.int64)
+
+def add_ballot(counts, index, ballot, multiplicity=1):
+    """Adds a ballot's preferences to a C x C counter matrix, once for each of
+    the multiplicity voters who cast it.  ballot is a sequence of
+    (cand_id, value) tuples; only candidates on the ballot are compared"""
+    positions = np.array([index[cand_id] for cand_id, value in ballot], dtype=np.intp)
+    values = np.array([value for cand_id, value in ballot])
+    counts[np.ix_(positions, positions)] += multiplicity * (
+        values[:, np.newaxis] > values[np.newaxis, :])
+
+def compress_ballots(ballots):
+    """Groups identical rows of a voters x candidates ballot matrix.  Returns
+    (unique ballots, multiplicities), the number of voters for each row"""
+    if ballots.shape[0] == 0:
+        return ballots, np.zeros(0, dtype=np.int64)
+    unique_ballots, multiplicities = np.unique(ballots, axis=0, return_counts=True)
+    return unique_ballots, multiplicities
+
+def pairwise_from_ballots(ballots, unranked, multiplicities=None, block_cells=2 ** 24):
+    """Counts pairwise preferences over a voters x candidates ballot matrix,
+    where unranked marks candidates a voter didn't vote for.  Each row counts
+    multiplicities[row] times if given, see compress_ballots().  Rows are
+    compared in blocks of about block_cells booleans to bound memory"""
+    num_candidates = ballots.shape[1]
+    counts = empty_matrix(num_candidates)
+    block_size = max(1, block_cells // max(1, num_candidates * num_candidates))
+    for start in range(0, ballots.shape[0], block_size):
+        block = ballots[start:start + block_size]
+        # unranked is below every real value, so only cand2 needs masking
+        prefers = block[:, :, np.newaxis] > block[:, np.newaxis, :]
+        prefers &= (block != unranked)[:, np.newaxis, :]
+        if multiplicities is None:
+            counts += prefers.sum(axis=0)
+        else:
+            counts += np.tensordot(
+                multiplicities[start:start + block_size], prefers, axes=1)
+    return counts
+
+def merge_partials(partials):
+    """Sums (candidate_ids, C x C counts) partials counted over disjoint sets
+    of voters, e.g. by separate processes or database shards.  Returns a
+    single (candidate_ids, counts) with the union of the candidates"""
+    candidate_ids = sorted(set(cand_id for partial_ids, partial_counts in partials
+        for cand_id in partial_ids))
+    index = candidate_index(candidate_ids)
+    counts = empty_matrix(len(candidate_ids))
+    for partial_ids, partial_counts in partials:
+        positions = np.array([index[cand_id] for cand_id in partial_ids], dtype=np.intp)
+        counts[np.ix_(positions, positions)] += partial_counts
+    return candidate_ids, counts
+
+def ballot_sums(ballots, unranked):
+    """Returns (vote sums, vote counts) arrays per candidate column of a
+    voters x candidates ballot matrix"""
+    ranked = ballots != unranked
+    sums = np.where(ranked, ballots, 0).sum(axis=0, dtype=np.int64)
+    return sums, ranked.sum(axis=0)
+
+def ballot_pairs(ballot):
+    """Returns the (cand1, cand2) pairs a {cand_id: value} ballot prefers"""
+    return [(cand1, cand2) for cand1, value1 in ballot.items()
+        for cand2, value2 in ballot.items() if value1 > value2]
+
+def pair_dict_to_matrix(pair_results, candidate_ids=None):
+    """Converts a {(cand1, cand2): num_users_prefer} dict to a
+    (candidate_ids, C x C matrix) tuple.  Pairs missing from the dict are 0"""
+    ids = set(candidate_ids or [])
+    for cand1, cand2 in pair_results.keys():
+        ids.update((cand1, cand2))
+    candidate_ids = sorted(ids)
+    index = candidate_index(candidate_ids)
+
+    matrix = empty_matrix(len(candidate_ids))
+    for (cand1, cand2), num_users_prefer in pair_results.items():
+        matrix[index[cand1], index[cand2]] = num_users_prefer
+    return candidate_ids, matrix
+
+def matrix_to_pair_dict(candidate_ids, matrix):
+    """Converts a C x C matrix back to a {(cand1, cand2): num_users_prefer}
+    dict.  Like the SQL builders, only pairs with a count > 0 are returned"""
+    rows, cols = np.nonzero(matrix)
+    return {(candidate_ids[i], candidate_ids[j]): int(matrix[i, j])
+        for i, j in zip(rows, cols)}
+
+def widest_paths(matrix):
+    """Computes Schulze strongest path strengths from a pairwise preference
+    matrix, using the Floyd-Warshall max-min relaxation.  Each intermediate
+    candidate k is applied to the whole matrix at once, by broadcasting
+    column k against row k."""
+    paths = np.where(matrix > matrix.T, matrix, 0)
+    for k in range(paths.shape[0]):
+        np.maximum(paths,
+            np.minimum(paths[:, k, np.newaxis], paths[np.newaxis, k, :]),
+            out=paths)
+    np.fill_diagonal(paths, 0)
+    return paths
+
+def schulze_winners(candidate_ids, paths):
+    """Returns {cand_id: bool}, True for every candidate that no other
+    candidate beats by strongest path"""
+    beaten = (paths.T > paths).any(axis=1)
+    return {cand_id: not bool(lost) for cand_id, lost in zip(candidate_ids, beaten)}
+
+def schulze_ranking(candidate_ids, paths):
+    """Returns candidate ids in Schulze order, best first.  The strongest path
+    relation is transitive, so ordering by the number of candidates beaten
+    gives the full ranking.  Ties are ordered by candidate id."""
+    wins = (paths > paths.T).sum(axis=1)
+    order = sorted(range(len(candidate_ids)),
+        key=lambda i: (-wins[i], candidate_ids[i]))
+    return [candidate_ids[i] for i in order]
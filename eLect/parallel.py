@@ -0,0 +1,206 @@
+### Election-wide tallies, fanned out over a process pool
+#
+# Each worker process tallies whole races with its own connection pool,
+# and the parent persists every race's Results in one bulk insert.  This
+# forks a new pool per call, so it is only run by the tally_election
+# manage command.  GET /api/elections/<id>/tally serves stored Results
+# instead, and queues tallies of stale races to a single background thread.
+#
+# Single large Schulze races are split by voter instead: partial pairwise
+# matrices are counted per voter shard, which are then summed.  That work
+# waits on the shard databases, so it runs on one long-lived thread pool
+# per process rather than on new worker processes.
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from eLect.main import app
+from eLect import ballots
+from eLect import models
+from eLect import pairwise
+from eLect.database import engine, session, create_pooled_engine
+from eLect.electiontypes import get_tally_engine
+from eLect.utils import race_vote_version
+
+logger = logging.getLogger(__name__)
+
+# This process's engines for VOTE_SHARD_DATABASE_URIS, by URI, and its
+# thread pool for shard queries.  Both are recreated in forked children
+_shard_engines = {}
+_shard_threads = None
+_shard_pid = None
+_shard_lock = threading.Lock()
+
+
+def _init_worker():
+    """Drops the session and connections inherited from the parent process,
+    so the worker opens its own.  The inherited session is forgotten, not
+    closed, as anything it holds belongs to the parent"""
+    session.registry.clear()
+    engine.dispose()
+
+def _tally_race(race_id):
+    """Tallies a single race inside a worker process.  Returns a dict with
+    the results or the tally error, and the time the tally took"""
+    start = time.perf_counter()
+    tally = {"race_id": race_id}
+    try:
+        race = session.query(models.Race).get(race_id)
+        tally["election_type"] = race.election_type
+        tally["vote_version"] = race_vote_version(race_id)
+        elect_type = get_tally_engine(race.election_type)
+        results = elect_type.tally_race(race_id)
+        elect_type.check_results(results)
+        tally["results"] = results
+    except Exception as e:
+        tally["message"] = "Tally Error: {}".format(e)
+    finally:
+        session.rollback()
+    tally["seconds"] = time.perf_counter() - start
+    return tally
+
+def tally_election(elect_id, max_workers=None):
+    """Tallies every race in an election across a new pool of worker
+    processes, and stores the successful tallies as Results rows in bulk.
+    Returns a list of per-race tally dicts, ordered by race id.
+
+    The calling session is committed first: forked workers must not share
+    its connection.  Forking per call is too costly for requests, see
+    stored_election_tally()"""
+    if max_workers is None:
+        max_workers = app.config.get("TALLY_WORKERS")
+    race_ids = [race_id for race_id, in session.query(models.Race.id).filter(
+        models.Race.election_id == elect_id).order_by(models.Race.id)]
+
+    session.commit()
+    engine.dispose()
+    with ProcessPoolExecutor(max_workers=max_workers,
+            initializer=_init_worker) as executor:
+        tallies = list(executor.map(_tally_race, race_ids,
+            chunksize=max(1, len(race_ids) // 256)))
+    store_tallies(tallies)
+    return tallies
+
+def store_tallies(tallies):
+    """Replaces the tallied races' stale Results with the successful
+    tallies, and commits"""
+    tallied = [tally for tally in tallies if "results" in tally]
+    if tallied:
+        session.query(models.Results).filter(
+            models.Results.race_id.in_([tally["race_id"] for tally in tallied]),
+            models.Results.vote_version != None).delete(synchronize_session=False)
+        session.bulk_insert_mappings(models.Results, [{
+            "race_id": tally["race_id"],
+            "election_type": tally["election_type"],
+            "vote_version": tally["vote_version"],
+            "results": tally["results"]}
+            for tally in tallied])
+        session.commit()
+
+
+# Races queued for a background tally, and the error of each race's last
+# failed background tally with the vote-set version it was tallied at, so
+# a failing race isn't tallied again until its votes change
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="election-tally")
+_queued = set()
+_queued_lock = threading.Lock()
+_failed = {}
+
+def stored_election_tally(elect_id):
+    """Returns (tallies, stale race ids) for an election's races, ordered by
+    race id: a tally dict for each race with current stored Results or a
+    failed background tally of its current votes, and the ids of the races
+    with neither"""
+    tallies = []
+    stale_race_ids = []
+    races = session.query(models.Race.id, models.Race.election_type).filter(
+        models.Race.election_id == elect_id).order_by(models.Race.id)
+    for race_id, election_type in races:
+        tally = {"race_id": race_id, "election_type": election_type}
+        vote_version = race_vote_version(race_id)
+        results = session.query(models.Results.results).filter(
+            models.Results.race_id == race_id,
+            models.Results.election_type == election_type,
+            models.Results.vote_version == vote_version).first()
+        failed = _failed.get(race_id)
+        if results:
+            tally["results"] = results[0]
+        elif failed and failed[0] == vote_version:
+            tally["message"] = failed[1]
+        else:
+            stale_race_ids.append(race_id)
+            continue
+        tallies.append(tally)
+    return tallies, stale_race_ids
+
+def enqueue_tallies(race_ids):
+    """Queues background tallies of the races not queued already"""
+    with _queued_lock:
+        race_ids = [race_id for race_id in race_ids if race_id not in _queued]
+        _queued.update(race_ids)
+    if race_ids:
+        _background.submit(_background_tally, race_ids)
+
+def _background_tally(race_ids):
+    """Tallies races one by one in the background thread, and stores them"""
+    try:
+        tallies = [_tally_race(race_id) for race_id in race_ids]
+        store_tallies(tallies)
+        for tally in tallies:
+            if "message" in tally:
+                _failed[tally["race_id"]] = (tally.get("vote_version"), tally["message"])
+            else:
+                _failed.pop(tally["race_id"], None)
+    except Exception:
+        logger.exception("Could not tally races %s", race_ids)
+        session.rollback()
+    finally:
+        session.remove()
+        with _queued_lock:
+            _queued.difference_update(race_ids)
+
+def _shard_pool(database_uris):
+    """Returns this process's shard query thread pool and its engines for
+    database_uris, creating them on first use"""
+    global _shard_threads, _shard_pid
+    with _shard_lock:
+        if _shard_pid != os.getpid():
+            _shard_engines.clear()
+            _shard_threads = ThreadPoolExecutor(
+                max_workers=app.config.get("PAIRWISE_SHARD_THREADS", 4),
+                thread_name_prefix="pairwise-shard")
+            _shard_pid = os.getpid()
+        for database_uri in database_uris:
+            if database_uri is not None and database_uri not in _shard_engines:
+                _shard_engines[database_uri] = create_pooled_engine(database_uri)
+        engines = dict(_shard_engines)
+        engines[None] = engine
+        return _shard_threads, engines
+
+def _partial_pairwise_counts(bind, task):
+    """Counts one voter shard of a race, against the main database or a vote
+    shard database"""
+    race_id, database_uri, shard, num_shards = task
+    with bind.connect() as connection:
+        return ballots.partial_pairwise_counts(race_id, connection, shard, num_shards)
+
+def sharded_pairwise_counts(race_id, num_shards=None, database_uris=None):
+    """Counts a race's pairwise preferences as user_id % num_shards voter
+    shards, in every database of database_uris (None = the main database),
+    on the process's shard thread pool.  Returns the merged
+    (candidate_ids, C x C counts).
+
+    Only votes committed before the call are counted"""
+    if num_shards is None:
+        num_shards = app.config.get("PAIRWISE_SHARDS") or os.cpu_count()
+    if database_uris is None:
+        database_uris = [None] + list(app.config.get("VOTE_SHARD_DATABASE_URIS", []))
+    tasks = [(race_id, database_uri, shard, num_shards)
+        for database_uri in database_uris for shard in range(num_shards)]
+
+    threads, engines = _shard_pool(database_uris)
+    partials = list(threads.map(
+        lambda task: _partial_pairwise_counts(engines[task[1]], task), tasks))
+    return pairwise.merge_partials(partials)
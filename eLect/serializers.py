@@ -0,0 +1,123 @@
+### JSON serialization for API responses
+#
+# Each model gets a Serializer with its response fields worked out once:
+# the field names, an attrgetter pulling them all off an instance (or a Core
+# row) in one call, and the positions of its DateTime columns.  Rows then
+# become dicts without per-field lookups or json's default= fallback hook.
+#
+# orjson is used when installed, and encodes datetimes natively.  Otherwise
+# the standard json module is used, and datetimes are converted to ISO 8601
+# strings up front.
+import json
+from operator import attrgetter
+
+from sqlalchemy import DateTime
+
+from eLect import models
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Encodes obj as UTF-8 JSON bytes, with the fastest available backend.
+    Dicts may have int keys, as tally results do"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj).encode("utf-8")
+
+
+class Serializer(object):
+    """Serializes a model's instances, or Core rows with the same fields, to
+    JSON-ready dicts"""
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = tuple(fields)
+        table_columns = model.__table__.c
+        # Deferred columns, such as description_long, left out of lists
+        self.deferred_fields = frozenset(field for field in self.fields
+            if getattr(getattr(model, field).property, "deferred", False))
+        self.datetime_positions = [position for position, field in enumerate(self.fields)
+            if isinstance(table_columns[field].type, DateTime)]
+        # Narrowed copies of this serializer, see only()
+        self._subsets = {}
+        getter = attrgetter(*self.fields)
+        if len(self.fields) == 1:
+            self._values = lambda instance: (getter(instance),)
+        else:
+            self._values = getter
+
+    def columns(self):
+        """Returns the model's table columns for the fields, in order, for
+        Core selects"""
+        table_columns = self.model.__table__.c
+        return [table_columns[field] for field in self.fields]
+
+    def attributes(self):
+        """Returns the model's mapped attributes for the fields, in order, for
+        session.query() projections"""
+        return [getattr(self.model, field) for field in self.fields]
+
+    def only(self, fields):
+        """Returns a Serializer for the given subset of the fields, kept in
+        this serializer's order.  Raises ValueError for unknown fields"""
+        fields = frozenset(fields)
+        unknown = fields.difference(self.fields)
+        if unknown:
+            raise ValueError("Unknown fields: {}".format(", ".join(sorted(unknown))))
+        if fields not in self._subsets:
+            self._subsets[fields] = Serializer(self.model,
+                [field for field in self.fields if field in fields])
+        return self._subsets[fields]
+
+    def listed(self):
+        """Returns this serializer without its deferred fields, for list
+        endpoints.  Clients get those with the fields arg, or per resource"""
+        if not self.deferred_fields:
+            return self
+        return self.only(field for field in self.fields
+            if field not in self.deferred_fields)
+
+    def from_values(self, values):
+        """Returns the dict for a tuple of field values"""
+        if orjson is None and self.datetime_positions:
+            values = list(values)
+            for position in self.datetime_positions:
+                if values[position] is not None:
+                    values[position] = values[position].isoformat()
+        return dict(zip(self.fields, values))
+
+    def row(self, instance):
+        """Returns the dict for one instance or row"""
+        return self.from_values(self._values(instance))
+
+    def rows(self, instances):
+        """Returns a list of dicts for an iterable of instances or rows"""
+        values = self._values
+        return [self.from_values(values(instance)) for instance in instances]
+
+
+election = Serializer(models.Election, ["id", "title", "description_short",
+    "description_long", "start_date", "last_modified", "elect_open",
+    "default_election_type", "admin_id", "icon_small_location"])
+race = Serializer(models.Race, ["id", "title", "description_short",
+    "description_long", "icon_small_location", "election_id", "election_type",
+    "start_date", "last_modified"])
+candidate = Serializer(models.Candidate, ["id", "title", "description_short",
+    "description_long", "icon_small_location", "race_id", "start_date",
+    "last_modified"])
+vote = Serializer(models.Vote, ["id", "value", "candidate_id", "user_id",
+    "race_id", "start_date", "last_modified"])
+user = Serializer(models.User, ["id", "name", "email", "password",
+    "start_date", "last_modified"])
+election_type = Serializer(models.ElectionType, ["election_type", "title",
+    "description_short", "description_long", "last_modified"])
+results = Serializer(models.Results, ["id", "race_id", "election_type",
+    "results", "start_date", "last_modified"])
+pairwise_count = Serializer(models.PairwiseCount, ["race_id", "cand1_id",
+    "cand2_id", "num_users_prefer"])
+candidate_tally = Serializer(models.CandidateTally, ["candidate_id", "race_id",
+    "vote_sum", "vote_count", "version"])
+race_tally = Serializer(models.RaceTally, ["race_id", "version"])
@@ -1,10 +1,15 @@
 import os.path
 import datetime
+from collections import Counter
 
 # from eLect.main import app
+from sqlalchemy import text
 from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert
 # For some reason, it will not let me import models when utils is imported into models.py
 from . import models
+from . import pairwise
+from eLect.custom_exceptions import *
 from eLect.database import Base, engine, session
 
 def get_or_create(model, defaults=None, **kwargs):
@@ -24,9 +29,179 @@ def num_votes_cast(race_id):
     # TODO: Fix this query to simply return the count #, not a list of tuples
     num_votes_cast = session.query(
             func.count(models.Vote.id)).filter(
-            models.Vote.candidate.has(race_id = race_id)).all()[0][0] 
+            models.Vote.race_id == race_id).all()[0][0] 
     return num_votes_cast
 
+def race_ballot(race_id, user_id):
+    """Returns a user's ballot for a race, as a dict of {cand_id: value}"""
+    votes = session.query(
+        models.Vote.candidate_id,
+        models.Vote.value).filter(
+        models.Vote.race_id == race_id,
+        models.Vote.user_id == user_id).all()
+    return dict(votes)
+
+def check_race(race_id):
+    """Checks race conditions before attempting to tally votes. 
+    Failed test returns Exception"""
+    race = session.query(models.Race).get(race_id)
+    # Fix this query to simply return the count #, not a list of tuples
+    votes_cast = num_votes_cast(race_id)
+    if not race:
+        raise NoRaces("No race with id {}".format(race_id))
+    elif not race.candidates:
+        raise NoCandidates("No candidates found for race id {}".format(race_id))
+    elif race.race_open == True:
+        raise OpenElection("Race id {} in Election {} is still open.".format(
+            race_id, race.election_id))
+    elif votes_cast == 0:
+        raise NoVotes("No Votes cast in Race id {}".format(race_id))
+
+def pairwise_count_deltas(race_id, old_ballot, new_ballot):
+    """Returns the pairwise_count row changes for one user's ballot changing
+    from old_ballot to new_ballot: the old ballot's preferences subtracted
+    and the new ballot's added"""
+    delta = Counter(pairwise.ballot_pairs(new_ballot))
+    delta.subtract(pairwise.ballot_pairs(old_ballot))
+    return [{
+        "race_id": race_id,
+        "cand1_id": cand1,
+        "cand2_id": cand2,
+        "num_users_prefer": num_users_prefer}
+        for (cand1, cand2), num_users_prefer in delta.items() if num_users_prefer]
+
+def update_pairwise_counts(race_id, old_ballot, new_ballot):
+    """Updates a race's persisted pairwise counts for one user's ballot
+    changing from old_ballot to new_ballot, in the current transaction"""
+    rows = pairwise_count_deltas(race_id, old_ballot, new_ballot)
+    if not rows:
+        return
+
+    upsert = insert(models.PairwiseCount.__table__)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["race_id", "cand1_id", "cand2_id"],
+        set_={"num_users_prefer": models.PairwiseCount.num_users_prefer +
+            upsert.excluded.num_users_prefer})
+    session.execute(upsert, rows)
+
+# Casts a single vote in one statement.  The INSERT resolves race_id from
+# the candidate, only for open elections, and the vote table's unique indexes
+# reject repeat votes via ON CONFLICT DO NOTHING.  For ranked races, the same
+# statement adds the new vote's preferences against the user's earlier votes
+# to pairwise_count.  The user's advisory lock is taken by a statement of
+# its own first, so the INSERT's snapshot includes any concurrent vote by
+# the same user that committed while it waited.  The SQL is shared with
+# the async ingestion service.
+lock_user_sql = "SELECT pg_advisory_xact_lock(:user_id)"
+cast_vote_sql = """
+WITH new_vote AS (
+    INSERT INTO vote (user_id, candidate_id, race_id, value, start_date)
+    SELECT CAST(:user_id AS integer), candidate.id, candidate.race_id,
+        CAST(:value AS integer), CAST(:start_date AS timestamp)
+    FROM candidate
+    JOIN race ON race.id = candidate.race_id
+    JOIN election ON election.id = race.election_id
+    WHERE candidate.id = :candidate_id AND election.elect_open
+    ON CONFLICT DO NOTHING
+    RETURNING vote.*
+), pair_delta AS (
+    SELECT new_vote.race_id,
+        CASE WHEN new_vote.value > vote.value
+            THEN new_vote.candidate_id ELSE vote.candidate_id END AS cand1_id,
+        CASE WHEN new_vote.value > vote.value
+            THEN vote.candidate_id ELSE new_vote.candidate_id END AS cand2_id
+    FROM new_vote
+    JOIN vote ON vote.user_id = new_vote.user_id AND vote.race_id = new_vote.race_id
+    WHERE new_vote.ranked AND vote.value <> new_vote.value
+), pair_upsert AS (
+    INSERT INTO pairwise_count (race_id, cand1_id, cand2_id, num_users_prefer)
+    SELECT race_id, cand1_id, cand2_id, 1 FROM pair_delta
+    ON CONFLICT (race_id, cand1_id, cand2_id) DO UPDATE
+    SET num_users_prefer = pairwise_count.num_users_prefer + 1
+)
+SELECT new_vote.id, new_vote.value, new_vote.candidate_id, new_vote.user_id,
+    new_vote.race_id, new_vote.start_date, new_vote.last_modified,
+    race.election_id
+FROM new_vote JOIN race ON race.id = new_vote.race_id
+"""
+lock_user_statement = text(lock_user_sql)
+cast_vote_statement = text(cast_vote_sql)
+
+def lock_user_votes(user_id):
+    """Serializes vote writes by user_id until the current transaction ends,
+    so reading the user's ballot and adding to it can't interleave with a
+    concurrent request (see cast_vote_statement)"""
+    session.execute(lock_user_statement, {"user_id": user_id})
+
+def cast_vote(user_id, candidate_id, value):
+    """Inserts a vote with cast_vote_statement, in the current transaction,
+    holding the user's vote lock.  Returns the new vote's row, or None if the
+    candidate's election is closed or the user already voted for the
+    candidate / race"""
+    lock_user_votes(user_id)
+    return session.execute(cast_vote_statement, {
+        "user_id": user_id,
+        "candidate_id": candidate_id,
+        "value": value,
+        "start_date": datetime.datetime.utcnow()}).first()
+
+def rebuild_pairwise_counts(race_id):
+    """Rebuilds a race's persisted pairwise counts from its votes, for races
+    with votes written outside the API (seeding, imports, etc)"""
+    session.query(models.PairwiseCount).filter(
+        models.PairwiseCount.race_id == race_id).delete(synchronize_session=False)
+    session.execute(text(
+        "INSERT INTO pairwise_count (race_id, cand1_id, cand2_id, num_users_prefer) "
+        "SELECT :race_id, cand1_id, cand2_id, num_users_prefer "
+        "FROM elect_pairwise_counts(:race_id)"), {"race_id": race_id})
+
+def rebuild_vote_tallies(race_id):
+    """Rebuilds a race's candidate_tally rollup rows from its raw votes.
+    Returns the candidate ids whose rollup was out of step"""
+    votes = session.query(
+        models.Vote.candidate_id,
+        func.sum(models.Vote.value),
+        func.count(models.Vote.id)).filter(
+        models.Vote.race_id == race_id).group_by(
+        models.Vote.candidate_id).all()
+    expected = {cand: (vote_sum, vote_count) for cand, vote_sum, vote_count in votes}
+    rollup = session.query(
+        models.CandidateTally.candidate_id,
+        models.CandidateTally.vote_sum,
+        models.CandidateTally.vote_count).filter(
+        models.CandidateTally.race_id == race_id,
+        models.CandidateTally.vote_count > 0).all()
+    current = {cand: (vote_sum, vote_count) for cand, vote_sum, vote_count in rollup}
+    mismatched = sorted(cand for cand in set(expected) | set(current)
+        if expected.get(cand) != current.get(cand))
+
+    # The rebuilt rows start at version 0, so race_tally takes the whole
+    # version, which must still invalidate cached results
+    version = race_vote_version(race_id) + 1
+    session.query(models.CandidateTally).filter(
+        models.CandidateTally.race_id == race_id).delete(synchronize_session=False)
+    session.query(models.RaceTally).filter(
+        models.RaceTally.race_id == race_id).delete(synchronize_session=False)
+    session.bulk_insert_mappings(models.CandidateTally, [{
+        "candidate_id": cand,
+        "race_id": race_id,
+        "vote_sum": vote_sum,
+        "vote_count": vote_count,
+        "version": 0}
+        for cand, (vote_sum, vote_count) in expected.items()])
+    session.add(models.RaceTally(race_id=race_id, version=version))
+    return mismatched
+
+def race_vote_version(race_id):
+    """Returns the race's vote-set version: the candidate trigger's
+    race_tally.version plus the vote trigger's candidate_tally versions,
+    which grows on every change that can alter the race's tally"""
+    candidates_version = session.query(models.RaceTally.version).filter(
+        models.RaceTally.race_id == race_id).scalar()
+    votes_version = session.query(func.sum(models.CandidateTally.version)).filter(
+        models.CandidateTally.race_id == race_id).scalar()
+    return int((candidates_version or 0) + (votes_version or 0))
+
 def dict_keys_to_str(dict):
     """Util to convert dictionary keys to strings"""
     converted = {str(key): value for key, value in dict}
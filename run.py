@@ -1,11 +1,24 @@
+import asyncio
+import datetime
+import json
 import os
+import time
+from collections import Counter
 
 # Change this to DevelopmentConfig when not testing
 os.environ["CONFIG_PATH"] = "eLect.config.TestingConfig"
 
 from flask_script import Manager
 from eLect.main import app
+from eLect import models
+from eLect import utils
+from eLect import parallel
+from eLect import importer
+from eLect import migrations
+from eLect import serializers
+from eLect.journal import get_journal
 from eLect.database import Base, engine, session
+from eLect.electiontypes import get_tally_engine, WinnerTakeAll
 from tests.api_tests import TestAPI
 
 manager = Manager(app)
@@ -18,8 +31,204 @@ def seed_db():
     testapi = TestAPI()
     testapi.populate_database()
 
+@manager.command
+def benchmark_pair_builders(race_id, repeat=5):
+    """Times each Schulze pair builder on a race and checks they agree with
+    the first, "join".  Builders that fail, e.g. for an unreachable
+    VOTE_SHARD_DATABASE_URIS database, are skipped with a note"""
+    schulze = get_tally_engine("Schulze")
+    race = session.query(models.Race).get(int(race_id))
+    reference = None
+    for pair_builder in schulze.pair_builders:
+        timings = []
+        try:
+            for i in range(int(repeat)):
+                start = time.perf_counter()
+                pair_results = schulze.gen_pair_results(race, pair_builder)
+                timings.append(time.perf_counter() - start)
+        except Exception as e:
+            session.rollback()
+            print("{:<10} skipped: {}".format(pair_builder, e))
+            continue
+        if reference is None:
+            reference = pair_results
+        print("{:<10} best {:.4f}s  mean {:.4f}s  {}".format(
+            pair_builder,
+            min(timings),
+            sum(timings) / len(timings),
+            "ok" if pair_results == reference else "MISMATCH"))
+
+@manager.command
+def benchmark_serializers(rows=100000, repeat=5):
+    """Times JSON encoding of rows candidates with as_dictionary() and
+    json_serial against the serializers module, and checks they agree"""
+    now = datetime.datetime.utcnow()
+    candidates = [models.Candidate(id=i, title="Candidate {}".format(i),
+        description_short="Short description", description_long="Long description",
+        race_id=1, start_date=now, last_modified=now) for i in range(int(rows))]
+
+    def as_dictionary():
+        return json.dumps([candidate.as_dictionary() for candidate in candidates],
+            default=utils.json_serial)
+
+    def serializer():
+        return serializers.dumps(serializers.candidate.rows(candidates))
+
+    reference = None
+    for name, encode in [("as_dictionary", as_dictionary), ("serializers", serializer)]:
+        timings = []
+        for i in range(int(repeat)):
+            start = time.perf_counter()
+            data = encode()
+            timings.append(time.perf_counter() - start)
+        data = json.loads(data)
+        if reference is None:
+            reference = data
+        print("{:<14} best {:.4f}s  mean {:.4f}s  {}".format(
+            name,
+            min(timings),
+            sum(timings) / len(timings),
+            "ok" if data == reference else "MISMATCH"))
+
+@manager.command
+def rebuild_pairwise_counts(race_id=None):
+    """Rebuilds persisted pairwise counts from the vote table, for one race
+    or for every race"""
+    if race_id:
+        race_ids = [int(race_id)]
+    else:
+        race_ids = [race_id for race_id, in session.query(models.Race.id)]
+    for race_id in race_ids:
+        utils.rebuild_pairwise_counts(race_id)
+    session.commit()
+    print("Rebuilt pairwise counts for {} races".format(len(race_ids)))
+
+@manager.command
+def check_vote_tallies(race_id=None):
+    """Rebuilds the candidate_tally rollups from the vote table,
+    for one race or for every race, reporting any that were out of step"""
+    if race_id:
+        race_ids = [int(race_id)]
+    else:
+        race_ids = [race_id for race_id, in session.query(models.Race.id)]
+    for race_id in race_ids:
+        mismatched = utils.rebuild_vote_tallies(race_id)
+        if mismatched:
+            print("Race {}: rebuilt rollup for candidates {}".format(
+                race_id, mismatched))
+    session.commit()
+    print("Checked vote tallies for {} races".format(len(race_ids)))
+
+@manager.command
+def tally_election(elect_id, workers=0):
+    """Tallies every race in an election across a process pool, storing the
+    Results and printing each race's tally time"""
+    start = time.perf_counter()
+    tallies = parallel.tally_election(int(elect_id), int(workers) or None)
+    for tally in tallies:
+        print("Race {:<8} {:>9.4f}s  {}".format(
+            tally["race_id"],
+            tally["seconds"],
+            tally.get("results", tally.get("message"))))
+    print("Tallied {} races in {:.4f}s".format(
+        len(tallies), time.perf_counter() - start))
+
+@manager.command
+def import_votes(path, file_format=None, rejects_path=None):
+    """Bulk loads votes from a CSV (user_id,candidate_id,value header) or
+    NDJSON file with COPY, writing rejected lines to a side file"""
+    stats = importer.import_votes(path, file_format, rejects_path)
+    print("Imported {} votes into {} races in {:.2f}s ({:.0f} rows/s)".format(
+        stats["rows"], stats["races"], stats["seconds"], stats["rows_per_second"]))
+    if stats["rejected"]:
+        print("Rejected {} lines, see {}".format(
+            stats["rejected"], stats["rejects_path"]))
+
+@manager.command
+def migrate():
+    """Adds the columns and indexes introduced since an existing database
+    was created"""
+    index_names = migrations.migrate()
+    print("Migrated, {} indexes in place".format(len(index_names)))
+
+@manager.command
+def benchmark_ingest(flask_url="http://localhost:8080",
+        ingest_url="http://localhost:8081", votes=5000, concurrency=500):
+    """Posts votes concurrently to the Flask API and to the asyncio ingestion
+    service, both already running against this database, and compares
+    their requests per second and latencies.  Each gets its own new users
+    voting in a new open race"""
+    import aiohttp
+
+    votes = int(votes)
+    concurrency = int(concurrency)
+    if not session.query(models.ElectionType).get("WTA"):
+        session.add(WinnerTakeAll())
+    session.execute(models.User.__table__.insert(), [{
+        "name": "Benchmark voter {}".format(i),
+        "email": "benchmark-{}-{}@eLect.com".format(time.time(), i),
+        "password": "benchmark"}
+        for i in range(2 * votes)])
+    user_ids = [user_id for user_id, in session.query(models.User.id).order_by(
+        models.User.id.desc()).limit(2 * votes)]
+    election = models.Election(title="Ingest benchmark", admin_id=user_ids[0])
+    race = models.Race(title="Ingest benchmark", election=election)
+    candidates = [models.Candidate(title="Candidate {}".format(i), race=race)
+        for i in range(10)]
+    session.add_all([election, race] + candidates)
+    session.commit()
+    cand_ids = [candidate.id for candidate in candidates]
+
+    async def post_votes(url, voters):
+        semaphore = asyncio.Semaphore(concurrency)
+        statuses = Counter()
+        latencies = []
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as client:
+            async def post(position, user_id):
+                vote = {
+                "user_id": user_id,
+                "candidate_id": cand_ids[position % len(cand_ids)],
+                "value": 1,
+                }
+                async with semaphore:
+                    start = time.perf_counter()
+                    async with client.post(url + "/api/votes", json=vote,
+                            headers={"Accept": "application/json"}) as response:
+                        await response.read()
+                    latencies.append(time.perf_counter() - start)
+                    statuses[response.status] += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(post(position, user_id)
+                for position, user_id in enumerate(voters)))
+            seconds = time.perf_counter() - start
+        return seconds, sorted(latencies), statuses
+
+    loop = asyncio.get_event_loop()
+    for name, url, voters in [
+            ("flask", flask_url, user_ids[:votes]),
+            ("asyncio", ingest_url, user_ids[votes:])]:
+        seconds, latencies, statuses = loop.run_until_complete(post_votes(url, voters))
+        print("{:<8} {:>8.0f} req/s  p50 {:>8.1f}ms  p99 {:>8.1f}ms  {}".format(
+            name,
+            len(latencies) / seconds,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(0.99 * (len(latencies) - 1))] * 1000,
+            dict(statuses)))
+
+@manager.command
+def run_ingest():
+    """Runs the asyncio vote ingestion service (see eLect/async_ingest.py)"""
+    from eLect import async_ingest
+    port = int(os.environ.get('INGEST_PORT', 8081))
+    async_ingest.run(port=port)
+
 @manager.command
 def run():
+    # Replays any journaled votes left over from the last run.  Otherwise
+    # the journal starts with the first request that uses it
+    get_journal()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
 
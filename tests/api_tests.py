@@ -1,7 +1,10 @@
 import unittest
+import asyncio
 import os
 import shutil
 import json
+import random
+import threading
 try: from urllib.parse import urlparse
 except ImportError: from urlparse import urlparse # Py2 compatibility
 from io import StringIO
@@ -12,13 +15,34 @@ import sys
 # Configure our app to use the testing database
 os.environ["CONFIG_PATH"] = "eLect.config.TestingConfig"
 
+import sqlalchemy
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import aliased
+from sqlalchemy import text
+from sqlalchemy.sql import select
 from eLect.main import app
 from eLect.custom_exceptions import *
 from eLect import models
+from eLect import api
 from eLect import utils
+from eLect import ballots
+from eLect import parallel
+from eLect import pairwise
+from eLect import importer
+from eLect import migrations
+from eLect import journal
+from eLect import serializers
+from eLect import database
 from eLect.database import Base, engine, session
 from eLect.electiontypes import WinnerTakeAll, Proportional, Schulze
+from eLect.electiontypes import TallyEngine, TALLY_ENGINES
+from eLect.electiontypes import register_tally_engine, get_tally_engine
+from eLect.electiontypes import candidate_vote_sums, race_vote_total
+try:
+    from aiohttp.test_utils import TestClient, TestServer
+    from eLect import async_ingest
+except ImportError:
+    async_ingest = None
 
 
 
@@ -28,6 +52,10 @@ class TestAPI(unittest.TestCase):
     def setUp(self):
         """ Test setup """
         self.client = app.test_client()
+        # Test requests share the app context, and so the test's session,
+        # instead of removing the session when each one ends
+        self.app_context = app.app_context()
+        self.app_context.push()
 
         # Drop all residual tables and data
         Base.metadata.drop_all(engine)
@@ -238,6 +266,139 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(len(candidates), 4)
         self.assertEqual(candidates[0]["title"], "Candidate BA")
 
+    def test_get_candidates_paginated(self):
+        """ Paging through a race's candidates with limit and after """
+        self.populate_database()
+        candidate_ids = []
+        url = "/api/races/{}/candidates?limit=3".format(self.raceB.id)
+        while url:
+            response = self.client.get(url,
+                headers=[("Accept", "application/json")])
+            self.assertEqual(response.status_code, 200)
+            candidates = json.loads(response.data.decode("ascii"))
+            self.assertTrue(len(candidates) <= 3)
+            candidate_ids.extend(candidate["id"] for candidate in candidates)
+
+            link = response.headers.get("Link")
+            url = link[1:link.index(">")] if link else None
+            if url:
+                self.assertIn('rel="next"', link)
+                self.assertIn("after={}".format(candidates[-1]["id"]), url)
+
+        self.assertEqual(candidate_ids, [self.candidateBA.id, self.candidateBB.id,
+            self.candidateBC.id, self.candidateBD.id])
+
+        response = self.client.get("/api/races/{}/candidates?limit=0&after={}".format(
+            self.raceB.id, self.candidateBC.id),
+            headers=[("Accept", "application/json")])
+        candidates = json.loads(response.data.decode("ascii"))
+        self.assertEqual([candidate["id"] for candidate in candidates],
+            [self.candidateBD.id])
+        self.assertEqual(response.headers.get("Link"), None)
+
+    def test_get_candidates_unpaginated(self):
+        """ Getting every candidate of a race without limit or after, even
+        past DEFAULT_PAGE_SIZE """
+        self.populate_database()
+        default_page_size = app.config["DEFAULT_PAGE_SIZE"]
+        app.config["DEFAULT_PAGE_SIZE"] = 2
+        try:
+            response = self.client.get("/api/races/{}/candidates".format(self.raceB.id),
+                headers=[("Accept", "application/json")])
+        finally:
+            app.config["DEFAULT_PAGE_SIZE"] = default_page_size
+        self.assertEqual(response.status_code, 200)
+        candidates = json.loads(response.data.decode("ascii"))
+        self.assertEqual([candidate["id"] for candidate in candidates],
+            [self.candidateBA.id, self.candidateBB.id,
+            self.candidateBC.id, self.candidateBD.id])
+        self.assertEqual(response.headers.get("Link"), None)
+
+    def test_get_candidates_fields(self):
+        """ Getting only some of a race's candidates' fields """
+        self.populate_database()
+        url = "/api/races/{}/candidates?fields=title,race_id&limit=2".format(
+            self.raceB.id)
+        response = self.client.get(url,
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        candidates = json.loads(response.data.decode("ascii"))
+        self.assertEqual(candidates, [
+            {"id": self.candidateBA.id, "title": self.candidateBA.title,
+                "race_id": self.raceB.id},
+            {"id": self.candidateBB.id, "title": self.candidateBB.title,
+                "race_id": self.raceB.id}])
+        self.assertIn("fields=title", response.headers.get("Link"))
+
+        response = self.client.get("/api/candidates/{}?fields=description_long".format(
+            self.candidateBA.id),
+            headers=[("Accept", "application/json")])
+        candidate = json.loads(response.data.decode("ascii"))
+        self.assertEqual(candidate, {"id": self.candidateBA.id,
+            "description_long": self.candidateBA.description_long})
+
+        response = self.client.get("/api/races/{}/candidates?fields=title,bogus".format(
+            self.raceB.id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data.decode("ascii"))
+        self.assertEqual(data["message"], "Unknown fields: bogus")
+
+        # Lists leave the deferred columns out unless asked for them
+        response = self.client.get("/api/races/{}/candidates".format(self.raceB.id),
+            headers=[("Accept", "application/json")])
+        candidates = json.loads(response.data.decode("ascii"))
+        self.assertNotIn("description_long", candidates[0])
+        self.assertEqual(candidates[0]["description_short"],
+            self.candidateBA.description_short)
+        response = self.client.get("/api/candidates/{}".format(self.candidateBA.id),
+            headers=[("Accept", "application/json")])
+        candidate = json.loads(response.data.decode("ascii"))
+        self.assertEqual(candidate["description_long"], self.candidateBA.description_long)
+
+        # The large text columns are deferred
+        session.expunge_all()
+        candidate = session.query(models.Candidate).get(self.candidateBA.id)
+        self.assertIn("description_long", sqlalchemy.inspect(candidate).unloaded)
+
+    def test_get_votes_streamed(self):
+        """ Streaming a race's votes as NDJSON, and as a JSON list """
+        self.populate_database(election_type="Schulze")
+        for user in [self.userA, self.userB, self.userC]:
+            for value, candidate in enumerate([self.candidateBA, self.candidateBB,
+                    self.candidateBC]):
+                session.add(models.Vote(
+                    user_id = user.id,
+                    candidate_id = candidate.id,
+                    value = value))
+        session.commit()
+        url = "/api/races/{}/votes".format(self.raceB.id)
+
+        response = self.client.get(url,
+            headers=[("Accept", "application/json")])
+        votes = json.loads(response.data.decode("ascii"))
+        self.assertEqual(len(votes), 9)
+
+        app.config["STREAM_CHUNK_ROWS"] = 4
+        try:
+            response = self.client.get(url,
+                headers=[("Accept", "application/x-ndjson")])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            lines = response.data.decode("ascii").splitlines()
+            self.assertEqual([json.loads(line) for line in lines], votes)
+
+            response = self.client.get(url + "?stream=1",
+                headers=[("Accept", "application/json")])
+            self.assertEqual(response.mimetype, "application/json")
+            self.assertEqual(json.loads(response.data.decode("ascii")), votes)
+
+            response = self.client.get(url + "?stream=1&after={}".format(votes[-1]["id"]),
+                headers=[("Accept", "application/json")])
+            self.assertEqual(json.loads(response.data.decode("ascii")), [])
+        finally:
+            app.config["STREAM_CHUNK_ROWS"] = 1000
+
     def test_get_candidate(self):
         """ Testing GET method on /api/candidates endpoint for single candidate"""
         self.populate_database()
@@ -259,6 +420,50 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(candidate["race_id"], self.candidateBB.race_id)
         self.assertEqual(candidate_long["race_id"], self.candidateBB.race_id)
 
+    def test_get_conditional(self):
+        """ Conditional GETs answer 304 until the resource changes """
+        self.populate_database()
+        url = "/api/candidates/{}".format(self.candidateBB.id)
+        response = self.client.get(url,
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        self.assertNotEqual(etag, None)
+        self.assertNotEqual(last_modified, None)
+
+        response = self.client.get(url, headers=[("Accept", "application/json"),
+            ("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        response = self.client.get(url, headers=[("Accept", "application/json"),
+            ("If-Modified-Since", last_modified)])
+        self.assertEqual(response.status_code, 304)
+
+        list_url = "/api/races/{}/candidates".format(self.raceB.id)
+        response = self.client.get(list_url,
+            headers=[("Accept", "application/json")])
+        list_etag = response.headers.get("ETag")
+        self.assertEqual(response.headers.get("Last-Modified"), None)
+        response = self.client.get(list_url, headers=[("Accept", "application/json"),
+            ("If-None-Match", list_etag)])
+        self.assertEqual(response.status_code, 304)
+
+        # Other representations of the resource have their own ETags
+        response = self.client.get(url + "?fields=title",
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 200)
+
+        self.candidateBB.title = "Candidate BB renamed"
+        session.commit()
+        response = self.client.get(url, headers=[("Accept", "application/json"),
+            ("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+        response = self.client.get(list_url, headers=[("Accept", "application/json"),
+            ("If-None-Match", list_etag)])
+        self.assertEqual(response.status_code, 200)
+
     def test_get_nonexistant_data(self):
         """ Tests GET requests for nonexistant data """
         response = self.client.get("/api/elections/1",
@@ -269,6 +474,12 @@ class TestAPI(unittest.TestCase):
 
         data = json.loads(response.data.decode("ascii"))
         self.assertEqual(data["message"], "Could not find election with id 1")
+        self.assertEqual(response.headers.get("ETag"), None)
+
+        # Missing resources have no validators to match
+        response = self.client.get("/api/elections/1",
+            headers=[("Accept", "application/json"), ("If-None-Match", "*")])
+        self.assertEqual(response.status_code, 404)
 
     def test_post_user(self):
         """Test POST method for Users"""
@@ -515,6 +726,174 @@ class TestAPI(unittest.TestCase):
         "User with id {} has already voted for candidate with id {}.".format(
             userA.id, candidateA.id))
 
+        # An unknown user trips the vote's user foreign key
+        data = {
+        "value": 1,
+        "user_id": 999999,
+        "candidate_id": candidateA.id
+        }
+        response = self.client.post("/api/votes",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data.decode("ascii"))
+        self.assertEqual(data["message"], "Could not find user with id 999999")
+
+        # Vote values are whole numbers
+        data = {
+        "value": 2.5,
+        "user_id": userA.id,
+        "candidate_id": candidateA.id
+        }
+        response = self.client.post("/api/votes",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 422)
+
+        # Other integrity errors aren't reported as unknown users
+        with self.assertRaises(IntegrityError) as raised:
+            session.execute(models.Vote.__table__.insert().values(
+                user_id=userA.id, candidate_id=999999, value=1))
+        session.rollback()
+        self.assertFalse(api.unknown_user_error(raised.exception))
+
+    def test_POST_ballot(self):
+        """Test POST method for a whole ranked ballot, and its validation"""
+        self.populate_database(election_type="Schulze")
+        self.raceB.max_vote_val = 4
+        session.commit()
+        self.assertEqual(self.raceB.max_vote_val, 4)
+
+        data = {
+        "user_id": self.userA.id,
+        "votes": [
+            {"candidate_id": self.candidateBA.id, "value": 4},
+            {"candidate_id": self.candidateBB.id, "value": 0},
+            {"candidate_id": self.candidateBC.id, "value": 3},
+            {"candidate_id": self.candidateBD.id, "value": 1}]
+        }
+
+        response = self.client.post("/api/races/{}/ballot".format(self.raceB.id),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(urlparse(response.headers.get("Location")).path,
+            "/api/races/{}".format(self.raceB.id))
+
+        ballot = json.loads(response.data.decode("ascii"))
+        self.assertEqual(ballot["user_id"], self.userA.id)
+        self.assertEqual(len(ballot["votes"]), 4)
+
+        votes = session.query(models.Vote).filter(
+            models.Vote.user_id == self.userA.id).all()
+        self.assertEqual(len(votes), 4)
+        self.assertTrue(all(vote.race_id == self.raceB.id for vote in votes))
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+
+        # Same ballot again
+        response = self.client.post("/api/races/{}/ballot".format(self.raceB.id),
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 403)
+        data = json.loads(response.data.decode("ascii"))
+        self.assertEqual(data["message"],
+        "User with id {} has already voted for candidate with id {}.".format(
+            self.userA.id, self.candidateBA.id))
+
+        # Out of range value, and a candidate from another race
+        for cand_id, value in [(self.candidateBA.id, 5), (self.candidateAA.id, 1)]:
+            data = {
+            "user_id": self.userB.id,
+            "votes": [
+                {"candidate_id": self.candidateBB.id, "value": 2},
+                {"candidate_id": cand_id, "value": value}]
+            }
+            response = self.client.post("/api/races/{}/ballot".format(self.raceB.id),
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 422)
+
+        votes = session.query(models.Vote).filter(
+            models.Vote.user_id == self.userB.id).all()
+        self.assertEqual(len(votes), 0)
+
+    def test_vote_unique_indexes(self):
+        """Test repeat votes are rejected by the vote table's unique indexes,
+        and by POST /api/votes with the matching messages"""
+        self.populate_database()
+        session.add(models.Vote(
+            user_id = self.userA.id,
+            candidate_id = self.candidateAA.id,
+            value = 1))
+        session.commit()
+
+        # Second vote in a WTA race, by the ORM and by the API
+        session.add(models.Vote(
+            user_id = self.userA.id,
+            candidate_id = self.candidateAB.id,
+            value = 1))
+        self.assertRaises(IntegrityError, session.commit)
+        session.rollback()
+
+        data = {
+        "value": 1,
+        "user_id": self.userA.id,
+        "candidate_id": self.candidateAB.id
+        }
+        response = self.client.post("/api/votes",
+            data=json.dumps(data),
+            content_type="application/json",
+            headers=[("Accept", "application/json")]
+        )
+        self.assertEqual(response.status_code, 403)
+        data = json.loads(response.data.decode("ascii"))
+        self.assertEqual(data["message"],
+        "User with id {} has already voted in race id {}.".format(
+            self.userA.id, self.raceA.id))
+
+        # Ranked races take one vote per candidate
+        self.raceB.election_type = "Schulze"
+        session.commit()
+        for candidate in [self.candidateBA, self.candidateBB]:
+            data = {
+            "value": 1 if candidate is self.candidateBA else 0,
+            "user_id": self.userA.id,
+            "candidate_id": candidate.id
+            }
+            response = self.client.post("/api/votes",
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")]
+            )
+            self.assertEqual(response.status_code, 201)
+
+        votes = session.query(models.Vote).filter(
+            models.Vote.race_id == self.raceB.id).all()
+        self.assertEqual(len(votes), 2)
+        self.assertTrue(all(vote.ranked for vote in votes))
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            {(self.candidateBA.id, self.candidateBB.id): 1})
+
+        # Can't drop rankings while a user has several votes in the race
+        self.raceB.election_type = "WTA"
+        self.assertRaises(IntegrityError, session.commit)
+        session.rollback()
+
     def test_invalid_header_data(self):
         """Tests invalid JSON schema for POST/PUT endpoints"""
         elect_data = {
@@ -862,6 +1241,15 @@ class TestAPI(unittest.TestCase):
         """Test standard Schulze tally """
         self.populate_database(election_type="Schulze")
 
+        # Both path engines find no results before any votes are cast
+        for path_engine in ["matrix", "dict"]:
+            results = self.schulze.tally_race(self.raceB.id, path_engine=path_engine)
+            self.assertEqual(results, {})
+            self.assertEqual(self.schulze.engine.rank_race(self.raceB.id,
+                path_engine=path_engine), [])
+            with self.assertRaises(NoResults):
+                self.schulze.check_results(results)
+
         uAvote1 = models.Vote(
             user = self.userA,
             candidate = self.candidateBA,
@@ -913,7 +1301,23 @@ class TestAPI(unittest.TestCase):
             candidate = self.candidateBD,
             value = 3)
         # Check gen_pair_results() method in Schulze()
-        cand_pair_results = self.schulze.gen_pair_results(self.raceB)
+        cand_pair_results = self.schulze.engine.gen_pair_results(self.raceB)
+        # Every pair builder must return exactly the same dict
+        self.assertEqual(cand_pair_results,
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+        self.assertEqual(cand_pair_results,
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"))
+        self.assertEqual(cand_pair_results,
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="database"))
+        self.assertEqual(cand_pair_results,
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="matrix"))
+
+        # One int32 row per voter, one column per candidate
+        ballot_matrix = ballots.load_ballot_matrix(self.raceB.id)
+        self.assertEqual(ballot_matrix.ballots.shape, (3, 4))
+        self.assertEqual(ballot_matrix.ballots.dtype, "int32")
+        self.assertEqual(ballot_matrix.ballots[0][
+            ballot_matrix.candidate_index[self.candidateBA.id]], 5)
         # Generate expected pair_results dict for comparitive purposes
         vote2 = aliased(models.Vote, name="vote2")
         expected_pair_results = {}
@@ -934,6 +1338,12 @@ class TestAPI(unittest.TestCase):
                 expected_pair_results[(cand1, cand2)])
 
         final_result = self.schulze.tally_race(self.raceB.id)
+        # The reference dict engine must agree with the matrix engine
+        self.assertEqual(final_result,
+            self.schulze.tally_race(self.raceB.id, path_engine="dict"))
+        self.assertEqual(self.schulze.engine.rank_race(self.raceB.id),
+            self.schulze.engine.rank_race(self.raceB.id, path_engine="dict"))
+        self.assertEqual(self.schulze.engine.rank_race(self.raceB.id)[0], 3)
 
         self.dbresults = models.Results(
             race_id = self.raceB.id,
@@ -954,10 +1364,829 @@ class TestAPI(unittest.TestCase):
 
 
 
+    def test_pairwise_counts_persisted(self):
+        """Test the pairwise counts kept up to date by the vote endpoints"""
+        self.populate_database(election_type="Schulze")
+        candidates = [self.candidateBA, self.candidateBB,
+            self.candidateBC, self.candidateBD]
+        ballots = {
+            self.userA.id: [5, 0, 3, -2],
+            self.userB.id: [6, 1, -2, 5],
+            self.userC.id: [-2, 5, 2, 3]}
+
+        for user_id, values in ballots.items():
+            for candidate, value in zip(candidates, values):
+                data = {
+                "value": value,
+                "user_id": user_id,
+                "candidate_id": candidate.id
+                }
+                response = self.client.post("/api/votes",
+                    data=json.dumps(data),
+                    content_type="application/json",
+                    headers=[("Accept", "application/json")])
+                self.assertEqual(response.status_code, 201)
+
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"))
+
+        # Edit, then delete one of userA's votes
+        vote = session.query(models.Vote).filter(
+            models.Vote.user_id == self.userA.id,
+            models.Vote.candidate_id == self.candidateBD.id).first()
+        response = self.client.put("/api/votes",
+            data=json.dumps({"id": vote.id, "value": 7}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"))
+
+        response = self.client.delete("/api/votes",
+            data=json.dumps({"id": vote.id}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"))
+
+    def test_pairwise_counts_concurrent_edits(self):
+        """Test concurrent edits and deletes of one user's votes wait for
+        each other, so the pairwise counts don't drift"""
+        self.populate_database(election_type="Schulze")
+        votes = []
+        for candidate, value in zip([self.candidateBA, self.candidateBB,
+                self.candidateBC, self.candidateBD], [5, 0, 3, -2]):
+            response = self.client.post("/api/votes",
+                data=json.dumps({
+                    "value": value,
+                    "user_id": self.userA.id,
+                    "candidate_id": candidate.id}),
+                content_type="application/json",
+                headers=[("Accept", "application/json")])
+            self.assertEqual(response.status_code, 201)
+            votes.append(json.loads(response.data.decode("ascii"))["id"])
+        session.commit()
+
+        statuses = []
+        def send(method, data):
+            client = app.test_client()
+            response = client.open("/api/votes", method=method,
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")])
+            statuses.append(response.status_code)
+
+        # Holds userA's vote lock while both requests start
+        with engine.connect() as connection:
+            transaction = connection.begin()
+            connection.execute(text(utils.lock_user_sql), {"user_id": self.userA.id})
+            threads = [
+                threading.Thread(target=send, args=("PUT", {"id": votes[0], "value": -5})),
+                threading.Thread(target=send, args=("DELETE", {"id": votes[1]}))]
+            for thread in threads:
+                thread.start()
+            threads[0].join(0.5)
+            self.assertEqual(statuses, [])
+            transaction.commit()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(statuses), [200, 200])
+        session.expire_all()
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"))
+
+    def test_vote_tally_rollup(self):
+        """Test the candidate_tally rollups kept by the vote trigger, and
+        that votes don't write the race's race_tally row"""
+        self.populate_database(election_type="Proportional")
+        race_version = session.query(models.RaceTally.version).filter(
+            models.RaceTally.race_id == self.raceA.id).scalar()
+        versions = [utils.race_vote_version(self.raceA.id)]
+        voteA1 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userA.id)
+        voteA2 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userB.id)
+        voteA3 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAB.id,
+            user_id = self.userC.id)
+        session.add_all([voteA1, voteA2, voteA3])
+        session.commit()
+
+        self.assertEqual(sorted(candidate_vote_sums(self.raceA.id)),
+            sorted(candidate_vote_sums(self.raceA.id, source="votes")))
+        self.assertEqual(sorted(candidate_vote_sums(self.raceA.id)),
+            sorted(candidate_vote_sums(self.raceA.id, source="matrix")))
+        self.assertEqual(race_vote_total(self.raceA.id), 3)
+        self.assertEqual(race_vote_total(self.raceA.id, source="matrix"), 3)
+        self.assertEqual(session.query(models.RaceTally.version).filter(
+            models.RaceTally.race_id == self.raceA.id).scalar(), race_version)
+        versions.append(utils.race_vote_version(self.raceA.id))
+
+        # Updates and deletes must be rolled up too
+        voteA2.candidate_id = self.candidateAB.id
+        session.delete(voteA3)
+        session.commit()
+        self.assertEqual(sorted(candidate_vote_sums(self.raceA.id)),
+            sorted(candidate_vote_sums(self.raceA.id, source="votes")))
+        self.assertEqual(race_vote_total(self.raceA.id), 2)
+        versions.append(utils.race_vote_version(self.raceA.id))
+
+        # The rollup is consistent, so the rebuild finds nothing to fix
+        self.assertEqual(utils.rebuild_vote_tallies(self.raceA.id), [])
+        session.commit()
+        self.assertEqual(race_vote_total(self.raceA.id), 2)
+        versions.append(utils.race_vote_version(self.raceA.id))
+
+        # A candidate leaving the race takes its rollup with it, and the
+        # race's version still grows
+        session.delete(voteA1)
+        session.delete(voteA2)
+        session.delete(self.candidateAA)
+        session.commit()
+        versions.append(utils.race_vote_version(self.raceA.id))
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_tally_results_cache(self):
+        """Test tally results cached in Results, keyed by vote-set version"""
+        self.populate_database()
+        voteA1 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userA.id)
+        voteA2 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userB.id)
+        voteA3 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAB.id,
+            user_id = self.userC.id)
+        session.add_all([voteA1, voteA2, voteA3])
+        self.electionA.elect_open = False
+        session.commit()
+
+        response = self.client.get("/api/races/{}/tally".format(self.raceA.id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode("ascii")), {"1": 2})
+        self.assertEqual(response.headers.get("Cache-Control"), "no-cache")
+        etag = response.headers.get("ETag")
+
+        cached = session.query(models.Results).filter(
+            models.Results.race_id == self.raceA.id).all()
+        self.assertEqual(len(cached), 1)
+        self.assertEqual(cached[0].results, {"1": 2})
+        self.assertEqual(cached[0].vote_version,
+            utils.race_vote_version(self.raceA.id))
+
+        response = self.client.get("/api/races/{}/tally".format(self.raceA.id),
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 304)
+
+        # Any vote mutation invalidates the cached tally
+        voteA3.candidate_id = self.candidateAA.id
+        session.commit()
+        response = self.client.get("/api/races/{}/tally".format(self.raceA.id),
+            headers=[("Accept", "application/json"), ("If-None-Match", etag)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode("ascii")), {"1": 3})
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+
+    def test_tally_election(self):
+        """Test tallying every race of an election in parallel, and the
+        election tally endpoint serving stored results"""
+        self.populate_database()
+        voteA1 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userA.id)
+        voteA2 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAA.id,
+            user_id = self.userB.id)
+        voteA3 = models.Vote(
+            value = 1,
+            candidate_id = self.candidateAB.id,
+            user_id = self.userC.id)
+        session.add_all([voteA1, voteA2, voteA3])
+        self.electionA.elect_open = False
+        session.commit()
+        elect_id, race_id = self.electionA.id, self.raceA.id
+
+        # The first request queues the tally in the background
+        response = self.client.get("/api/elections/{}/tally".format(elect_id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data.decode("ascii"))
+        self.assertEqual(data["pending_race_ids"], [race_id])
+        # Waits for the single background thread to finish the queued tally
+        parallel._background.submit(int).result()
+
+        response = self.client.get("/api/elections/{}/tally".format(elect_id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+
+        tallies = json.loads(response.data.decode("ascii"))
+        self.assertEqual(len(tallies), 1)
+        self.assertEqual(tallies[0]["race_id"], race_id)
+        self.assertEqual(tallies[0]["results"], {"1": 2})
+
+        results = session.query(models.Results).filter(
+            models.Results.race_id == race_id).all()
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].results, {"1": 2})
+
+        # The tally_election command tallies in a process pool
+        tallies = parallel.tally_election(elect_id)
+        self.assertEqual(tallies[0]["results"], {1: 2})
+        self.assertIn("seconds", tallies[0])
+
+    def test_ballot_compression(self):
+        """Test identical ballots are grouped, with the pair counts unchanged"""
+        self.populate_database(election_type="Schulze")
+        userD = models.User(
+            name = "UserD",
+            email = "userD@eLect.com",
+            password = "asdf")
+        session.add(userD)
+        session.commit()
+
+        candidates = [self.candidateBA, self.candidateBB,
+            self.candidateBC, self.candidateBD]
+        # userA and userD cast the same ballot
+        ballots_cast = {
+            self.userA: [5, 0, 3, -2],
+            self.userB: [6, 1, -2, 5],
+            self.userC: [-2, 5, 2, 3],
+            userD: [5, 0, 3, -2]}
+        for user, values in ballots_cast.items():
+            for candidate, value in zip(candidates, values):
+                session.add(models.Vote(
+                    user_id = user.id,
+                    candidate_id = candidate.id,
+                    value = value))
+        session.commit()
+
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="stream"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="matrix"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+
+        response = self.client.get(
+            "/api/races/{}/ballots/stats".format(self.raceB.id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.data.decode("ascii"))
+        self.assertEqual(stats["num_ballots"], 4)
+        self.assertEqual(stats["num_unique_ballots"], 3)
+
+    def test_import_votes(self):
+        """Test bulk vote import from CSV, with rejected lines, rollups and
+        ranked votes"""
+        self.populate_database(election_type="Schulze")
+        import_dir = "test-import"
+        os.mkdir(import_dir)
+        path = os.path.join(import_dir, "votes.csv")
+        with open(path, "w") as vote_file:
+            vote_file.write("user_id,candidate_id,value\n")
+            for user, values in [(self.userA, [5, 0, 3, -2]),
+                    (self.userB, [6, 1, -2, 5])]:
+                for candidate, value in zip([self.candidateBA, self.candidateBB,
+                        self.candidateBC, self.candidateBD], values):
+                    vote_file.write("{},{},{}\n".format(user.id, candidate.id, value))
+            vote_file.write("{},{},1\n".format(self.userC.id, self.candidateAA.id))
+            vote_file.write("{},{},2\n".format(self.userA.id, self.candidateBA.id))
+            vote_file.write("{},9999,1\n".format(self.userC.id))
+            vote_file.write("9999,{},1\n".format(self.candidateAA.id))
+            vote_file.write("not,a,vote\n")
+
+        try:
+            stats = importer.import_votes(path)
+            self.assertEqual(stats["rows"], 9)
+            self.assertEqual(stats["rejected"], 4)
+            self.assertEqual(stats["races"], 2)
+            with open(stats["rejects_path"]) as rejects:
+                self.assertEqual(len(rejects.readlines()), 4)
+        finally:
+            shutil.rmtree(import_dir)
+
+        session.expire_all()
+        self.assertEqual(session.query(models.Vote).count(), 9)
+        vote = session.query(models.Vote).filter(
+            models.Vote.candidate_id == self.candidateAA.id).one()
+        self.assertEqual(vote.race_id, self.raceA.id)
+        for vote in session.query(models.Vote):
+            self.assertEqual(vote.ranked,
+                vote.race.election_type in models.Race._ranking_types)
+        self.assertTrue(session.query(models.Vote).filter(
+            models.Vote.race_id == self.raceB.id).first().ranked)
+        self.assertEqual(utils.rebuild_vote_tallies(self.raceB.id), [])
+        self.assertEqual(sorted(candidate_vote_sums(self.raceB.id, source="rollup")),
+            sorted(candidate_vote_sums(self.raceB.id, source="votes")))
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+
+    def test_vote_journal(self):
+        """Test journaled votes are flushed to the vote table once, with
+        pairwise counts, including on replay after a restart, and that
+        receipt status is read from disk"""
+        self.populate_database(election_type="Schulze")
+        self.electionA.elect_open = False
+        session.commit()
+        journal_root = "test-journal"
+        journal_dir = os.path.join(journal_root, "0000")
+
+        vote_journal = journal.VoteJournal(journal_dir, flush_interval=3600)
+        vote_journal.start()
+        try:
+            # Another process can't journal to the same directory
+            with self.assertRaises(JournalInUse):
+                journal.VoteJournal(journal_dir)
+            receipts = [vote_journal.append(self.userA.id, candidate.id, value)
+                for candidate, value in [(self.candidateBA, 3), (self.candidateBB, 0),
+                    (self.candidateBC, 2), (self.candidateBD, 1)]]
+            closed_receipt = vote_journal.append(self.userA.id, self.candidateAA.id, 1)
+            repeat_receipt = vote_journal.append(self.userA.id, self.candidateBA.id, 1)
+            self.assertEqual(vote_journal.status(receipts[0]), "pending")
+            self.assertEqual(journal.receipt_status(journal_root, receipts[0]), "pending")
+            vote_journal.close()
+
+            self.assertEqual([name for name in os.listdir(journal_dir)
+                if name.endswith(journal.SEGMENT_SUFFIX)], [])
+            self.assertEqual(vote_journal.status(receipts[0]), None)
+            self.assertEqual(vote_journal.status(closed_receipt), "rejected")
+            self.assertEqual(vote_journal.status(repeat_receipt), "rejected")
+            self.assertEqual(journal.receipt_status(journal_root, closed_receipt), "rejected")
+            self.assertEqual(journal.receipt_status(journal_root, receipts[0]), None)
+            vote_journal.receipt_ttl = -1
+            vote_journal.expire_receipts()
+            self.assertEqual(vote_journal.status(closed_receipt), None)
+
+            session.expire_all()
+            votes = session.query(models.Vote).all()
+            self.assertEqual(sorted(vote.receipt for vote in votes), sorted(receipts))
+            self.assertEqual(
+                self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+                self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+
+            # A segment left over from a crash, partly flushed already
+            with open(os.path.join(journal_dir, "000000000001.journal"), "w") as segment:
+                for receipt, user, candidate, value in [
+                        (receipts[0], self.userA, self.candidateBA, 3),
+                        ("replayed", self.userB, self.candidateBA, 1)]:
+                    segment.write(json.dumps({
+                        "receipt": receipt,
+                        "user_id": user.id,
+                        "candidate_id": candidate.id,
+                        "value": value,
+                        "start_date": "2016-01-01T00:00:00"}) + "\n")
+                segment.write('{"receipt": "torn"')
+
+            vote_journal = journal.VoteJournal(journal_dir)
+            self.assertEqual(vote_journal.status("replayed"), "pending")
+            vote_journal.flush_segments()
+            self.assertEqual(vote_journal.status(receipts[0]), None)
+            self.assertEqual(vote_journal.status("replayed"), None)
+            vote_journal._lock_file.close()
+
+            session.expire_all()
+            self.assertEqual(session.query(models.Vote).count(), 5)
+            self.assertEqual(
+                self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+                self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+        finally:
+            shutil.rmtree(journal_root)
+
+    def test_tally_engine_registry(self):
+        """Test tally engines are shared per election type, and that ORM
+        election types forward to them"""
+        for elect_type in ["WTA", "Proportional", "Schulze"]:
+            engine = get_tally_engine(elect_type)
+            self.assertIsInstance(engine, TallyEngine)
+            self.assertEqual(engine.election_type, elect_type)
+            self.assertIs(get_tally_engine(elect_type), engine)
+        self.assertEqual(get_tally_engine("IRV"), None)
+        self.assertIs(Schulze().engine, get_tally_engine("Schulze"))
+
+        # Engines must implement both tally methods
+        with self.assertRaises(TypeError):
+            @register_tally_engine("Test")
+            class IncompleteEngine(TallyEngine):
+                def tally_race(self, race_id):
+                    return {race_id: True}
+        self.assertNotIn("Test", TALLY_ENGINES)
+
+        @register_tally_engine("Test")
+        class TestEngine(TallyEngine):
+            def tally_race(self, race_id):
+                return {race_id: True}
+
+            def check_results(self, results):
+                pass
+        try:
+            self.assertEqual(get_tally_engine("Test").tally_race(7), {7: True})
+        finally:
+            del TALLY_ENGINES["Test"]
+
+        # Tallying through the API adds no election type rows
+        self.populate_database()
+        num_elect_types = session.query(models.ElectionType).count()
+        self.raceA.race_open = False
+        session.add(models.Vote(
+            user_id = self.userA.id,
+            candidate_id = self.candidateAA.id,
+            value = 1))
+        session.commit()
+        response = self.client.get("/api/races/{}/tally".format(self.raceA.id),
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.query(models.ElectionType).count(), num_elect_types)
+
+    def test_schulze_path_engines(self):
+        """Test the matrix strongest path engine against the dict reference,
+        over complete pair dicts and sparse ones like the pair builders
+        return, without their zero counts"""
+        schulze = get_tally_engine("Schulze")
+        rng = random.Random(1234)
+        for trial in range(50):
+            cand_ids = rng.sample(range(1, 100), rng.randint(2, 12))
+            pair_results = {(cand1, cand2): rng.randint(1, 50)
+                for cand1 in sorted(cand_ids) for cand2 in sorted(cand_ids)
+                if cand1 != cand2}
+            self.assertEqual(schulze.gen_path_matrix(pair_results),
+                schulze.gen_path_results(pair_results))
+        for trial in range(50):
+            cand_ids = rng.sample(range(1, 100), rng.randint(2, 12))
+            pair_results = {(cand1, cand2): count
+                for cand1 in sorted(cand_ids) for cand2 in sorted(cand_ids)
+                for count in [rng.choice([0, 0, rng.randint(1, 50)])]
+                if cand1 != cand2 and count}
+            self.assertEqual(schulze.gen_path_matrix(pair_results),
+                schulze.gen_path_results(pair_results))
+
+        # A unanimous pair has no reverse key.  Candidates in no pair aren't
+        # ranked, so an unvoted candidate doesn't tie with the winner
+        pair_results = {(1, 2): 5}
+        self.assertEqual(schulze.gen_path_results(pair_results),
+            ({1: True, 2: False}, [1, 2]))
+        self.assertEqual(schulze.gen_path_matrix(pair_results),
+            schulze.gen_path_results(pair_results))
+
+    def test_sharded_pair_counts(self):
+        """Test partial pair counts over voter shards merge to the full counts"""
+        self.populate_database(election_type="Schulze")
+        candidates = [self.candidateBA, self.candidateBB,
+            self.candidateBC, self.candidateBD]
+        ballots_cast = {
+            self.userA: [5, 0, 3, -2],
+            self.userB: [6, 1, -2, 5],
+            self.userC: [-2, 5, 2, 3]}
+        for user, values in ballots_cast.items():
+            for candidate, value in zip(candidates, values):
+                session.add(models.Vote(
+                    user_id = user.id,
+                    candidate_id = candidate.id,
+                    value = value))
+        session.commit()
+
+        pair_results = self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join")
+        for num_shards in (1, 2, 5):
+            partials = [ballots.partial_pairwise_counts(self.raceB.id,
+                shard=shard, num_shards=num_shards) for shard in range(num_shards)]
+            candidate_ids, counts = pairwise.merge_partials(partials)
+            self.assertEqual(pairwise.matrix_to_pair_dict(candidate_ids, counts),
+                pair_results)
+
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="sharded"),
+            pair_results)
+
+    def test_serializers(self):
+        """Test the serializers encode models as as_dictionary() does"""
+        self.populate_database()
+        vote = models.Vote(
+            user_id = self.userA.id,
+            candidate_id = self.candidateAA.id,
+            value = 1)
+        session.add(vote)
+        session.commit()
+
+        instances = [
+            (serializers.election, self.electionA),
+            (serializers.race, self.raceA),
+            (serializers.candidate, self.candidateAA),
+            (serializers.vote, vote),
+            (serializers.user, self.userA)]
+        for serializer, instance in instances:
+            self.assertEqual(
+                json.loads(serializers.dumps(serializer.row(instance)).decode("utf-8")),
+                json.loads(json.dumps(instance.as_dictionary(), default=utils.json_serial)))
+
+        # Core rows serialize the same as instances
+        row = session.execute(select(serializers.vote.columns()).where(
+            models.Vote.id == vote.id)).first()
+        self.assertEqual(serializers.vote.rows([row]), serializers.vote.rows([vote]))
+
+        # Tally results keep their int keys
+        self.assertEqual(json.loads(serializers.dumps({1: True}).decode("utf-8")),
+            {"1": True})
+
+    def explain(self, query):
+        """Returns the query plan of an ORM query or Core select, with
+        sequential scans disabled so the tiny test tables use their indexes"""
+        statement = getattr(query, "statement", query)
+        sql = str(statement.compile(dialect=engine.dialect,
+            compile_kwargs={"literal_binds": True}))
+        session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = "\n".join(line for line, in session.execute(text("EXPLAIN " + sql)))
+        session.rollback()
+        return plan
+
+    def test_hot_path_indexes(self):
+        """Test the migration is idempotent, backfills the vote tallies and
+        pairwise counts, and the hot queries use indexes"""
+        self.populate_database(election_type="Schulze")
+        for value, candidate in enumerate([self.candidateBA, self.candidateBB]):
+            session.add(models.Vote(
+                user_id = self.userA.id,
+                candidate_id = candidate.id,
+                value = value))
+        session.commit()
+        # Votes cast before the tally triggers existed have no rollup rows
+        session.query(models.CandidateTally).delete(synchronize_session=False)
+        session.query(models.PairwiseCount).delete(synchronize_session=False)
+        session.commit()
+
+        index_names = migrations.migrate()
+        self.assertEqual(migrations.migrate(), index_names)
+        self.assertEqual(utils.rebuild_vote_tallies(self.raceB.id), [])
+        self.assertEqual(sorted((count.cand1_id, count.cand2_id, count.num_users_prefer)
+            for count in session.query(models.PairwiseCount).filter(
+                models.PairwiseCount.race_id == self.raceB.id)),
+            [(self.candidateBB.id, self.candidateBA.id, 1)])
+        session.rollback()
+        for index_name in ["vote_race_user", "vote_candidate_user",
+                "candidate_race", "race_election", "candidate_tally_race",
+                "results_race_version", "vote_receipt_key"]:
+            self.assertIn(index_name, index_names)
+
+        vote = models.Vote.__table__
+        # Ballot loads, see ballots.load_ballot_matrix()
+        self.assertIn("vote_race_user", self.explain(
+            select([vote.c.user_id, vote.c.candidate_id, vote.c.value]).where(
+                vote.c.race_id == self.raceB.id,
+                vote.c.candidate_id.in_([self.candidateBA.id, self.candidateBB.id]))))
+        # A candidate's votes
+        self.assertIn("vote_candidate_user", self.explain(
+            session.query(models.Vote.user_id, models.Vote.value).filter(
+                models.Vote.candidate_id == self.candidateBA.id)))
+        # A user's ballot, see utils.race_ballot()
+        self.assertIn("vote_race_user", self.explain(
+            session.query(models.Vote.candidate_id, models.Vote.value).filter(
+                models.Vote.race_id == self.raceB.id,
+                models.Vote.user_id == self.userA.id)))
+        # GET /api/races/<race_id>/candidates
+        self.assertIn("candidate_race", self.explain(
+            session.query(models.Candidate.id, models.Candidate.title).filter(
+                models.Candidate.race_id == self.raceB.id).order_by(
+                models.Candidate.id).limit(101)))
+        # GET /api/elections/<elect_id>/races
+        self.assertIn("race_election", self.explain(
+            session.query(models.Race.id, models.Race.title).filter(
+                models.Race.election_id == self.electionA.id).order_by(
+                models.Race.id).limit(101)))
+        # Rollup vote sums, see electiontypes.candidate_vote_sums()
+        self.assertIn("candidate_tally_race", self.explain(
+            session.query(models.CandidateTally.vote_sum,
+                models.CandidateTally.candidate_id).filter(
+                models.CandidateTally.race_id == self.raceB.id,
+                models.CandidateTally.vote_count > 0)))
+
+    @unittest.skipUnless(models.VOTE_PARTITIONED, "VOTE_PARTITION_BY_RACE is not set")
+    def test_vote_partitions(self):
+        """Test races get vote partitions, which tallies prune to and which
+        are dropped with their election"""
+        self.populate_database(election_type="Schulze")
+        for value, candidate in enumerate([self.candidateBA, self.candidateBB]):
+            session.add(models.Vote(
+                user_id = self.userA.id,
+                candidate_id = candidate.id,
+                value = value))
+        session.commit()
+
+        partitions = set(name for name, in session.execute(text(
+            "SELECT inhrelid::regclass::text FROM pg_inherits "
+            "WHERE inhparent = 'vote'::regclass")))
+        race_ids = [race_id for race_id, in session.query(models.Race.id).filter(
+            models.Race.election_id == self.electionA.id)]
+        self.assertTrue(set(models.vote_partition_name(race_id)
+            for race_id in race_ids) <= partitions)
+
+        vote = models.Vote.__table__
+        plan = self.explain(select([vote.c.user_id, vote.c.candidate_id, vote.c.value]).where(
+            vote.c.race_id == self.raceB.id))
+        self.assertIn(models.vote_partition_name(self.raceB.id), plan)
+        self.assertNotIn(models.vote_partition_name(self.raceA.id), plan)
+
+        response = self.client.delete("/api/elections",
+            data=json.dumps({"id": self.electionA.id}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        for race_id in race_ids:
+            self.assertEqual(session.execute(text("SELECT to_regclass(:name)"),
+                {"name": models.vote_partition_name(race_id)}).scalar(), None)
+        self.assertEqual(session.query(models.Vote).filter(
+            models.Vote.race_id.in_(race_ids)).count(), 0)
+
+    @unittest.skipUnless(database.replicas.engines, "No REPLICA_DATABASE_URIS configured")
+    def test_replica_routing(self):
+        """Test GET requests read from a replica, except right after the
+        client wrote.  The second instance isn't really replicating, so it
+        holds different rows under the same ids"""
+        replica_engine = database.replicas.engines[0]
+        Base.metadata.drop_all(replica_engine)
+        Base.metadata.create_all(replica_engine)
+        self.addCleanup(Base.metadata.drop_all, replica_engine)
+        election = models.Election(title="Primary election")
+        session.add(election)
+        session.commit()
+        url = "/api/elections/{}".format(election.id)
+        with replica_engine.begin() as connection:
+            connection.execute(models.Election.__table__.insert().values(
+                id=election.id, title="Replica election"))
+
+        response = self.client.get(url,
+            headers=[("Accept", "application/json")])
+        election = json.loads(response.data.decode("ascii"))
+        self.assertEqual(election["title"], "Replica election")
+        response = self.client.get("/api/database/pool",
+            headers=[("Accept", "application/json")])
+        status = json.loads(response.data.decode("ascii"))
+        self.assertEqual(status["replicas"][0]["lag_seconds"], 0)
+
+        # Reads go to the primary for a while after a write
+        response = self.client.post("/api/elections",
+            data=json.dumps({"title": "Election C"}),
+            content_type="application/json",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(url,
+            headers=[("Accept", "application/json")])
+        election = json.loads(response.data.decode("ascii"))
+        self.assertEqual(election["title"], "Primary election")
+
+        # A session that writes reads its own writes from the primary
+        session.info["read_engine"] = replica_engine
+        self.assertEqual(session.query(models.Election).get(
+            election["id"]).title, "Replica election")
+        session.expire_all()
+        session.add(models.Election(title="Election D"))
+        session.flush()
+        self.assertNotIn("read_engine", session.info)
+        self.assertEqual(session.query(models.Election).get(
+            election["id"]).title, "Primary election")
+        session.rollback()
+
+    def test_scoped_sessions(self):
+        """Test each thread gets its own session, and the pool stats"""
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(session()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], session())
+        self.assertIs(session(), session())
+
+        database.checkout_stats.reset()
+        session.execute(select([1]))
+        session.commit()
+        response = self.client.get("/api/database/pool",
+            headers=[("Accept", "application/json")])
+        self.assertEqual(response.status_code, 200)
+        status = json.loads(response.data.decode("ascii"))
+        self.assertEqual(status["size"], app.config["DB_POOL_SIZE"])
+        self.assertTrue(status["checkouts"] >= 1)
+        self.assertEqual(status["timeouts"], 0)
+        self.assertTrue(status["wait_seconds_max"] >= status["wait_seconds_mean"] >= 0)
+
+    def test_failed_request_session(self):
+        """Test a request that fails mid-transaction has its session rolled
+        back and removed, so the next request on its thread starts clean
+        and its connection goes back to the pool.  The requests run on their
+        own thread, without the test's app context, so each ends its own"""
+        results = []
+
+        def failing_pool_status():
+            session.execute(text("SELECT 1 / 0"))
+
+        def send():
+            try:
+                self.client.get("/api/database/pool",
+                    headers=[("Accept", "application/json")])
+            except sqlalchemy.exc.DBAPIError as error:
+                results.append(error)
+            response = self.client.get("/api/elections",
+                headers=[("Accept", "application/json")])
+            results.append(response.status_code)
+
+        checked_out = engine.pool.checkedout()
+        original_pool_status = api.pool_status
+        api.pool_status = failing_pool_status
+        try:
+            thread = threading.Thread(target=send)
+            thread.start()
+            thread.join()
+        finally:
+            api.pool_status = original_pool_status
+
+        self.assertIsInstance(results[0], sqlalchemy.exc.DataError)
+        self.assertEqual(results[1:], [200])
+        self.assertEqual(engine.pool.checkedout(), checked_out)
+
+    @unittest.skipUnless(async_ingest, "aiohttp and asyncpg are not installed")
+    def test_async_ingest(self):
+        """Test the asyncio ingestion service casts votes and ballots, and
+        rejects them, as the Flask API does"""
+        self.populate_database(election_type="Schulze")
+        self.raceB.max_vote_val = 4
+        session.commit()
+        requests = [
+            ("/api/votes", {"user_id": self.userB.id,
+                "candidate_id": self.candidateAA.id, "value": 1}),
+            ("/api/votes", {"user_id": self.userB.id,
+                "candidate_id": self.candidateAA.id, "value": 1}),
+            ("/api/races/{}/ballot".format(self.raceB.id), {"user_id": self.userA.id,
+                "votes": [
+                    {"candidate_id": self.candidateBA.id, "value": 4},
+                    {"candidate_id": self.candidateBB.id, "value": 0}]}),
+            ("/api/votes", {"user_id": self.userA.id,
+                "candidate_id": self.candidateBC.id, "value": 3}),
+            ("/api/votes", {"user_id": 999999,
+                "candidate_id": self.candidateBD.id, "value": 1}),
+            ("/api/votes", {"user_id": self.userA.id, "value": 1}),
+            ("/api/votes", {"user_id": self.userC.id,
+                "candidate_id": self.candidateAA.id, "value": 2.5}),
+            ("/api/votes", {"user_id": self.userC.id,
+                "candidate_id": self.candidateAA.id, "value": 1.0}),
+            ]
+
+        async def post_all():
+            responses = []
+            async with TestClient(TestServer(async_ingest.create_app())) as client:
+                for url, data in requests:
+                    response = await client.post(url, json=data,
+                        headers={"Accept": "application/json"})
+                    responses.append((response.status,
+                        response.headers.get("Location"), await response.json()))
+            return responses
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        responses = loop.run_until_complete(post_all())
+        self.assertEqual([status for status, location, data in responses],
+            [201, 403, 201, 201, 404, 422, 422, 201])
+
+        status, location, vote = responses[0]
+        self.assertEqual(location, "/api/elections/{}".format(self.electionA.id))
+        self.assertEqual(vote["user_id"], self.userB.id)
+        self.assertEqual(vote["candidate_id"], self.candidateAA.id)
+        self.assertEqual(vote["race_id"], self.raceA.id)
+        self.assertEqual(responses[1][2]["message"],
+            "User with id {} has already voted for candidate with id {}.".format(
+                self.userB.id, self.candidateAA.id))
+        status, location, ballot = responses[2]
+        self.assertEqual(location, "/api/races/{}".format(self.raceB.id))
+        self.assertEqual(len(ballot["votes"]), 2)
+        self.assertEqual(responses[4][2]["message"],
+            "Could not find user with id 999999")
+
+        votes = session.query(models.Vote).filter(
+            models.Vote.user_id == self.userA.id).all()
+        self.assertEqual(len(votes), 3)
+        self.assertEqual(
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="persisted"),
+            self.schulze.engine.gen_pair_results(self.raceB, pair_builder="join"))
+
     def tearDown(self):
         """ Test teardown """
         session.close()
         # Remove the tables and their data from the database
         Base.metadata.drop_all(engine)
+        self.app_context.pop()
 
 